@@ -0,0 +1,236 @@
+# admission.py
+"""Admission control and a circuit breaker for slow upstream calls (Vertex AI).
+
+    guard = UpstreamGuard("vertex", slots=8, queue_size=16, queue_timeout=5, deadline=60,
+                          breaker=CircuitBreaker("vertex"))
+    res = guard.call(model.generate_images, prompt=prompt)
+
+At most `slots` calls run at once, on the guard's own threads. Up to
+`queue_size` more wait for a slot, each for at most `queue_timeout` seconds;
+anyone beyond that is turned away straight away. A caller gets its result
+within `deadline` seconds or gives up; the call itself can't be interrupted,
+so it keeps its slot until it really returns, and a hung upstream never has
+more than `slots` calls outstanding.
+
+The breaker watches the last `window` calls. Once it has seen `min_calls` and
+the share that failed, or that ran longer than `slow_seconds`, reaches
+`error_rate` / `slow_rate`, it opens and calls fail at once for
+`open_seconds`. Then a single trial call goes through: if it's fine the
+circuit closes, otherwise it opens again.
+
+Every refusal is a DependencyUnavailable, which the routes already answer
+with a 503 after refunding the reservation.
+"""
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import metrics
+from clients import DependencyUnavailable
+
+UPSTREAM_REJECTED = metrics.counter("upstream_rejected_total", "Upstream calls refused or abandoned",
+                                    ("dependency", "reason"))
+BREAKER_TRANSITIONS = metrics.counter("circuit_breaker_transitions_total", "Circuit breaker state changes",
+                                      ("dependency", "state"))
+
+
+class UpstreamRejected(DependencyUnavailable):
+    reason = "rejected"
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Overloaded(UpstreamRejected):
+    reason = "overloaded"
+
+
+class DeadlineExceeded(UpstreamRejected):
+    reason = "deadline"
+
+
+class CircuitOpen(UpstreamRejected):
+    reason = "circuit_open"
+
+
+class CircuitBreaker:
+    def __init__(self, name, window=20, min_calls=10, error_rate=0.5, slow_seconds=30.0, slow_rate=0.5,
+                 open_seconds=30.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._outcomes = deque(maxlen=window)   # (failed, slow) for recent calls
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Raise CircuitOpen unless a call may go ahead. Returns True for the trial call."""
+        with self._lock:
+            if self.state == "closed":
+                return False
+            retry_after = self._opened_at + self.open_seconds - time.monotonic()
+            if self.state == "open" and retry_after <= 0:
+                self._set_state("half_open")
+            if self.state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+        raise CircuitOpen(f"{self.name} is failing; try again shortly", retry_after=max(retry_after, 1))
+
+    def record(self, failed, seconds, trial=False):
+        slow = seconds >= self.slow_seconds
+        with self._lock:
+            if trial:
+                self._trial_running = False
+                self._set_state("open" if failed or slow else "closed")
+                return
+            if self.state != "closed":
+                return   # calls let in before the circuit opened
+            self._outcomes.append((failed, slow))
+            n = len(self._outcomes)
+            if n < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            slow_calls = sum(1 for _, slow in self._outcomes if slow)
+            if failures / n >= self.error_rate or slow_calls / n >= self.slow_rate:
+                self._set_state("open")
+
+    def cancel(self, trial):
+        """A call that allow() let through never ran."""
+        if trial:
+            with self._lock:
+                self._trial_running = False
+
+    def _set_state(self, state):
+        if state == "open":
+            self._opened_at = time.monotonic()
+        if state != "half_open":
+            self._outcomes.clear()
+        if state != self.state:
+            self.state = state
+            BREAKER_TRANSITIONS.inc(dependency=self.name, state=state)
+
+    def stats(self):
+        with self._lock:
+            outcomes = list(self._outcomes)
+            stats = {"state": self.state, "recentCalls": len(outcomes)}
+            if outcomes:
+                stats["errorRate"] = round(sum(1 for f, _ in outcomes if f) / len(outcomes), 3)
+                stats["slowRate"] = round(sum(1 for _, s in outcomes if s) / len(outcomes), 3)
+            if self.state == "open":
+                stats["retryInSeconds"] = round(max(self._opened_at + self.open_seconds - time.monotonic(), 0), 1)
+            return stats
+
+
+class UpstreamGuard:
+    def __init__(self, name, slots=8, queue_size=16, queue_timeout=5.0, deadline=60.0, breaker=None):
+        self.name = name
+        self.slots = slots
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.deadline = deadline
+        self.breaker = breaker
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=slots, thread_name_prefix=f"{name}-call")
+        self._admitted = 0   # waiting + running
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) on one of the guard's slots, within the deadline."""
+        started_at = time.monotonic()
+        future = self.submit(fn, *args, **kwargs)
+        return self.result(future, self.deadline - (time.monotonic() - started_at))
+
+    def submit(self, fn, *args, **kwargs):
+        """Start fn(*args, **kwargs) on a slot, queueing for one if need be. Returns its Future."""
+        try:
+            future = self._submit(fn, args, kwargs, self.slots + self.queue_size, self.queue_timeout)
+        except CircuitOpen as e:
+            raise self.reject(e) from None
+        if future is None:
+            raise self.reject(Overloaded(f"{self.name} is at capacity; try again shortly", retry_after=1))
+        return future
+
+    def try_submit(self, fn, *args, **kwargs):
+        """Like submit(), but only if a slot is free right now. Returns None otherwise."""
+        try:
+            return self._submit(fn, args, kwargs, self.slots, None)
+        except CircuitOpen:
+            return None
+
+    def result(self, future, timeout):
+        """The call's result, or DeadlineExceeded after `timeout` seconds."""
+        try:
+            return future.result(timeout=max(timeout, 0))
+        except FutureTimeout:
+            raise self.reject(DeadlineExceeded(f"{self.name} did not answer in time")) from None
+
+    def reject(self, error):
+        """Count a refusal; returns the error to raise."""
+        with self._lock:
+            self.rejected += 1
+        UPSTREAM_REJECTED.inc(dependency=self.name, reason=error.reason)
+        return error
+
+    def _submit(self, fn, args, kwargs, limit, queue_timeout):
+        trial = self.breaker.allow() if self.breaker is not None else False
+        with self._lock:
+            full = self._admitted >= limit
+            if not full:
+                self._admitted += 1
+        if full:
+            self._cancelled(trial)
+            return None
+
+        started = threading.Event()
+        # The call runs on the guard's thread but keeps the request's context (log request ID)
+        future = self._executor.submit(contextvars.copy_context().run, self._run, started, trial, fn, args, kwargs)
+        if queue_timeout is not None and not started.wait(queue_timeout) and future.cancel():
+            with self._lock:
+                self._admitted -= 1
+            self._cancelled(trial)
+            raise self.reject(Overloaded(f"{self.name} is busy: no free slot within {queue_timeout:g}s",
+                                         retry_after=1))
+        return future
+
+    def _run(self, started, trial, fn, args, kwargs):
+        with self._lock:
+            self._running += 1
+        started.set()
+        began = time.perf_counter()
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            if self.breaker is not None:
+                self.breaker.record(failed, time.perf_counter() - began, trial)
+            with self._lock:
+                self._running -= 1
+                self._admitted -= 1
+
+    def _cancelled(self, trial):
+        if self.breaker is not None:
+            self.breaker.cancel(trial)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "slots": self.slots,
+                "running": self._running,
+                "queued": self._admitted - self._running,
+                "queueSize": self.queue_size,
+                "rejected": self.rejected,
+            }
+        if self.breaker is not None:
+            stats["breaker"] = self.breaker.stats()
+        return stats
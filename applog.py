@@ -0,0 +1,223 @@
+# applog.py
+"""Structured logging that never blocks a request thread.
+
+    applog.setup()                           # once, at startup
+    log = logging.getLogger(__name__)
+    log.debug("credits deducted", extra={"userId": user_id, "cost": 1})
+
+    applog.begin_request()                   # before_request
+    with applog.stage("model_call"):
+        ...
+    applog.stages()                          # {"model_call": 812.4}
+    applog.end_request()                     # teardown
+
+Records go onto a bounded queue and a background thread writes them to stderr
+as JSON lines (LOG_FORMAT=text for a plain format). The request thread only
+formats the message and, for errors, the traceback; when the queue is full the
+record is dropped and counted rather than waiting for the writer.
+
+Every record logged during a request carries its correlation ID. LOG_SAMPLE
+("DEBUG=0.01,INFO=1") keeps that fraction of each level; the decision is made
+per request ID, so a sampled request keeps all of its lines. WARNING and above
+are never sampled.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import copy
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+import contextvars
+from contextlib import contextmanager
+
+import metrics
+
+QUEUE_SIZE = 10000
+DEFAULT_SAMPLE = "DEBUG=0.01"
+
+LOG_DROPPED = metrics.counter("log_records_dropped_total", "Log records dropped because the queue was full")
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+_stages = contextvars.ContextVar("stages", default=None)
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+_listener = None
+_handler = None
+
+
+# ---- Request context ----
+
+def begin_request(request_id=None):
+    """Start a request: set its correlation ID (a new one unless given) and clear
+    the stage timings. Returns the ID."""
+    if not request_id or len(request_id) > 64 or not request_id.isprintable():
+        request_id = uuid.uuid4().hex[:16]
+    _request_id.set(request_id)
+    _stages.set({})
+    return request_id
+
+
+def end_request():
+    _request_id.set(None)
+    _stages.set(None)
+
+
+def request_id():
+    return _request_id.get()
+
+
+def stages():
+    """Time spent so far in each stage of the current request, in ms."""
+    return dict(_stages.get() or {})
+
+
+@contextmanager
+def stage(name):
+    """Add the time spent in the block to the current request's `name` stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = _stages.get()
+        if stages is not None:
+            elapsed = (time.perf_counter() - started) * 1000
+            stages[name] = round(stages.get(name, 0.0) + elapsed, 2)
+
+
+# ---- Handlers and formatters ----
+
+def parse_sample(spec):
+    """"DEBUG=0.01,INFO=0.5" -> {10: 0.01, 20: 0.5}"""
+    rates = {}
+    for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+        name, _, rate = part.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int) or level >= logging.WARNING:
+            raise ValueError(f"Can't sample log level {name!r}")
+        rates[level] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class _ContextFilter(logging.Filter):
+    """Tags records with the request ID and drops the ones sampled out.
+    Runs on the calling thread, where the request's context is."""
+
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        rid = _request_id.get()
+        record.request_id = rid
+        rate = self.sample_rates.get(record.levelno)
+        if rate is None or rate >= 1:
+            return True
+        if rid is None:
+            return random.random() < rate
+        return zlib.crc32(rid.encode("utf-8")) % 10000 < rate * 10000
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only what has to happen here: the message and traceback need this
+        # thread's objects. JSON encoding and the write happen on the writer.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+def _extra(record):
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS and not k.startswith("_")}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["requestId"] = record.request_id
+        entry.update(_extra(record))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra(record)
+        if getattr(record, "request_id", None):
+            fields = dict(requestId=record.request_id, **fields)
+        if fields:
+            extra = " ".join(f"{k}={json.dumps(v, default=str)}" for k, v in fields.items())
+            line, _, exc = line.partition("\n")
+            line = f"{line} {extra}" + (f"\n{exc}" if exc else "")
+        return line
+
+
+# ---- Setup ----
+
+def setup(level=None, fmt=None, sample=None, stream=None):
+    """Send every logger through the queue to a background writer. Later calls do nothing."""
+    global _listener, _handler
+    if _listener is not None:
+        return
+    level = level or os.environ.get("LOG_LEVEL", "DEBUG")
+    fmt = fmt or os.environ.get("LOG_FORMAT", "json")
+    sample = sample if sample is not None else os.environ.get("LOG_SAMPLE", DEFAULT_SAMPLE)
+
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+    _handler = _QueueHandler(queue.Queue(QUEUE_SIZE))
+    _handler.addFilter(_ContextFilter(parse_sample(sample)))
+
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level.upper())
+    _listener = logging.handlers.QueueListener(_handler.queue, writer)
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    """Write out what's queued and detach the handler."""
+    global _listener, _handler
+    listener, _listener = _listener, None
+    if listener is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    _handler = None
+    listener.stop()
+
+
+def stats():
+    return {
+        "queued": _listener.queue.qsize() if _listener is not None else 0,
+        "dropped": int(LOG_DROPPED.value()),
+    }
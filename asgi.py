@@ -0,0 +1,382 @@
+# asgi.py
+"""Async serving mode: the same API on an event loop.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+/generate and /generate-batch are native async handlers. A generation waiting
+for Imagen is a coroutine, not a parked thread: it waits on the event loop
+for one of the VERTEX_MAX_CONCURRENCY slots (at most ASGI_MAX_PENDING
+requests, each for up to ASGI_QUEUE_TIMEOUT seconds), and only the call
+itself runs on a thread, through the same retry / hedging policy, admission
+guard and circuit breaker as in Flask mode. Credit reservations and refunds
+run on the thread pool. GET /asgi-stats shows how many are waiting.
+
+Everything else (credits, daily claim, checkout, the Stripe webhook, video
+jobs, static files, /health, /metrics) is the Flask app from index.py mounted
+underneath and run on the thread pool (ASGI_THREADS), so those responses are
+exactly the Flask ones.
+
+`python bench.py --server asgi` runs the load test against this app; compare
+with the default `--server flask`.
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+import warnings
+import functools
+import contextvars
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import anyio
+from fastapi import FastAPI, APIRouter, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+
+with warnings.catch_warnings():
+    # Deprecated in favour of a2wsgi, which isn't a dependency; the pinned starlette has it
+    warnings.simplefilter("ignore")
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+import index
+import applog
+from admission import Overloaded
+from clients import DependencyUnavailable
+from result_cache import ResultCache
+
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", "64"))
+ASGI_MAX_PENDING = int(os.environ.get("ASGI_MAX_PENDING", "5000"))
+ASGI_QUEUE_TIMEOUT = float(os.environ.get("ASGI_QUEUE_TIMEOUT", "60"))
+
+log = logging.getLogger(__name__)
+
+
+class VertexSlots:
+    """Waits for a Vertex slot on the event loop, then runs the call on a thread."""
+
+    def __init__(self, slots, max_pending, queue_timeout):
+        self.slots = slots
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.pending = 0
+        self.running = 0
+        self._free = None
+        self._threads = ThreadPoolExecutor(max_workers=slots, thread_name_prefix="asgi-vertex")
+
+    def start(self):
+        # asyncio primitives belong to the loop that first waits on them
+        self._free = asyncio.Semaphore(self.slots)
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            raise index.vertex_guard.reject(Overloaded("vertex is at capacity; try again shortly", retry_after=1))
+        self.pending += 1
+        try:
+            await asyncio.wait_for(self._free.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise index.vertex_guard.reject(Overloaded(
+                f"vertex is busy: no free slot within {self.queue_timeout:g}s", retry_after=1)) from None
+        finally:
+            self.pending -= 1
+        self.running += 1
+        try:
+            # copy_context keeps the request ID and stage timings on the worker thread
+            call = functools.partial(contextvars.copy_context().run, fn, *args)
+            return await asyncio.get_running_loop().run_in_executor(self._threads, call)
+        finally:
+            self.running -= 1
+            self._free.release()
+
+    def load(self):
+        """Slot use in the shape the tier router reads from vertex_guard.stats()"""
+        return {"slots": self.slots, "running": self.running, "queued": self.pending}
+
+    def stats(self):
+        return {"slots": self.slots, "pending": self.pending, "maxPending": self.max_pending}
+
+
+vertex_slots = VertexSlots(index.vertex_guard.slots, ASGI_MAX_PENDING, ASGI_QUEUE_TIMEOUT)
+# Requests queue here, in front of vertex_guard, so this is where the router sees load
+index.model_router.load = vertex_slots.load
+
+
+class InstrumentedRoute(APIRoute):
+    """Request ID, the per-request log line and HTTP metrics, as index.py's Flask hooks do."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path.replace("{", "<").replace("}", ">")   # same labels as Flask
+
+        async def instrumented(request):
+            request_id = applog.begin_request(request.headers.get("X-Request-ID"))
+            started = time.perf_counter()
+            status = 500
+            index.HTTP_IN_FLIGHT.inc(route=route)
+            try:
+                response = await handler(request)
+                status = response.status_code
+                response.headers["X-Request-ID"] = request_id
+                return response
+            finally:
+                index.HTTP_IN_FLIGHT.dec(route=route)
+                index.HTTP_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method)
+                index.HTTP_REQUESTS.inc(route=route, method=request.method, status=str(status))
+                log.log(logging.WARNING if status >= 500 else logging.INFO, "request", extra={
+                    "method": request.method,
+                    "route": route,
+                    "status": status,
+                    "durationMs": round((time.perf_counter() - started) * 1000, 2),
+                    "stages": applog.stages(),
+                })
+                applog.end_request()
+
+        return instrumented
+
+
+router = APIRouter(route_class=InstrumentedRoute)
+
+
+async def _json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _error(message, status, **fields):
+    return JSONResponse(dict(fields, error=message), status_code=status)
+
+
+def _unavailable(e):
+    retry_after = getattr(e, "retry_after", None)
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))} if retry_after else None
+    return JSONResponse({"error": str(e)}, status_code=503, headers=headers)
+
+
+def _static_url(request, filename):
+    return str(request.base_url).rstrip("/") + f"/static/{filename}"
+
+
+async def _rate_limited(name, user_id):
+    wait = await run_in_threadpool(index.rate_limiter.check, name, user_id)
+    if not wait:
+        return None
+    retry_after = max(1, math.ceil(wait))
+    return JSONResponse({"error": f"Too many requests. Try again in {retry_after} seconds.",
+                         "retryAfter": retry_after},
+                        status_code=429, headers={"Retry-After": str(retry_after)})
+
+
+async def _reserve(user_id, cost):
+    return await run_in_threadpool(index.reserve_credits, user_id, cost)
+
+
+async def _with_reservation(reservation, fn, *args):
+    """Await fn(*args) on a Vertex slot; refund the reservation if it fails (or the client goes away)."""
+    try:
+        result = await vertex_slots.run(fn, *args)
+    except BaseException:
+        with anyio.CancelScope(shield=True):
+            try:
+                await run_in_threadpool(reservation.refund)
+            except Exception:
+                log.exception("Refund failed, credits lost", extra={"userId": reservation.user_id,
+                                                                   "amount": reservation.cost})
+        raise
+    await run_in_threadpool(reservation.commit)
+    return result
+
+
+def _cache_hit(user_id, filename, tier, inline):
+    """Charge (or look up the balance) for a result cache hit. Returns (error, balance, png)."""
+    cost = index._cache_hit_cost(tier)
+    if cost > 0:
+        reservation, remaining_credits = index.reserve_credits(user_id, cost=cost)
+        if reservation is None:
+            return index._credits_message(cost, "an image"), remaining_credits, None
+        reservation.commit()
+    else:
+        remaining_credits = index.credit_store.balance(user_id)
+    png = None
+    if inline:
+        with open(index.storage.path(filename), "rb") as f:
+            png = f.read()
+    return None, remaining_credits, png
+
+
+def _png_response(img_bytes, remaining_credits):
+    return Response(img_bytes, media_type="image/png", headers={
+        "Cache-Control": "no-store",
+        "X-Remaining-Credits": str(remaining_credits)
+    })
+
+
+def _generate_inline(prompt, gen_params, tier):
+    return index._extract_first_image_bytes(index._generate_images(prompt, tier, **gen_params))
+
+
+@router.post("/generate")
+async def generate(request: Request):
+    try:
+        data = await _json(request)
+        prompt = (data.get("prompt") or "").strip()
+        user_id = data.get("userId")
+        quality = data.get("quality")
+        inline = request.query_params.get("inline") == "1"
+
+        if not prompt:
+            return _error("No prompt provided", 400)
+        if not user_id:
+            return _error("User ID required", 400)
+        if index._bad_quality(quality):
+            return _error(index._bad_quality(quality), 400)
+
+        limited = await _rate_limited("generate", user_id)
+        if limited:
+            return limited
+
+        tier, tier_reason = await run_in_threadpool(index._choose_tier, user_id, quality)
+        gen_params = {"number_of_images": 1}
+        request_key = ResultCache.key(prompt, tier.model_id, gen_params)
+        if index.prewarmer is not None:
+            index.prewarmer.observe(request_key, (prompt, tier.name))
+
+        cache_key = None
+        if index.result_cache is not None:
+            cache_key = request_key
+            cached_name = await run_in_threadpool(index.result_cache.get, cache_key)
+            if cached_name:
+                filename = "cache/" + cached_name
+                error, remaining_credits, png = await run_in_threadpool(_cache_hit, user_id, filename, tier, inline)
+                if error:
+                    return _error(error, 402, currentCredits=remaining_credits)
+                if inline:
+                    return _png_response(png, remaining_credits)
+                return JSONResponse({
+                    "filename": filename,
+                    "relative_url": f"/static/{filename}",
+                    "url": _static_url(request, filename),
+                    "remainingCredits": remaining_credits,
+                    "tier": tier.name,
+                    "cached": True
+                })
+
+        reservation, remaining_credits = await _reserve(user_id, tier.credits)
+        if reservation is None:
+            return _error(index._credits_message(tier.credits, "an image"), 402,
+                          currentCredits=remaining_credits)
+
+        if inline:
+            img_bytes = await _with_reservation(reservation, _generate_inline, prompt, gen_params, tier)
+            response = _png_response(img_bytes, remaining_credits)
+            response.headers["X-Image-Tier"] = tier.name
+            return response
+
+        filename = None
+        if index.prewarmer is not None:
+            filename = await run_in_threadpool(index._take_prewarmed, request_key, user_id)
+        prewarmed = filename is not None
+        if prewarmed:
+            await run_in_threadpool(reservation.commit)
+        else:
+            filename = await _with_reservation(reservation, index._generate_shared, user_id, request_key, prompt,
+                                               gen_params, cache_key, tier)
+        return JSONResponse({
+            "filename": filename,
+            "relative_url": f"/static/{filename}",
+            "url": _static_url(request, filename),
+            "remainingCredits": remaining_credits,
+            "tier": tier.name,
+            "degraded": tier_reason == "degraded",
+            "prewarmed": prewarmed
+        })
+
+    except DependencyUnavailable as e:
+        return _unavailable(e)
+
+    except Exception as e:
+        log.exception("Error in /generate")
+        return _error(str(e), 500)
+
+
+@router.post("/generate-batch")
+async def generate_batch(request: Request):
+    try:
+        data = await _json(request)
+        prompt = (data.get("prompt") or "").strip()
+        user_id = data.get("userId")
+
+        if not prompt:
+            return _error("No prompt provided", 400)
+        if not user_id:
+            return _error("User ID required", 400)
+
+        try:
+            count = int(data.get("count", index.IMAGEN_MAX_IMAGES))
+        except (TypeError, ValueError):
+            count = 0
+        if not 1 <= count <= index.IMAGEN_MAX_IMAGES:
+            return _error(f"count must be between 1 and {index.IMAGEN_MAX_IMAGES}", 400)
+
+        quality = data.get("quality")
+        if index._bad_quality(quality):
+            return _error(index._bad_quality(quality), 400)
+
+        limited = await _rate_limited("generate", user_id)
+        if limited:
+            return limited
+
+        tier, tier_reason = await run_in_threadpool(index._choose_tier, user_id, quality, count)
+        reservation, remaining_credits = await _reserve(user_id, count * tier.credits)
+        if reservation is None:
+            return _error(index._credits_message(count * tier.credits, f"{count} images"), 402,
+                          currentCredits=remaining_credits)
+
+        filenames = await _with_reservation(reservation, index._generate_batch_files, prompt, count, user_id, tier)
+        if len(filenames) < count:
+            # Some images were filtered out; only charge for what came back
+            await run_in_threadpool(reservation.reduce_to, len(filenames) * tier.credits)
+
+        return JSONResponse({
+            "images": [{
+                "filename": filename,
+                "relative_url": f"/static/{filename}",
+                "url": _static_url(request, filename)
+            } for filename in filenames],
+            "count": len(filenames),
+            "creditsCharged": reservation.cost,
+            "remainingCredits": reservation.balance,
+            "tier": tier.name,
+            "degraded": tier_reason == "degraded"
+        })
+
+    except DependencyUnavailable as e:
+        return _unavailable(e)
+
+    except Exception as e:
+        log.exception("Error in /generate-batch")
+        return _error(str(e), 500)
+
+
+@router.get("/asgi-stats")
+async def asgi_stats():
+    return {"vertexSlots": vertex_slots.stats(), "threads": ASGI_THREADS}
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Mounted Flask requests and credit calls share this pool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ASGI_THREADS
+    vertex_slots.start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+app.include_router(router)
+app.mount("/", WSGIMiddleware(index.app))
@@ -0,0 +1,220 @@
+# assets.py
+"""The HTML pages, served from memory: precompressed, fingerprinted and revalidated.
+
+Each page is read once. Its references to Media/ files are rewritten to
+fingerprinted names (Media/image.png?v=2 -> Media/image.3f2a9c81d0.png,
+from the file's content hash), and gzip and brotli copies are made. A
+request gets the smallest copy its Accept-Encoding allows, with a strong
+ETag per copy, so a revalidation is a 304 with no body; serving a page
+costs a dict lookup, not a file read and a compress.
+
+Fingerprinted Media/ URLs change whenever the file does, so serve_media
+sends them with a one-year immutable Cache-Control. The pages themselves
+keep their URLs and are sent with `no-cache` (always revalidate).
+
+A page is reloaded when its file, or a Media/ file it links to, changes
+(both are checked at most every `check_interval` seconds). Compressed copies are also written to `cache_dir`
+under the content hash, so other workers and later restarts load them
+instead of compressing again; `python assets.py build` fills it ahead of a
+deploy. Brotli needs the `brotli` package; without it pages are sent gzipped.
+"""
+import os
+import re
+import sys
+import gzip
+import time
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+
+from delivery import atomic_write
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PAGES = ("index.html", "image.html", "video.html", "pricing.html")
+FINGERPRINT_LENGTH = 10
+# Media/name.ext with an optional ?v=... cache buster, inside quotes or url(...)
+MEDIA_REF = re.compile(r"""(?<=["'(])(/?Media/)([^"'?)\s]+)(\?v=[^"')\s]*)?(?=["')])""")
+FINGERPRINTED = re.compile(r"^(.+)\.([0-9a-f]{%d})(\.[^./]+)$" % FINGERPRINT_LENGTH)
+
+log = logging.getLogger(__name__)
+
+# bodies: encoding -> bytes; media: ((Media/ name, (mtime, size) or None), ...) as of the load
+Page = namedtuple("Page", "mtime size digest bodies media")
+
+
+def _compressors():
+    compressors = {"gzip": lambda data: gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        compressors["br"] = lambda data: brotli.compress(data, quality=11, mode=brotli.MODE_TEXT)
+    return compressors
+
+
+class AssetStore:
+    def __init__(self, root, media_dir, pages=PAGES, cache_dir=None, check_interval=2.0):
+        self.root = root
+        self.media_dir = media_dir
+        self.pages = tuple(pages)
+        self.cache_dir = cache_dir
+        self.check_interval = check_interval
+        self.compressors = _compressors()
+        self._pages = {}         # name -> Page
+        self._checked = {}       # name -> monotonic time of the last stat()
+        self._media = {}         # Media/ path -> (mtime, size, fingerprint)
+        self._lock = threading.Lock()
+
+    # -- pages --
+    def page(self, name):
+        """The Page for `name` (loaded, or reloaded if its file changed), or None."""
+        if name not in self.pages:
+            return None
+        now = time.monotonic()
+        page = self._pages.get(name)
+        if page is not None and now - self._checked.get(name, 0) < self.check_interval:
+            return page
+        try:
+            st = os.stat(os.path.join(self.root, name))
+        except OSError:
+            return None
+        self._checked[name] = now
+        if page is not None and self._current(page, st):
+            return page
+        with self._lock:
+            page = self._pages.get(name)
+            if page is None or not self._current(page, st):
+                page = self._load(name, st)
+                self._pages[name] = page
+        return page
+
+    def _current(self, page, st):
+        """Whether the page's file and the Media/ files it links to are as they were when loaded."""
+        return ((page.mtime, page.size) == (st.st_mtime_ns, st.st_size)
+                and all(self._media_stat(name) == stamp for name, stamp in page.media))
+
+    def warm(self):
+        """Load (and compress) every page now rather than on its first request."""
+        for name in self.pages:
+            self.page(name)
+
+    def warm_up(self):
+        """warm() in a background thread."""
+        def run():
+            try:
+                self.warm()
+            except Exception:
+                log.exception("Page warm-up failed")
+
+        t = threading.Thread(target=run, name="warm-up-pages", daemon=True)
+        t.start()
+        return t
+
+    def choose(self, page, accept_encodings):
+        """(encoding or None, body): the smallest copy the client accepts."""
+        best = (None, page.bodies[None])
+        for encoding, body in page.bodies.items():
+            if encoding is not None and accept_encodings[encoding] > 0 and len(body) < len(best[1]):
+                best = (encoding, body)
+        return best
+
+    def _load(self, name, st):
+        started = time.perf_counter()
+        with open(os.path.join(self.root, name), "rb") as f:
+            text = f.read().decode("utf-8")
+        # Stat before fingerprinting, so a file changing in between costs a reload rather than a stale link
+        refs = sorted({match.group(2) for match in MEDIA_REF.finditer(text)})
+        media = tuple((ref, self._media_stat(ref)) for ref in refs)
+        html = self.fingerprint_refs(text).encode("utf-8")
+        digest = hashlib.sha256(html).hexdigest()[:16]
+        bodies = {None: html}
+        for encoding, compress in self.compressors.items():
+            bodies[encoding] = self._compressed(digest, encoding, html, compress)
+        log.info(f"Loaded {name}", extra={"bytes": len(html), "encodings": {
+            str(encoding or "identity"): len(body) for encoding, body in bodies.items()},
+            "durationMs": round((time.perf_counter() - started) * 1000, 1)})
+        return Page(st.st_mtime_ns, st.st_size, digest, bodies, media)
+
+    def _compressed(self, digest, encoding, data, compress):
+        path = os.path.join(self.cache_dir, f"{digest}.{encoding}") if self.cache_dir else None
+        if path:
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except OSError:
+                pass
+        body = compress(data)
+        if path:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                atomic_write(path, body)
+            except OSError as e:
+                log.warning(f"Could not cache {path}: {e}")
+        return body
+
+    # -- Media/ fingerprints --
+    def fingerprint_refs(self, html):
+        def replace(match):
+            prefix, name, _ = match.groups()
+            fingerprinted = self.fingerprinted_name(name)
+            return prefix + fingerprinted if fingerprinted else match.group(0)
+        return MEDIA_REF.sub(replace, html)
+
+    def fingerprinted_name(self, name):
+        """Media/name.ext -> name.<hash>.ext, or None if there's no such file."""
+        fingerprint = self._media_fingerprint(name)
+        if fingerprint is None:
+            return None
+        stem, ext = os.path.splitext(name)
+        return f"{stem}.{fingerprint}{ext}"
+
+    def resolve_media(self, filename):
+        """(real name, immutable): strips a fingerprint; immutable if it is the file's current one."""
+        match = FINGERPRINTED.match(filename)
+        if match is None:
+            return filename, False
+        name = match.group(1) + match.group(3)
+        return name, self._media_fingerprint(name) == match.group(2)
+
+    def _media_stat(self, name):
+        """(mtime, size) of a Media/ file, or None if there's no such file."""
+        try:
+            st = os.stat(os.path.join(self.media_dir, name))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _media_fingerprint(self, name):
+        path = os.path.join(self.media_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        cached = self._media.get(name)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        fingerprint = digest.hexdigest()[:FINGERPRINT_LENGTH]
+        self._media[name] = (st.st_mtime_ns, st.st_size, fingerprint)
+        return fingerprint
+
+    def stats(self):
+        return {name: {str(encoding or "identity"): len(body) for encoding, body in page.bodies.items()}
+                for name, page in self._pages.items()}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["build"]:
+        sys.exit("usage: python assets.py build")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    store = AssetStore(base_dir, os.path.join(base_dir, "Media"),
+                       cache_dir=os.environ.get("ASSET_CACHE_DIR", os.path.join(base_dir, ".asset_cache")))
+    store.warm()
+    for name, sizes in store.stats().items():
+        print(f"{name}: {sizes}")
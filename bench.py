@@ -0,0 +1,417 @@
+# bench.py
+"""Offline load test of the API with stand-ins for Vertex, Firebase and Stripe.
+
+Boots index.py in this process against fake_imagen / fake_firebase /
+fake_stripe (each with its own latency and error rate), serves it over HTTP
+on a random local port and drives /generate, /get-credits,
+/claim-daily-credits, /add-credits and /stripe-webhook from a pool of
+concurrent clients. Everything is written under a temp directory.
+
+Reports requests/s and p50/p95/p99 per endpoint, and checks correctness:
+every user's final balance must equal their starting balance plus what the
+successful responses said was added or charged (no lost or doubled updates).
+Results are saved as JSON; pass --baseline to compare with an earlier run.
+
+    python bench.py                                  # file mode (SQLite ledger)
+    python bench.py --mode firebase --firebase-latency 0.02
+    python bench.py --duration 60 --concurrency 64 --imagen-latency 1.5
+    python bench.py --baseline bench_results/bench-file-20250101-120000.json
+    python bench.py --server asgi --concurrency 256 --imagen-latency 2   # asgi.py under uvicorn
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+import applog
+import fake_firebase
+import fake_imagen
+import fake_stripe
+
+DEFAULT_MIX = "generate=4,get-credits=10,claim-daily=2,add-credits=3,stripe-webhook=1"
+PROMPTS = ["a lighthouse at dawn", "a red fox in snow", "neon city street at night",
+           "a bowl of ramen, studio light", "mountain lake reflection"]
+ADD_AMOUNT = 5
+DAILY_CREDITS = 15
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("file", "firebase"), default="file")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask",
+                        help="werkzeug's threaded server, or asgi.py under uvicorn")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--users", type=int, default=50, help="distinct userIds (fewer = more contention)")
+    parser.add_argument("--initial-credits", type=int, default=1000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="endpoint weights")
+    parser.add_argument("--unique-prompts", action="store_true",
+                        help="never repeat a prompt (no coalescing)")
+    parser.add_argument("--imagen-latency", type=float, default=0.3)
+    parser.add_argument("--imagen-jitter", type=float, default=0.1)
+    parser.add_argument("--imagen-error-rate", type=float, default=0.0)
+    parser.add_argument("--imagen-tail-rate", type=float, default=0.0,
+                        help="share of Imagen calls that take --imagen-tail-latency longer")
+    parser.add_argument("--imagen-tail-latency", type=float, default=2.0)
+    parser.add_argument("--firebase-latency", type=float, default=0.01)
+    parser.add_argument("--firebase-error-rate", type=float, default=0.0)
+    parser.add_argument("--stripe-latency", type=float, default=0.1)
+    parser.add_argument("--stripe-error-rate", type=float, default=0.0)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra app setting, e.g. --env MICRO_BATCH_WINDOW_MS=50")
+    parser.add_argument("--out", help="results file (default: bench_results/bench-<mode>-<time>.json)")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed throughput drop / p99 growth vs the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own output")
+    return parser.parse_args(argv)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise SystemExit(f"Unknown endpoint in --mix: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+# ---- App under test ----
+def boot_app(args, workdir):
+    """Import index.py against the fakes and serve it. Returns (index, server, base_url)."""
+    os.chdir(workdir)
+    if args.mode == "firebase":
+        # index.py switches to Firebase mode when the key file exists
+        with open("serviceAccountKey.json", "w") as f:
+            json.dump({"type": "service_account", "project_id": "bench"}, f)
+
+    os.environ.update({
+        "STATIC_DIR": os.path.join(workdir, "static"),
+        "CREDITS_DB": os.path.join(workdir, "credits.db"),
+        "VIDEO_JOBS_DB": os.path.join(workdir, "video_jobs.db"),
+        "STORAGE_DB": os.path.join(workdir, "storage.db"),
+        "STRIPE_EVENTS_DB": os.path.join(workdir, "stripe_events.db"),
+        "DERIVATIVE_WORKERS": "0",
+        # A few users hammer the app, which the per-user limits would mostly turn away
+        "RATE_LIMIT_GENERATE_USER": "0",
+        "RATE_LIMIT_CLAIM_USER": "0",
+    })
+    for item in args.env:
+        name, _, value = item.partition("=")
+        os.environ[name] = value
+
+    # Error rates are switched on only while the load runs (see inject_errors)
+    fake_imagen.install(args.imagen_latency, 0.0, args.imagen_jitter, args.imagen_tail_rate,
+                        args.imagen_tail_latency)
+    fake_firebase.install()
+    fake_firebase.reset(args.firebase_latency)
+    fake_stripe.install(args.stripe_latency)
+
+    import index
+    from werkzeug.serving import make_server
+    if not args.verbose:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    for client in index.dependencies.clients.values():
+        client.get()
+    if args.server == "asgi":
+        return index, *start_uvicorn()
+    server = make_server("127.0.0.1", 0, index.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    return index, server, f"http://127.0.0.1:{server.server_port}"
+
+
+class UvicornThread:
+    def __init__(self, server):
+        self.server = server
+        self.thread = threading.Thread(target=server.run, name="bench-server", daemon=True)
+
+    def shutdown(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def start_uvicorn():
+    """Serve asgi.py with uvicorn on a free port. Returns (server, base_url)."""
+    import socket
+    import uvicorn
+    import asgi
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = UvicornThread(uvicorn.Server(uvicorn.Config(asgi.app, host="127.0.0.1", port=port,
+                                                         log_level="error", backlog=4096)))
+    server.thread.start()
+    while not server.server.started:
+        time.sleep(0.01)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def inject_errors(args, on):
+    fake_imagen.model.error_rate = args.imagen_error_rate if on else 0.0
+    fake_firebase.database().error_rate = args.firebase_error_rate if on else 0.0
+    fake_stripe.config.error_rate = args.stripe_error_rate if on else 0.0
+
+
+# ---- Operations: each returns (status, credit change it reports) ----
+def op_generate(http, base, user_id, index, args):
+    prompt = random.choice(PROMPTS)
+    if args.unique_prompts:
+        prompt = f"{prompt} #{random.getrandbits(48)}"
+    r = http.post(f"{base}/generate", json={"prompt": prompt, "userId": user_id})
+    if r.status_code != 200:
+        return r.status_code, 0
+    # The tier (and so the charge) depends on the plan the user bought and the load
+    return r.status_code, -index.model_router.by_name[r.json()["tier"]].credits
+
+
+def op_get_credits(http, base, user_id, index, args):
+    r = http.get(f"{base}/get-credits/{user_id}")
+    return r.status_code, 0
+
+
+def op_claim_daily(http, base, user_id, index, args):
+    r = http.post(f"{base}/claim-daily-credits", json={"userId": user_id})
+    return r.status_code, (DAILY_CREDITS if r.status_code == 200 else 0)
+
+
+def op_add_credits(http, base, user_id, index, args):
+    r = http.post(f"{base}/add-credits", json={"userId": user_id, "amount": ADD_AMOUNT})
+    return r.status_code, (ADD_AMOUNT if r.status_code == 200 else 0)
+
+
+def op_stripe_webhook(http, base, user_id, index, args):
+    price = random.choice(list(index.STRIPE_PLANS))
+    payload = json.dumps(fake_stripe.completed_checkout_event(user_id, price)).encode("utf-8")
+    r = http.post(f"{base}/stripe-webhook", data=payload, headers={
+        "Content-Type": "application/json",
+        "Stripe-Signature": fake_stripe.sign(payload, index.STRIPE_WEBHOOK_SECRET),
+    })
+    return r.status_code, (index.STRIPE_PLANS[price]["credits"] if r.status_code == 200 else 0)
+
+
+OPERATIONS = {
+    "generate": op_generate,
+    "get-credits": op_get_credits,
+    "claim-daily": op_claim_daily,
+    "add-credits": op_add_credits,
+    "stripe-webhook": op_stripe_webhook,
+}
+
+
+# ---- Load generator ----
+def run_load(index, base_url, args, users):
+    import requests
+
+    mix = parse_mix(args.mix)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    samples = []             # (operation, status, seconds)
+    expected_change = {u: 0 for u in users}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def client():
+        http = requests.Session()
+        local_samples = []
+        local_change = {}
+        while time.perf_counter() < deadline:
+            name = random.choices(names, weights)[0]
+            user_id = random.choice(users)
+            started = time.perf_counter()
+            try:
+                status, change = OPERATIONS[name](http, base_url, user_id, index, args)
+            except Exception:
+                status, change = "error", 0
+            local_samples.append((name, status, time.perf_counter() - started))
+            if change:
+                local_change[user_id] = local_change.get(user_id, 0) + change
+        with lock:
+            samples.extend(local_samples)
+            for user_id, change in local_change.items():
+                expected_change[user_id] += change
+
+    peak_threads = [0]
+
+    def watch_threads():
+        # Threads besides the clients themselves: the server's, the app's and the fakes'
+        while time.perf_counter() < deadline:
+            peak_threads[0] = max(peak_threads[0], threading.active_count() - args.concurrency - 2)
+            time.sleep(0.05)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, name=f"bench-client-{i}") for i in range(args.concurrency)]
+    threads.append(threading.Thread(target=watch_threads, name="bench-threads"))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, expected_change, time.perf_counter() - started, peak_threads[0]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize(samples, elapsed):
+    by_op = {}
+    for name, status, seconds in samples:
+        by_op.setdefault(name, []).append((status, seconds))
+    endpoints = {}
+    for name, rows in sorted(by_op.items()):
+        latencies = sorted(s for _, s in rows)
+        statuses = {}
+        for status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        endpoints[name] = {
+            "requests": len(rows),
+            "throughput": round(len(rows) / elapsed, 2),
+            "p50Ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95Ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99Ms": round(percentile(latencies, 99) * 1000, 2),
+            "maxMs": round(latencies[-1] * 1000, 2),
+            "statuses": statuses,
+        }
+    return endpoints
+
+
+def check_balances(index, users, initial, expected_change):
+    mismatches = []
+    for user_id in users:
+        expected = initial[user_id] + expected_change[user_id]
+        actual = index.credit_store.balance(user_id)
+        if actual != expected:
+            mismatches.append({"userId": user_id, "expected": expected, "actual": actual,
+                               "difference": actual - expected})
+    return {
+        "ok": not mismatches,
+        "usersChecked": len(users),
+        "mismatchedUsers": len(mismatches),
+        "lostCredits": -sum(m["difference"] for m in mismatches if m["difference"] < 0),
+        "extraCredits": sum(m["difference"] for m in mismatches if m["difference"] > 0),
+        "examples": mismatches[:10],
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print per-endpoint changes vs the baseline. Returns a list of regressions."""
+    regressions = []
+    print(f"\nCompared with {baseline.get('startedAt')} ({baseline.get('mode')} mode):")
+    for name, now in results["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before:
+            continue
+        tput = (now["throughput"] - before["throughput"]) / max(before["throughput"], 1e-9)
+        p99 = (now["p99Ms"] - before["p99Ms"]) / max(before["p99Ms"], 1e-9)
+        print(f"  {name:<15} throughput {tput:+7.1%}   p99 {p99:+7.1%}")
+        if tput < -tolerance:
+            regressions.append(f"{name} throughput {tput:+.1%}")
+        if p99 > tolerance:
+            regressions.append(f"{name} p99 {p99:+.1%}")
+    return regressions
+
+
+def print_report(results, out):
+    print(f"\n{results['mode']} mode on {results['server']}, {results['config']['concurrency']} clients, "
+          f"{results['elapsedSeconds']:.1f}s: {results['totalRequests']} requests, "
+          f"{results['throughput']:.1f} req/s, peak {results['peakThreads']} threads")
+    print(f"  {'endpoint':<15} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  statuses")
+    for name, e in results["endpoints"].items():
+        print(f"  {name:<15} {e['throughput']:>8.1f} {e['p50Ms']:>9.1f} {e['p95Ms']:>9.1f} "
+              f"{e['p99Ms']:>9.1f}  {e['statuses']}")
+    c = results["correctness"]
+    if c["ok"]:
+        print(f"  balances: all {c['usersChecked']} users correct")
+    else:
+        print(f"  balances: {c['mismatchedUsers']} users wrong "
+              f"({c['lostCredits']} credits lost, {c['extraCredits']} extra)")
+    print(f"  fakes: {results['fakes']}")
+    print(f"Saved {out}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    parse_mix(args.mix)
+    started_at = datetime.now().strftime("%Y%m%d-%H%M%S")
+    out = os.path.abspath(args.out or os.path.join(BASE_DIR, "bench_results",
+                                                   f"bench-{args.mode}-{args.server}-{started_at}.json"))
+    workdir = tempfile.mkdtemp(prefix="bench-")
+
+    real_stdout, real_stderr = sys.stdout, sys.stderr
+    if not args.verbose:
+        # The app logs every request; keep that out of the report
+        sys.stdout = sys.stderr = open(os.path.join(workdir, "app.log"), "w")
+    try:
+        index, server, base_url = boot_app(args, workdir)
+        users = [f"bench-user-{i}" for i in range(args.users)]
+        for user_id in users:
+            index.credit_store.grant(user_id, args.initial_credits)
+        initial = {user_id: index.credit_store.balance(user_id) for user_id in users}
+
+        inject_errors(args, True)
+        samples, expected_change, elapsed, peak_threads = run_load(index, base_url, args, users)
+        inject_errors(args, False)
+        server.shutdown()
+        index.video_jobs.stop(timeout=5)
+        # Webhooks are acknowledged before their credits land
+        index.stripe_events.wait_idle(timeout=30)
+        index.stripe_events.stop(timeout=5)
+        correctness = check_balances(index, users, initial, expected_change)
+    finally:
+        applog.stop()   # flush the app's log lines before its log file is closed
+        if sys.stdout is not real_stdout:
+            sys.stdout.close()
+            sys.stdout, sys.stderr = real_stdout, real_stderr
+
+    results = {
+        "startedAt": started_at,
+        "mode": args.mode,
+        "server": args.server,
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "verbose")},
+        "elapsedSeconds": round(elapsed, 3),
+        "totalRequests": len(samples),
+        "throughput": round(len(samples) / elapsed, 2),
+        "peakThreads": peak_threads,
+        "endpoints": summarize(samples, elapsed),
+        "correctness": correctness,
+        "fakes": {
+            "imagenCalls": fake_imagen.model.calls,
+            "firebaseRoundTrips": fake_firebase.database().round_trips,
+            "stripeCalls": fake_stripe.calls,
+        },
+        "app": {"singleFlight": index.single_flight.stats(),
+                "microBatch": index.micro_batcher.stats() if index.micro_batcher else None},
+        "appLog": os.path.join(workdir, "app.log"),
+    }
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print_report(results, out)
+
+    failed = not correctness["ok"]
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("REGRESSIONS: " + "; ".join(regressions))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
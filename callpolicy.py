@@ -0,0 +1,126 @@
+# callpolicy.py
+"""Retries with backoff and hedged requests for upstream calls (Imagen).
+
+    policy = CallPolicy(vertex_guard, attempts=3, budget=90, hedge_quantile=0.95)
+    res = policy.call(model.generate_images, prompt=prompt)
+
+Transient errors (dropped connections, 429 / 5xx from the Google APIs) are
+retried, up to `attempts` calls in all. Before retry n the caller sleeps a
+random time between 0 and base_delay * 2**n, capped at max_delay ("full
+jitter"), so requests that failed together don't all come back together.
+Refusals from the guard (busy, circuit open) are not retried.
+
+With `hedge_quantile` set, an attempt still running after that quantile of
+recent successful call times (and at least hedge_min_seconds) gets a twin
+sent alongside it, if a slot is free. Whichever succeeds first is used and the
+other's result is dropped. That costs a few percent more calls, each billed,
+for a much shorter tail, so it is off unless configured.
+
+No attempt starts, and the caller never waits, more than `budget` seconds
+after the first attempt.
+"""
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import metrics
+from admission import UpstreamRejected, DeadlineExceeded
+
+UPSTREAM_ATTEMPTS = metrics.counter("upstream_attempts_total", "Upstream call attempts",
+                                    ("dependency", "kind"))
+HEDGE_WINS = metrics.counter("upstream_hedge_wins_total", "Hedged calls that beat the original",
+                             ("dependency",))
+
+# google.api_core.exceptions worth another try, matched by name so the SDK
+# doesn't have to be imported here
+RETRYABLE_ERRORS = {"TooManyRequests", "ResourceExhausted", "InternalServerError", "BadGateway",
+                    "ServiceUnavailable", "GatewayTimeout", "DeadlineExceeded", "Aborted"}
+
+log = logging.getLogger(__name__)
+
+
+def is_retryable(error):
+    if isinstance(error, UpstreamRejected):
+        return False
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in RETRYABLE_ERRORS
+
+
+class CallPolicy:
+    def __init__(self, guard, attempts=3, base_delay=0.5, max_delay=8.0, budget=90.0,
+                 hedge_quantile=None, hedge_min_seconds=1.0, min_samples=20, retryable=is_retryable):
+        self.guard = guard
+        self.attempts = max(attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_seconds = hedge_min_seconds
+        self.min_samples = min_samples
+        self.retryable = retryable
+        self._latencies = deque(maxlen=200)   # seconds, recent successful calls
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args, **kwargs):
+        deadline = time.monotonic() + self.budget
+        for attempt in range(self.attempts):
+            try:
+                return self._attempt("first" if attempt == 0 else "retry", deadline, fn, args, kwargs)
+            except Exception as e:
+                if attempt == self.attempts - 1 or not self.retryable(e):
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if time.monotonic() + delay >= deadline:
+                    raise
+                log.warning(f"{self.guard.name} call failed ({e}), retrying in {delay:.2f}s",
+                            extra={"attempt": attempt + 1})
+                time.sleep(delay)
+
+    def hedge_delay(self):
+        """Seconds after which an attempt gets a twin, or None (off, or too few samples yet)."""
+        if not self.hedge_quantile:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            samples = sorted(self._latencies)
+        return max(samples[int(self.hedge_quantile * (len(samples) - 1))], self.hedge_min_seconds)
+
+    def _attempt(self, kind, deadline, fn, args, kwargs):
+        guard = self.guard
+        UPSTREAM_ATTEMPTS.inc(dependency=guard.name, kind=kind)
+        started = {guard.submit(fn, *args, **kwargs): time.monotonic()}
+        first = next(iter(started))
+        # Like guard.call(): the per-call deadline, but never past the budget
+        give_up = min(started[first] + guard.deadline, deadline)
+
+        hedge_after = self.hedge_delay()
+        if hedge_after is not None:
+            done, _ = wait([first], timeout=min(hedge_after, give_up - time.monotonic()))
+            if not done and time.monotonic() < give_up:
+                twin = guard.try_submit(fn, *args, **kwargs)
+                if twin is not None:
+                    UPSTREAM_ATTEMPTS.inc(dependency=guard.name, kind="hedge")
+                    started[twin] = time.monotonic()
+
+        pending, error = set(started), None
+        while pending:
+            done, pending = wait(pending, timeout=max(give_up - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                raise guard.reject(DeadlineExceeded(f"{guard.name} did not answer in time"))
+            for future in done:
+                if future.exception() is None:
+                    with self._lock:
+                        self._latencies.append(time.monotonic() - started[future])
+                    if future is not first:
+                        HEDGE_WINS.inc(dependency=guard.name)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def stats(self):
+        delay = self.hedge_delay()
+        return {"attempts": self.attempts, "budgetSeconds": self.budget,
+                "hedgeAfterSeconds": round(delay, 3) if delay is not None else None}
@@ -0,0 +1,118 @@
+# clients.py
+"""Lazily created SDK clients (Vertex AI, Firebase, Stripe).
+
+Importing and initializing the Google / Stripe SDKs takes seconds, so index.py
+doesn't do it at import time. Each client is a LazyClient: it is built the
+first time it's used, or ahead of time by `warm_up()` in a background thread.
+Callers that need it before it's ready just wait for the one initialization
+in progress. `proxy()` gives an object that forwards attribute access to the
+real client, so existing code like `model.generate_images(...)` keeps working.
+"""
+import time
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class DependencyUnavailable(Exception):
+    pass
+
+
+class LazyClient:
+    def __init__(self, name, factory, required=True, retry_after=30.0):
+        self.name = name
+        self.factory = factory
+        self.required = required       # counts towards /readyz
+        self.retry_after = retry_after  # seconds before retrying a failed init
+        self._client = None
+        self._error = None
+        self._failed_at = None
+        self._init_seconds = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._client is not None
+
+    def get(self):
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is not None:
+                return self._client
+            if self._failed_at is not None and time.time() - self._failed_at < self.retry_after:
+                raise DependencyUnavailable(f"{self.name} is unavailable: {self._error}")
+            started = time.perf_counter()
+            try:
+                self._client = self.factory()
+            except Exception as e:
+                self._error = str(e)
+                self._failed_at = time.time()
+                log.warning(f"{self.name} initialization failed: {e}")
+                raise DependencyUnavailable(f"{self.name} is unavailable: {e}") from e
+            self._init_seconds = time.perf_counter() - started
+            self._error = None
+            self._failed_at = None
+            log.info(f"{self.name} initialized in {self._init_seconds:.2f}s")
+            return self._client
+
+    def warm_up(self):
+        """Initialize in a background thread."""
+        def run():
+            try:
+                self.get()
+            except DependencyUnavailable:
+                pass
+            except Exception:
+                log.exception(f"{self.name} warm-up failed")
+
+        t = threading.Thread(target=run, name=f"warm-up-{self.name}", daemon=True)
+        t.start()
+        return t
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "required": self.required,
+            "initSeconds": round(self._init_seconds, 3) if self._init_seconds is not None else None,
+            "error": self._error,
+        }
+
+    def proxy(self):
+        return _ClientProxy(self)
+
+
+class _ClientProxy:
+    def __init__(self, lazy):
+        object.__setattr__(self, "_lazy", lazy)
+
+    def __getattr__(self, name):
+        return getattr(self._lazy.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy.get(), name, value)
+
+    def __repr__(self):
+        return f"<lazy {self._lazy.name}>"
+
+
+class Dependencies:
+    """The set of LazyClients the app reports on in /health and /readyz."""
+
+    def __init__(self):
+        self.clients = {}
+
+    def add(self, client):
+        self.clients[client.name] = client
+        return client
+
+    def warm_up(self):
+        return [client.warm_up() for client in self.clients.values()]
+
+    def ready(self):
+        return all(c.ready for c in self.clients.values() if c.required)
+
+    def status(self):
+        return {name: client.status() for name, client in self.clients.items()}
@@ -0,0 +1,193 @@
+# delivery.py
+"""Writing and serving generated files.
+
+Generated files are written with `atomic_write` (temp file + rename), so a
+request can never see a half-written image, and served by `send_static`:
+
+- every response carries a strong ETag and answers If-None-Match with 304
+- `generated_*` files never change once written, so they are sent with
+  `Cache-Control: public, max-age=31536000, immutable`
+- byte ranges (Range / If-Range) get a 206, so seeking in a video only
+  fetches the part needed; a range that runs to the end of the file (what
+  players ask for) goes through the server's wsgi.file_wrapper, which
+  gunicorn and uWSGI send with sendfile()
+- size, mtime and ETag are kept in memory, so a request costs no hashing and,
+  for generated files, no stat()
+- with mode "x-sendfile" (Apache / lighttpd) or "x-accel" (nginx), Flask only
+  sends headers and the front proxy streams the bytes from disk
+"""
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import mimetypes
+from collections import OrderedDict, namedtuple
+
+from flask import Response, abort, request, send_file
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
+
+IMMUTABLE_MAX_AGE = 31536000   # one year
+DEFAULT_MAX_AGE = 3600
+IMMUTABLE_PREFIXES = ("generated_",)
+FILE_INFO_CACHE_SIZE = 4096
+FILE_INFO_SECONDS = 2.0        # how long a mutable file's stat() is trusted
+READ_CHUNK = 256 * 1024
+
+DELIVERY_MODES = ("python", "x-sendfile", "x-accel")
+
+
+def atomic_write(path, data):
+    """Write bytes to `path` so readers see either nothing or the whole file."""
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def is_immutable(filename):
+    return os.path.basename(filename).startswith(IMMUTABLE_PREFIXES)
+
+
+def file_etag(filename, st):
+    """Strong validator from name, size and mtime; files are only ever replaced whole."""
+    raw = f"{filename}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+FileInfo = namedtuple("FileInfo", "size mtime etag mimetype checked")
+
+_file_info = OrderedDict()   # path -> FileInfo
+_file_info_lock = threading.Lock()
+
+
+def file_info(path, filename):
+    """Size, mtime, ETag and type of a file, or None if it doesn't exist.
+
+    Generated files never change, so theirs are kept until evicted; other
+    files are checked again after FILE_INFO_SECONDS.
+    """
+    now = time.monotonic()
+    with _file_info_lock:
+        info = _file_info.get(path)
+        if info is not None and (is_immutable(filename) or now - info.checked < FILE_INFO_SECONDS):
+            _file_info.move_to_end(path)
+            return info
+    try:
+        st = os.stat(path)
+    except OSError:
+        forget_file(path)
+        return None
+    if not os.path.isfile(path):
+        return None
+    info = FileInfo(st.st_size, st.st_mtime, file_etag(filename, st),
+                    mimetypes.guess_type(filename)[0] or "application/octet-stream", now)
+    with _file_info_lock:
+        _file_info[path] = info
+        while len(_file_info) > FILE_INFO_CACHE_SIZE:
+            _file_info.popitem(last=False)
+    return info
+
+
+def forget_file(path):
+    with _file_info_lock:
+        _file_info.pop(path, None)
+
+
+def send_static(directory, filename, mode="python", accel_prefix="/_static/"):
+    """Serve `directory/filename` with validators and caching headers."""
+    path = safe_join(directory, filename)
+    if path is None or os.path.basename(path).startswith(".tmp-"):
+        abort(404)
+    info = file_info(path, filename)
+    if info is None:
+        abort(404)
+
+    if mode == "x-accel":
+        # nginx serves the body (and ranges) from an `internal` location
+        response = Response(mimetype=info.mimetype)
+        response.headers["X-Accel-Redirect"] = accel_prefix + filename.replace(os.sep, "/")
+        response.set_etag(info.etag)
+        response.last_modified = info.mtime
+        response = response.make_conditional(request)
+    elif mode == "x-sendfile":
+        # send_file emits X-Sendfile instead of the body
+        response = send_file(path, etag=info.etag, conditional=True, last_modified=info.mtime)
+    else:
+        response = _send_file(path, info)
+
+    if is_immutable(filename):
+        response.headers["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        response.headers["Cache-Control"] = f"public, max-age={DEFAULT_MAX_AGE}"
+    return response
+
+
+def _send_file(path, info):
+    """The file (or the requested byte range of it) with ETag / Last-Modified handling."""
+    response = Response(mimetype=info.mimetype, direct_passthrough=True)
+    response.set_etag(info.etag)
+    response.last_modified = info.mtime
+    response.accept_ranges = "bytes"
+    response.make_conditional(request)   # 304 / 412 from If-None-Match and friends
+    if response.status_code != 200:
+        return response
+
+    start, length = 0, info.size
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) == 1 and _if_range_matches(info):
+        span = byte_range.range_for_length(info.size)
+        if span is None:
+            response.status_code = 416
+            response.headers["Content-Range"] = f"bytes */{info.size}"
+            return response
+        start, length = span[0], span[1] - span[0]
+        response.status_code = 206
+        response.headers["Content-Range"] = byte_range.to_content_range_header(info.size)
+    # Several ranges at once (rare; no player asks for them) get the whole file
+
+    response.content_length = length
+    if request.method == "HEAD":
+        return response
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        forget_file(path)   # deleted (e.g. by the storage sweeper) since it was cached
+        abort(404)
+    f.seek(start)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and start + length == info.size:
+        # To the end of the file: the server can sendfile() it
+        response.response = file_wrapper(f, READ_CHUNK)
+    else:
+        response.response = _read_range(f, length)
+    return response
+
+
+def _if_range_matches(info):
+    """A Range only applies if If-Range (when sent) still names this version of the file."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == info.etag
+    if if_range.date is not None:
+        return http_date(if_range.date) == http_date(info.mtime)
+    return True
+
+
+def _read_range(f, length):
+    with f:
+        while length > 0:
+            chunk = f.read(min(READ_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
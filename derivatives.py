@@ -0,0 +1,245 @@
+# derivatives.py
+"""Smaller copies of images (WebP, and AVIF where Pillow supports it).
+
+For an image dir/name.png the pipeline writes, next to it,
+
+    dir/_variants/name.png.full.webp     same size, recompressed
+    dir/_variants/name.png.640w.webp     resized to 640px wide (never upscaled)
+    ...and the same in .avif
+
+in a process pool, so the request that produced the image isn't kept waiting.
+`pick_variant()` chooses what to send for a request: the best format the
+client's Accept header allows and, with a ?w= hint, the smallest width that
+still covers it. Anything missing falls back to the original file.
+
+Create variants for files that already exist, and compare bytes served:
+
+    python derivatives.py backfill [dir ...]    # default: static/ and Media/
+    python derivatives.py bench [dir ...]
+"""
+import os
+import sys
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+VARIANT_DIR = "_variants"
+WIDTHS = (320, 640, 1280)
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# Preferred first; AVIF is dropped if this Pillow can't encode it
+FORMATS = ("avif", "webp")
+MIMETYPES = {"avif": "image/avif", "webp": "image/webp"}
+QUALITY = {"avif": 60, "webp": 80}
+
+log = logging.getLogger(__name__)
+
+
+def supported_formats():
+    from PIL import features
+    return tuple(fmt for fmt in FORMATS if features.check(fmt))
+
+
+def is_source(path):
+    return (path.lower().endswith(SOURCE_EXTENSIONS)
+            and os.path.basename(os.path.dirname(path)) != VARIANT_DIR)
+
+
+def variant_path(path, fmt, width=None):
+    directory, name = os.path.split(path)
+    label = f"{width}w" if width else "full"
+    return os.path.join(directory, VARIANT_DIR, f"{name}.{label}.{fmt}")
+
+
+def remove_variants(path):
+    """Delete every variant of `path` (used when the original is deleted)."""
+    directory, name = os.path.split(path)
+    variant_dir = os.path.join(directory, VARIANT_DIR)
+    try:
+        names = os.listdir(variant_dir)
+    except FileNotFoundError:
+        return
+    for variant in names:
+        if variant.startswith(name + "."):
+            try:
+                os.remove(os.path.join(variant_dir, variant))
+            except FileNotFoundError:
+                pass
+
+
+def make_variants(path, formats, widths=WIDTHS):
+    """Write the variants of one image. Runs in a pool process. Returns bytes written."""
+    from PIL import Image
+    from delivery import atomic_write
+    import io
+
+    source_size = os.path.getsize(path)
+    os.makedirs(os.path.join(os.path.dirname(path), VARIANT_DIR), exist_ok=True)
+    written = 0
+    with Image.open(path) as img:
+        img.load()
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        sizes = [None] + [w for w in widths if w < img.width]
+        for width in sizes:
+            if width:
+                height = max(1, round(img.height * width / img.width))
+                frame = img.resize((width, height), Image.LANCZOS)
+            else:
+                frame = img
+            for fmt in formats:
+                buf = io.BytesIO()
+                frame.save(buf, format=fmt.upper(), quality=QUALITY[fmt])
+                data = buf.getvalue()
+                if not width and len(data) >= source_size:
+                    continue  # no point serving a "smaller" copy that isn't
+                atomic_write(variant_path(path, fmt, width), data)
+                written += len(data)
+    return written
+
+
+def accepted_formats(accept_header, formats):
+    accept = (accept_header or "").lower()
+    return [fmt for fmt in formats if MIMETYPES[fmt] in accept]
+
+
+def pick_variant(path, accept_header, width_hint, formats):
+    """Path of the variant to send for `path`, or `path` itself."""
+    if not is_source(path):
+        return path
+    for fmt in accepted_formats(accept_header, formats):
+        if width_hint:
+            for width in WIDTHS:
+                if width >= width_hint:
+                    candidate = variant_path(path, fmt, width)
+                    if os.path.isfile(candidate):
+                        return candidate
+        candidate = variant_path(path, fmt)
+        if os.path.isfile(candidate):
+            return candidate
+    return path
+
+
+def _pool_context():
+    # Forking the (threaded) server isn't safe. Workers come from a fork server
+    # instead, which imports the main module (as __mp_main__) and Pillow once.
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(["__main__", "derivatives", "PIL.Image"])
+    return ctx
+
+
+class DerivativePipeline:
+    """Background variant generation in a process pool (created on first use)."""
+
+    def __init__(self, workers=2, formats=None):
+        self.workers = workers
+        self._formats = formats
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self._pool = None
+
+    @property
+    def formats(self):
+        # Checked on first use so importing the app doesn't load Pillow
+        if self._formats is None:
+            self._formats = supported_formats()
+        return self._formats
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=_pool_context())
+        return self._pool
+
+    def submit(self, path):
+        self.submitted += 1
+        future = self._executor().submit(make_variants, path, self.formats)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        error = future.exception()
+        if error is not None:
+            self.failed += 1
+            log.warning(f"Derivative generation failed: {error}")
+        else:
+            self.completed += 1
+            self.bytes_written += future.result()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "formats": list(self.formats),
+            "widths": list(WIDTHS),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "bytesWritten": self.bytes_written,
+        }
+
+
+def _sources(directories):
+    for directory in directories:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            # Skip our own output, the result cache (hardlinks of generated files) and
+            # pre-generated images nobody has claimed yet
+            dirnames[:] = [d for d in dirnames if d not in (VARIANT_DIR, "cache", "prewarm")]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if is_source(path):
+                    yield path
+
+
+def backfill(directories, workers=None):
+    formats = supported_formats()
+    paths = list(_sources(directories))
+    print(f"Creating {'/'.join(formats)} variants for {len(paths)} images")
+    started = time.time()
+    written = 0
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        futures = {pool.submit(make_variants, path, formats): path for path in paths}
+        for i, future in enumerate(as_completed(futures), 1):
+            try:
+                written += future.result()
+            except Exception as e:
+                print(f"  {futures[future]}: {e}")
+            if i % 50 == 0:
+                print(f"  {i}/{len(paths)}")
+    print(f"Done in {time.time() - started:.1f}s, {written / 1024 / 1024:.1f} MB written")
+
+
+def bench(directories):
+    """Bytes a browser would download for every image, before and after."""
+    formats = supported_formats()
+    cases = [
+        ("png only", "image/png,*/*", None),
+        ("webp", "image/webp,*/*", None),
+        ("avif+webp", "image/avif,image/webp,*/*", None),
+        ("avif+webp w=640", "image/avif,image/webp,*/*", 640),
+        ("avif+webp w=320", "image/avif,image/webp,*/*", 320),
+    ]
+    paths = list(_sources(directories))
+    original = sum(os.path.getsize(p) for p in paths)
+    print(f"{len(paths)} images, {original / 1024 / 1024:.2f} MB as stored")
+    for label, accept, width in cases:
+        served = sum(os.path.getsize(pick_variant(p, accept, width, formats)) for p in paths)
+        print(f"  {label:<18} {served / 1024 / 1024:8.2f} MB  ({100 * served / max(original, 1):5.1f}%)")
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    if len(sys.argv) < 2 or sys.argv[1] not in ("backfill", "bench"):
+        print("Usage: python derivatives.py backfill|bench [dir ...]")
+        sys.exit(1)
+
+    dirs = sys.argv[2:] or [os.path.join(base_dir, "static"), os.path.join(base_dir, "Media")]
+    if sys.argv[1] == "backfill":
+        backfill(dirs)
+    else:
+        bench(dirs)
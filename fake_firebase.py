@@ -0,0 +1,208 @@
+# fake_firebase.py
+"""In-memory stand-in for `firebase_admin.db` (Realtime Database).
+
+Implements the parts of the Reference API the app uses: get (with etag),
+set, update (with the increment server value), delete, set_if_unchanged and
+transaction. Every call counts as
+one round trip and can be slowed down with `latency` to make races likely;
+with `error_rate` that fraction of calls fails before touching any data.
+`lost_replies = n` makes the next n writes apply and then raise TimeoutError,
+like a reply lost after the server committed.
+
+    import fake_firebase
+    fake_firebase.reset(latency=0.005)
+    index.db = fake_firebase          # swap for firebase_admin.db
+
+    fake_firebase.install()           # or: make `import firebase_admin` use it
+"""
+import sys
+import copy
+import json
+import time
+import types
+import random
+import hashlib
+import threading
+
+_TRANSACTION_MAX_RETRIES = 25
+
+
+class TransactionAbortedError(Exception):
+    pass
+
+
+class UnavailableError(Exception):
+    """Injected failure (error_rate)."""
+
+
+class FakeDatabase:
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.round_trips = 0
+        self.lost_replies = 0
+        self._data = {}
+        self._lock = threading.Lock()
+
+    # -- path helpers --
+    @staticmethod
+    def _split(path):
+        return [p for p in path.strip("/").split("/") if p]
+
+    def _read(self, parts):
+        node = self._data
+        for p in parts:
+            if not isinstance(node, dict) or p not in node:
+                return None
+            node = node[p]
+        return copy.deepcopy(node)
+
+    def _write(self, parts, value):
+        if not parts:
+            self._data = copy.deepcopy(value) if value is not None else {}
+            return
+        node = self._data
+        for p in parts[:-1]:
+            if not isinstance(node.get(p), dict):
+                node[p] = {}
+            node = node[p]
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = copy.deepcopy(value)
+
+    def _server_value(self, parts, value):
+        """Resolve {".sv": {"increment": n}} against the current value, like the server does."""
+        if isinstance(value, dict) and isinstance(value.get(".sv"), dict) and "increment" in value[".sv"]:
+            current = self._read(parts)
+            if not isinstance(current, (int, float)) or isinstance(current, bool):
+                current = 0
+            return current + value[".sv"]["increment"]
+        return value
+
+    @staticmethod
+    def _etag(value):
+        raw = json.dumps(value, sort_keys=True).encode()
+        return hashlib.md5(raw).hexdigest()
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.round_trips += 1
+        if self.error_rate and random.random() < self.error_rate:
+            raise UnavailableError("fake_firebase: injected failure")
+
+    def _reply(self):
+        """After a write: lose the reply if asked to (the write stays applied)."""
+        with self._lock:
+            lost = self.lost_replies > 0
+            self.lost_replies -= lost
+        if lost:
+            raise TimeoutError("fake_firebase: reply lost after the write")
+
+    def reference(self, path="/"):
+        return Reference(self, path)
+
+
+class Reference:
+    def __init__(self, database, path):
+        self._db = database
+        self.path = "/" + "/".join(FakeDatabase._split(path))
+        self._parts = FakeDatabase._split(path)
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    def child(self, path):
+        return Reference(self._db, self.path + "/" + path)
+
+    def get(self, etag=False, shallow=False):
+        self._db._round_trip()
+        with self._db._lock:
+            value = self._db._read(self._parts)
+        if shallow and isinstance(value, dict):
+            value = {k: True for k in value}
+        if etag:
+            return value, FakeDatabase._etag(value)
+        return value
+
+    def set(self, value):
+        if value is None:
+            raise ValueError("Value must not be None.")
+        self._db._round_trip()
+        with self._db._lock:
+            self._db._write(self._parts, value)
+
+    def update(self, value):
+        if not value or not isinstance(value, dict):
+            raise ValueError("Value argument must be a non-empty dictionary.")
+        self._db._round_trip()
+        with self._db._lock:
+            # Keys may be multi-segment paths ("a/b/c"), like the real API
+            for key, child_value in value.items():
+                parts = self._parts + FakeDatabase._split(key)
+                self._db._write(parts, self._db._server_value(parts, child_value))
+        self._db._reply()
+
+    def delete(self):
+        self._db._round_trip()
+        with self._db._lock:
+            self._db._write(self._parts, None)
+
+    def set_if_unchanged(self, expected_etag, value):
+        if not isinstance(expected_etag, str):
+            raise ValueError("Expected ETag must be a string.")
+        if value is None:
+            raise ValueError("Value must not be none.")
+        self._db._round_trip()
+        with self._db._lock:
+            current = self._db._read(self._parts)
+            current_etag = FakeDatabase._etag(current)
+            if current_etag != expected_etag:
+                return False, current, current_etag
+            self._db._write(self._parts, value)
+        self._db._reply()
+        return True, value, FakeDatabase._etag(value)
+
+    def transaction(self, transaction_update):
+        data, etag = self.get(etag=True)
+        for _ in range(_TRANSACTION_MAX_RETRIES):
+            new_data = transaction_update(data)
+            success, data, etag = self.set_if_unchanged(etag, new_data)
+            if success:
+                return new_data
+        raise TransactionAbortedError("Transaction aborted after failed retries.")
+
+
+# Module-level API mirroring firebase_admin.db
+_default = FakeDatabase()
+
+
+def reset(latency=0.0, error_rate=0.0):
+    """Start over with an empty database. Returns the new FakeDatabase."""
+    global _default
+    _default = FakeDatabase(latency=latency, error_rate=error_rate)
+    return _default
+
+
+def database():
+    return _default
+
+
+def reference(path="/"):
+    return _default.reference(path)
+
+
+def install():
+    """Register a fake `firebase_admin` package whose `db` is this module."""
+    package = types.ModuleType("firebase_admin")
+    credentials = types.ModuleType("firebase_admin.credentials")
+    credentials.Certificate = lambda path: {"path": path}
+    package.credentials = credentials
+    package.db = sys.modules[__name__]
+    package.initialize_app = lambda cred=None, options=None, name="[DEFAULT]": object()
+    sys.modules["firebase_admin"] = package
+    sys.modules["firebase_admin.credentials"] = credentials
+    sys.modules["firebase_admin.db"] = package.db
@@ -0,0 +1,104 @@
+# fake_imagen.py
+"""Stand-in for Vertex AI's `ImageGenerationModel` (Imagen).
+
+`generate_images()` sleeps for `latency` seconds (plus up to `jitter`, and
+`tail_latency` more for a `tail_rate` share of calls), fails `error_rate` of
+the time, and returns `number_of_images` small PNGs in
+the same shape as the SDK (`result.images[i]._image_bytes`). The fast and
+ultra models (by name) take MODEL_SPEED times as long.
+
+    import fake_imagen
+    fake_imagen.install(latency=0.8, error_rate=0.01)
+    import index          # _init_imagen() now gets a FakeImageGenerationModel
+"""
+import io
+import sys
+import time
+import types
+import random
+import threading
+
+
+class ImagenUnavailable(ConnectionError):
+    """Injected failure (error_rate). Transient, like a dropped connection."""
+
+
+def _png(color):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class _GeneratedImage:
+    def __init__(self, data):
+        self._image_bytes = data
+
+
+class _Result:
+    def __init__(self, images):
+        self.images = images
+
+
+class FakeImageGenerationModel:
+    def __init__(self, latency=0.0, error_rate=0.0, jitter=0.0, tail_rate=0.0, tail_latency=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.calls = 0
+        self.images_returned = 0
+        self._lock = threading.Lock()
+        self._image = _png((90, 120, 200))
+
+    def generate_images(self, prompt, number_of_images=1, latency_scale=1.0, **kwargs):
+        with self._lock:
+            self.calls += 1
+        delay = (self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)) * latency_scale
+        if self.tail_rate and random.random() < self.tail_rate:
+            delay += self.tail_latency
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            raise ImagenUnavailable("fake_imagen: injected failure")
+        with self._lock:
+            self.images_returned += number_of_images
+        return _Result([_GeneratedImage(self._image) for _ in range(number_of_images)])
+
+
+class _Variant:
+    """One Imagen 4 variant: the shared model, faster or slower by MODEL_SPEED."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latency_scale = next((scale for key, scale in MODEL_SPEED.items() if f"-{key}-" in name), 1.0)
+
+    def generate_images(self, prompt, number_of_images=1, **kwargs):
+        return model.generate_images(prompt, number_of_images, latency_scale=self.latency_scale, **kwargs)
+
+
+# Latency of the fast / ultra models relative to the standard one
+MODEL_SPEED = {"fast": 0.5, "ultra": 1.5}
+
+# The model behind every from_pretrained() call, so callers can read its counters
+model = FakeImageGenerationModel()
+
+
+def install(latency=0.0, error_rate=0.0, jitter=0.0, tail_rate=0.0, tail_latency=0.0):
+    """Register fake `vertexai` modules. Returns the shared model."""
+    global model
+    model = FakeImageGenerationModel(latency, error_rate, jitter, tail_rate, tail_latency)
+
+    vision_models = types.ModuleType("vertexai.preview.vision_models")
+    vision_models.ImageGenerationModel = types.SimpleNamespace(from_pretrained=_Variant)
+    preview = types.ModuleType("vertexai.preview")
+    preview.vision_models = vision_models
+    vertexai = types.ModuleType("vertexai")
+    vertexai.preview = preview
+    vertexai.init = lambda **kwargs: None
+
+    sys.modules["vertexai"] = vertexai
+    sys.modules["vertexai.preview"] = preview
+    sys.modules["vertexai.preview.vision_models"] = vision_models
+    return model
@@ -0,0 +1,155 @@
+# fake_stripe.py
+"""Stand-in for the parts of the `stripe` package the app uses.
+
+Checkout sessions are kept in memory. Webhook signatures use the same scheme
+as Stripe (`t=<ts>,v1=<hmac-sha256>`), so `sign()` + `construct_event()`
+exercise the real verification path. Every API call sleeps for `latency`
+seconds and fails `error_rate` of the time.
+
+    import fake_stripe
+    fake_stripe.install(latency=0.2)
+    import index          # `import stripe` now gets this module
+"""
+import sys
+import hmac
+import json
+import time
+import uuid
+import random
+import hashlib
+import threading
+from types import SimpleNamespace
+
+api_key = None
+config = SimpleNamespace(latency=0.0, error_rate=0.0)
+calls = 0
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+class error:
+    class StripeError(Exception):
+        pass
+
+    class APIConnectionError(StripeError):
+        pass
+
+    class SignatureVerificationError(StripeError):
+        def __init__(self, message, sig_header=None):
+            super().__init__(message)
+            self.sig_header = sig_header
+
+
+def _call():
+    global calls
+    with _lock:
+        calls += 1
+    if config.latency:
+        time.sleep(config.latency)
+    if config.error_rate and random.random() < config.error_rate:
+        raise error.APIConnectionError("fake_stripe: injected failure")
+
+
+class _Session:
+    @staticmethod
+    def create(**params):
+        _call()
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        session = {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.test/pay/{session_id}",
+            "metadata": dict(params.get("metadata") or {}),
+            "line_items": [dict(item) for item in params.get("line_items") or []],
+            "payment_status": "paid",
+        }
+        with _lock:
+            _sessions[session_id] = session
+        return SimpleNamespace(id=session_id, url=session["url"], metadata=session["metadata"])
+
+    @staticmethod
+    def list_line_items(session_id, **params):
+        _call()
+        with _lock:
+            session = _sessions.get(session_id)
+        if session is None:
+            raise error.StripeError(f"No such checkout.session: {session_id}")
+        items = [SimpleNamespace(price=SimpleNamespace(id=item["price"]), quantity=item.get("quantity", 1))
+                 for item in session["line_items"]]
+        return SimpleNamespace(data=items)
+
+
+checkout = SimpleNamespace(Session=_Session)
+
+
+def _signature(payload, secret, timestamp):
+    signed = f"{timestamp}.".encode("utf-8") + payload
+    return hmac.new(secret.encode("utf-8"), signed, hashlib.sha256).hexdigest()
+
+
+def sign(payload, secret, timestamp=None):
+    """Stripe-Signature header value for `payload` (bytes)."""
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    return f"t={timestamp},v1={_signature(payload, secret, timestamp)}"
+
+
+class Webhook:
+    @staticmethod
+    def construct_event(payload, sig_header, secret, tolerance=300):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        try:
+            parts = dict(item.split("=", 1) for item in sig_header.split(","))
+            timestamp = int(parts["t"])
+        except (ValueError, KeyError):
+            raise error.SignatureVerificationError("Unable to extract timestamp and signatures from header",
+                                                   sig_header)
+        if not hmac.compare_digest(parts.get("v1", ""), _signature(payload, secret, timestamp)):
+            raise error.SignatureVerificationError("No signatures found matching the expected signature",
+                                                   sig_header)
+        if tolerance and timestamp < time.time() - tolerance:
+            raise error.SignatureVerificationError("Timestamp outside the tolerance zone", sig_header)
+        return json.loads(payload)  # ValueError on a bad payload, like stripe
+
+
+def completed_checkout_event(user_id, price, plan=None):
+    """A `checkout.session.completed` event, as if the user had just paid for `price`.
+
+    The session is recorded without going through latency/error injection, so
+    list_line_items() finds it when the webhook handler asks.
+    """
+    session_id = f"cs_test_{uuid.uuid4().hex}"
+    session = {
+        "id": session_id,
+        "object": "checkout.session",
+        "metadata": {"user_id": user_id, "plan": plan or price, "price_id": price},
+        "line_items": [{"price": price, "quantity": 1}],
+        "payment_status": "paid",
+    }
+    with _lock:
+        _sessions[session_id] = session
+    session = dict(session)
+    session.pop("line_items")
+    return {
+        "id": f"evt_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "created": int(time.time()),
+        "data": {"object": session},
+    }
+
+
+def reset(latency=0.0, error_rate=0.0):
+    global calls
+    config.latency = latency
+    config.error_rate = error_rate
+    calls = 0
+    with _lock:
+        _sessions.clear()
+
+
+def install(latency=0.0, error_rate=0.0):
+    """Make `import stripe` return this module."""
+    reset(latency, error_rate)
+    sys.modules["stripe"] = sys.modules[__name__]
@@ -0,0 +1,83 @@
+# fake_vertex.py
+"""Local stand-in for the Vertex AI Veo REST endpoint.
+
+Serves predictLongRunning / fetchPredictOperation with the same URL layout and
+JSON shapes as us-central1-aiplatform.googleapis.com. Operations finish after
+`op_seconds` and return a small MP4 as base64.
+
+    python fake_vertex.py            # http://127.0.0.1:8089
+    VEO_API_BASE=http://127.0.0.1:8089 VEO_ACCESS_TOKEN=test python index.py
+"""
+import os
+import time
+import uuid
+import base64
+import random
+import threading
+
+from flask import Flask, request, jsonify
+
+SAMPLE_VIDEO = b"\x00\x00\x00\x20ftypmp42" + b"\x00" * 1024
+
+
+def create_app(op_seconds=2.0, error_rate=0.0, video_bytes=SAMPLE_VIDEO):
+    app = Flask(__name__)
+    app.config["OP_SECONDS"] = op_seconds
+    app.config["ERROR_RATE"] = error_rate
+    app.config["REJECT_TOKENS"] = set()   # bearer tokens to answer with 401
+    operations = {}   # name -> started_at
+    stats = {"started": 0, "fetched": 0}
+    lock = threading.Lock()
+    app.operations = operations
+    app.stats = stats
+
+    @app.route("/v1/projects/<project>/locations/<location>/publishers/google/models/<path:model_action>",
+               methods=["POST"])
+    def model_action(project, location, model_action):
+        auth = request.headers.get("Authorization", "")
+        if not auth.startswith("Bearer ") or auth[7:] in app.config["REJECT_TOKENS"]:
+            return jsonify({"error": {"code": 401, "message": "Missing or expired bearer token"}}), 401
+
+        model_id, _, action = model_action.partition(":")
+        body = request.get_json(silent=True) or {}
+
+        if action == "predictLongRunning":
+            if random.random() < app.config["ERROR_RATE"]:
+                return jsonify({"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}}), 429
+            name = (f"projects/{project}/locations/{location}/publishers/google/models/{model_id}"
+                    f"/operations/{uuid.uuid4()}")
+            with lock:
+                operations[name] = time.time()
+                stats["started"] += 1
+            return jsonify({"name": name})
+
+        if action == "fetchPredictOperation":
+            name = body.get("operationName")
+            with lock:
+                started = operations.get(name)
+                stats["fetched"] += 1
+            if started is None:
+                return jsonify({"error": {"code": 404, "message": f"Operation {name} not found"}}), 404
+            if time.time() - started < app.config["OP_SECONDS"]:
+                return jsonify({"name": name})
+            return jsonify({
+                "name": name,
+                "done": True,
+                "response": {
+                    "@type": "type.googleapis.com/cloud.ai.large_models.vision.GenerateVideoResponse",
+                    "raiMediaFilteredCount": 0,
+                    "videos": [{
+                        "bytesBase64Encoded": base64.b64encode(video_bytes).decode("ascii"),
+                        "mimeType": "video/mp4"
+                    }]
+                }
+            })
+
+        return jsonify({"error": {"code": 400, "message": f"Unknown action {action}"}}), 400
+
+    return app
+
+
+if __name__ == "__main__":
+    app = create_app(op_seconds=float(os.environ.get("FAKE_VEO_OP_SECONDS", "20")))
+    app.run(host="127.0.0.1", port=int(os.environ.get("FAKE_VERTEX_PORT", "8089")), threaded=True)
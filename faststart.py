@@ -0,0 +1,152 @@
+# faststart.py
+"""Move an MP4's moov atom in front of its media data ("faststart").
+
+A player needs the moov atom (the sample index) before it can show a frame.
+When it sits after the media data, as many encoders write it, the browser
+has to fetch the end of the file with an extra range request, or download the
+whole file, before playback starts. With moov first, the first response is
+enough to start playing.
+
+The chunk offsets in every track's stco / co64 table move by the size of the
+moov atom; the media data itself is copied, not parsed. Files that are
+already faststart, fragmented, or have a compressed moov are left alone.
+
+    python faststart.py video.mp4 [out.mp4]
+"""
+import os
+import sys
+import struct
+import shutil
+import logging
+import tempfile
+
+# Atoms on the way from moov down to the chunk offset tables
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+log = logging.getLogger(__name__)
+
+
+class NotSupported(Exception):
+    pass
+
+
+def top_level_atoms(f):
+    """[(type, offset, size)] of the file's top-level atoms."""
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    atoms = []
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+        elif size == 0:
+            size = file_size - offset   # runs to the end of the file
+        if size < 8 or offset + size > file_size:
+            raise NotSupported(f"bad {kind!r} atom at {offset}")
+        atoms.append((kind, offset, size))
+        offset += size
+    return atoms
+
+
+def needs_faststart(path):
+    with open(path, "rb") as f:
+        kinds = [kind for kind, _, _ in top_level_atoms(f)]
+    return b"moov" in kinds and b"mdat" in kinds and kinds.index(b"moov") > kinds.index(b"mdat")
+
+
+def _shift_offsets(moov, start, end, shift, moved_from):
+    """Add `shift` to every chunk offset below `moved_from` in moov[start:end]."""
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", moov, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", moov, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise NotSupported(f"bad {kind!r} atom in moov")
+        if kind in CONTAINERS:
+            _shift_offsets(moov, offset + header, offset + size, shift, moved_from)
+        elif kind == b"cmov":
+            raise NotSupported("compressed moov")
+        elif kind in (b"stco", b"co64"):
+            count = struct.unpack_from(">I", moov, offset + header + 4)[0]
+            fmt, width = (">I", 4) if kind == b"stco" else (">Q", 8)
+            table = offset + header + 8
+            for i in range(count):
+                position = table + i * width
+                value = struct.unpack_from(fmt, moov, position)[0]
+                if value < moved_from:
+                    value += shift
+                    if kind == b"stco" and value > 0xFFFFFFFF:
+                        raise NotSupported("chunk offsets would overflow stco")
+                    struct.pack_into(fmt, moov, position, value)
+        offset += size
+
+
+def _copy_range(src, dst, offset, length):
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(1024 * 1024, length))
+        if not chunk:
+            raise NotSupported("file ended early")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def faststart(src_path, dst_path=None):
+    """Rewrite the file with moov first. Returns True if it was rewritten.
+
+    dst_path defaults to src_path (replaced atomically).
+    """
+    dst_path = dst_path or src_path
+    with open(src_path, "rb") as src:
+        try:
+            atoms = top_level_atoms(src)
+            kinds = [kind for kind, _, _ in atoms]
+            if b"moov" not in kinds or b"mdat" not in kinds or b"moof" in kinds:
+                return False
+            moov_index = kinds.index(b"moov")
+            first_mdat = kinds.index(b"mdat")
+            if moov_index < first_mdat:
+                return False
+
+            _, moov_offset, moov_size = atoms[moov_index]
+            src.seek(moov_offset)
+            moov = bytearray(src.read(moov_size))
+            header = 16 if struct.unpack_from(">I", moov, 0)[0] == 1 else 8
+            _shift_offsets(moov, header, moov_size, moov_size, moov_offset)
+        except NotSupported as e:
+            log.warning(f"Not making {src_path} faststart: {e}")
+            return False
+
+        order = atoms[:first_mdat] + [None] + [a for a in atoms[first_mdat:] if a[0] != b"moov"]
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst_path)), prefix=".tmp-",
+                                   suffix=os.path.basename(dst_path))
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                for atom in order:
+                    if atom is None:
+                        dst.write(moov)
+                    else:
+                        _copy_range(src, dst, atom[1], atom[2])
+            shutil.copymode(src_path, tmp)
+            os.replace(tmp, dst_path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+    return True
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.exit(__doc__)
+    rewritten = faststart(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None)
+    print("moved moov to the front" if rewritten else "already faststart (or not supported); unchanged")
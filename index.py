@@ -1,47 +1,359 @@
 # index.py
-from flask import Flask, request, jsonify, send_from_directory, url_for
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, request, jsonify, url_for, Response, stream_with_context, g
 from flask_cors import CORS
-import vertexai
-from vertexai.preview.vision_models import ImageGenerationModel
 import os
-import time
+import math
 import base64
-import traceback
-import firebase_admin
-from firebase_admin import credentials, db
-import stripe
+import io
+import re
+import hmac
 import json
+import random
+import logging
+import applog
+import metrics
+from metrics import Timed
+from clients import LazyClient, Dependencies, DependencyUnavailable
+from ledger import open_ledger
+from reservations import FirebaseCreditStore, LedgerCreditStore, InsufficientCredits, GrantOutcomeUnknown
+from ratelimit import RateLimiter
+from admission import UpstreamGuard, CircuitBreaker
+from callpolicy import CallPolicy
+from result_cache import ResultCache
+from singleflight import SingleFlight
+from microbatch import MicroBatcher
+from delivery import send_static, IMMUTABLE_MAX_AGE
+from storage import StorageManager
+from derivatives import DerivativePipeline, is_source, pick_variant
+from werkzeug.security import safe_join
+from webhook_events import WebhookEventStore, WebhookEventQueue, EventRejected
+from video_jobs import VideoJobStore, VideoJobQueue, JobQueueFull, TERMINAL_STATES
+from veo import VeoClient
+from faststart import faststart
+from model_router import ModelRouter, Tier
+from assets import AssetStore
+from prewarm import Prewarmer, VariantPool
+from profiler import Profiler, ProfileStore
 
 # ---- Paths ----
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-STATIC_DIR = os.path.join(BASE_DIR, "static")
+STATIC_DIR = os.environ.get("STATIC_DIR", os.path.join(BASE_DIR, "static"))
+MEDIA_DIR = os.path.join(BASE_DIR, "Media")
 os.makedirs(STATIC_DIR, exist_ok=True)
 
 # ---- Flask ----
 app = Flask(__name__, static_folder=STATIC_DIR, static_url_path="/static")
 # Allow file:// page or any origin to call this API:
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=False)
+# When started as `python index.py`, the derivative workers import this file as
+# __mp_main__; they must not start the server's background threads.
+BACKGROUND_TASKS = __name__ != "__mp_main__"
+
+# ---- Logging ----
+# JSON lines on stderr, written by a background thread (see applog.py). LOG_LEVEL,
+# LOG_FORMAT=text and LOG_SAMPLE ("DEBUG=0.01,INFO=1") tune it. Every line logged
+# during a request carries its X-Request-ID, and each request ends with one
+# "request" line holding its status, duration and time per stage.
+if BACKGROUND_TASKS:
+    applog.setup()
+log = logging.getLogger(__name__)
+
+@app.before_request
+def _start_request_log():
+    g.request_id = applog.begin_request(request.headers.get("X-Request-ID"))
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _tag_response(response):
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def _log_request(exc):
+    started = g.pop("request_started", None)
+    if started is not None:
+        status = g.get("response_status", 500)
+        log.log(logging.WARNING if status >= 500 else logging.INFO, "request", extra={
+            "method": request.method,
+            "route": request.url_rule.rule if request.url_rule else "unmatched",
+            "status": status,
+            "durationMs": round((time.perf_counter() - started) * 1000, 2),
+            "stages": applog.stages(),
+        })
+    applog.end_request()
+
+# ---- Metrics ----
+# Prometheus text format at /metrics. Cloud clients below are wrapped in Timed
+# proxies, so every Vertex / Firebase / ledger / Stripe call is timed too.
+HTTP_SECONDS = metrics.histogram("http_request_seconds", "Request latency by route", ("route", "method"))
+HTTP_REQUESTS = metrics.counter("http_requests_total", "Responses by route and status",
+                                ("route", "method", "status"))
+HTTP_IN_FLIGHT = metrics.gauge("http_requests_in_flight", "Requests being handled", ("route",))
+
+@app.before_request
+def _start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_started = time.perf_counter()
+    HTTP_IN_FLIGHT.inc(route=g.metrics_route)
+
+@app.after_request
+def _count_response(response):
+    HTTP_REQUESTS.inc(route=g.get("metrics_route", "unmatched"), method=request.method,
+                      status=str(response.status_code))
+    return response
+
+@app.teardown_request
+def _finish_request_metrics(exc):
+    route = g.pop("metrics_route", None)
+    if route is None:
+        return
+    HTTP_IN_FLIGHT.dec(route=route)
+    HTTP_SECONDS.observe(time.perf_counter() - g.metrics_started, route=route, method=request.method)
+
+# ---- Profiling (optional) ----
+# Sampled wall-clock profiles of single requests (see profiler.py), for finding where a
+# slow /generate or /claim-daily-credits spends its time. A request is profiled when it
+# sends `X-Profile-Token: <PROFILE_TOKEN>`, or at random with PROFILE_SAMPLE_RATE (0-1).
+# Profiles are folded stacks ready for flamegraph.pl / speedscope, kept in PROFILE_DIR
+# (newest PROFILE_MAX_FILES); GET /profiles lists them, with the same token as a Bearer.
+# With neither variable set no hook or thread is installed, so it costs nothing.
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+profiler = None
+if PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0:
+    profiler = Profiler(
+        ProfileStore(os.environ.get("PROFILE_DIR", os.path.join(BASE_DIR, "profiles")),
+                     max_profiles=int(os.environ.get("PROFILE_MAX_FILES", "100"))),
+        interval=float(os.environ.get("PROFILE_INTERVAL_MS", "10")) / 1000
+    )
+
+    @app.before_request
+    def _start_profile():
+        if request.path.startswith("/profiles"):
+            return
+        if _token_matches(request.headers.get("X-Profile-Token", ""), PROFILE_TOKEN):
+            reason = "requested"
+        elif random.random() < PROFILE_SAMPLE_RATE:
+            reason = "sampled"
+        else:
+            return
+        g.profile = (profiler.start(), reason)
+
+    # Teardown functions run last-registered first, so this one still sees the stages
+    @app.teardown_request
+    def _finish_profile(exc):
+        started = g.pop("profile", None)
+        if started is None:
+            return
+        session, reason = started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        try:
+            profiler.finish(session, f"{route.strip('/') or 'root'}-{g.get('request_id', '')}", {
+                "route": route,
+                "method": request.method,
+                "status": g.get("response_status", 500),
+                "requestId": g.get("request_id"),
+                "reason": reason,
+                "stages": applog.stages(),
+            })
+        except Exception as e:
+            log.warning(f"Could not save the request profile: {e}")
+
+def _token_matches(given, token):
+    return bool(token) and hmac.compare_digest(given.encode(), token.encode())
+
+# ---- Static delivery ----
+# Generated files get strong ETags and immutable caching. STATIC_DELIVERY picks who
+# sends the bytes: "python" (Flask), "x-sendfile" (Apache/lighttpd) or "x-accel" (nginx,
+# with an internal location at X_ACCEL_PREFIX aliased to STATIC_DIR).
+STATIC_DELIVERY = os.environ.get("STATIC_DELIVERY", "python")
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "/_static/")
+app.config["USE_X_SENDFILE"] = STATIC_DELIVERY == "x-sendfile"
+
+def serve_static(filename):
+    # /static/generated_x.png may live in a shard (static/ab/cd/...) or, for files
+    # written before sharding, directly in STATIC_DIR
+    return _send_image(STATIC_DIR, storage.relative_path(filename), mode=STATIC_DELIVERY)
+
+app.view_functions["static"] = serve_static
+
+@app.route("/Media/<path:filename>", methods=["GET"])
+def serve_media(filename):
+    # Sample images and videos used by the HTML pages. The X-Accel location only
+    # covers STATIC_DIR, so Flask sends these (or X-Sendfile, if that's on).
+    # The pages link to fingerprinted names (image.<hash>.png), which never change.
+    filename, immutable = assets.resolve_media(filename)
+    response = _send_image(MEDIA_DIR, filename, mode="python")
+    if immutable:
+        response.headers["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    return response
+
+def _send_image(directory, filename, mode):
+    """send_static, swapping in a WebP/AVIF variant when the client accepts one"""
+    path = safe_join(directory, filename)
+    if derivatives is None or path is None or not is_source(path):
+        return send_static(directory, filename, mode=mode, accel_prefix=X_ACCEL_PREFIX)
+
+    chosen = pick_variant(path, request.headers.get("Accept"), request.args.get("w", type=int),
+                          derivatives.formats)
+    response = send_static(directory, os.path.relpath(chosen, directory), mode=mode,
+                           accel_prefix=X_ACCEL_PREFIX)
+    response.vary.add("Accept")
+    return response
+
+# ---- HTML pages ----
+# index/image/video/pricing.html are served from memory with gzip (and brotli, if
+# the package is installed) copies made once, per-encoding ETags and Media/ links
+# rewritten to fingerprinted names. Compressed copies are kept in ASSET_CACHE_DIR;
+# `python assets.py build` fills it before a deploy.
+assets = AssetStore(BASE_DIR, MEDIA_DIR,
+                    cache_dir=os.environ.get("ASSET_CACHE_DIR", os.path.join(BASE_DIR, ".asset_cache")))
+if BACKGROUND_TASKS:
+    assets.warm_up()
+
+def _send_page(name):
+    page = assets.page(name)
+    if page is None:
+        return jsonify({"error": "Not found"}), 404
+    encoding, body = assets.choose(page, request.accept_encodings)
+    response = Response(body, mimetype="text/html")
+    response.set_etag(f"{page.digest}-{encoding or 'identity'}")
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    # Same URL for every version of the page: always revalidate (a 304 is cheap)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+# ---- Image derivatives ----
+# Every generated image also gets WebP/AVIF copies at a few widths, made by a pool of
+# DERIVATIVE_WORKERS processes after the response is sent (0 turns this off).
+# `python derivatives.py backfill` does the same for existing static/ and Media/ files.
+DERIVATIVE_WORKERS = int(os.environ.get("DERIVATIVE_WORKERS", "2"))
+derivatives = DerivativePipeline(DERIVATIVE_WORKERS) if DERIVATIVE_WORKERS > 0 else None
+
+# ---- Generated file storage ----
+# Generated images and videos are stored in hash-sharded subdirectories of STATIC_DIR
+# and indexed by owner. A background sweeper applies STORAGE_TTL_DAYS and
+# STORAGE_MAX_GB; STORAGE_USER_QUOTA_MB caps each user (their oldest files go first).
+# 0 disables a limit.
+storage = StorageManager(
+    STATIC_DIR,
+    os.environ.get("STORAGE_DB", os.path.join(BASE_DIR, "storage.db")),
+    ttl_seconds=float(os.environ.get("STORAGE_TTL_DAYS", "0")) * 86400,
+    max_bytes=int(float(os.environ.get("STORAGE_MAX_GB", "0")) * 1024 ** 3),
+    user_quota_bytes=int(float(os.environ.get("STORAGE_USER_QUOTA_MB", "0")) * 1024 ** 2),
+    sweep_interval=float(os.environ.get("STORAGE_SWEEP_SECONDS", "300"))
+)
+if BACKGROUND_TASKS:
+    storage.start_sweeper()
+
+# ---- Cloud clients (created lazily) ----
+# Vertex AI, Firebase and Stripe are initialized on first use or by a background
+# warm-up right after import, so the process can answer cheap routes (/, /health,
+# file-mode /get-credits) straight away. /readyz turns 200 once they're all up.
+dependencies = Dependencies()
 
 # ---- Firebase Admin ----
-# Initialize Firebase Admin SDK
-firebase_initialized = False
-try:
-    cred = credentials.Certificate("serviceAccountKey.json")  # You'll need to add your service account key
+# Firebase mode is on when the service account key is present; the SDK itself
+# is initialized in the background.
+FIREBASE_KEY_FILE = "serviceAccountKey.json"  # You'll need to add your service account key
+firebase_initialized = os.path.exists(FIREBASE_KEY_FILE)
+
+def _init_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, db
+    cred = credentials.Certificate(FIREBASE_KEY_FILE)
     firebase_admin.initialize_app(cred, {
         'databaseURL': 'https://perseptra-default-rtdb.firebaseio.com'
     })
-    firebase_initialized = True
-    print("Firebase Admin SDK initialized successfully")
-except Exception as e:
-    print(f"Firebase Admin initialization failed: {e}")
-    print("Using local storage fallback for testing")
-    # Continue without Firebase for now
+    log.info("Firebase Admin SDK initialized")
+    return db
+
+if firebase_initialized:
+    db = Timed(dependencies.add(LazyClient("firebase", _init_firebase)).proxy(), "firebase",
+               timed=("get", "set", "update", "set_if_unchanged", "transaction", "delete"),
+               chained=("reference", "child"))
+else:
+    db = None
+    log.info(f"No {FIREBASE_KEY_FILE} found, using the local credit ledger")
+
+# ---- Local credit ledger (file mode) ----
+# When Firebase is off, credits live in a SQLite ledger instead of rewriting
+# user_credits.json / daily_claims.json on every request. The JSON files are
+# imported once, the first time the ledger is created.
+CREDITS_FILE = os.path.join(BASE_DIR, "user_credits.json")
+CLAIMS_FILE = os.path.join(BASE_DIR, "daily_claims.json")
+LEDGER_PATH = os.environ.get("CREDITS_DB", os.path.join(BASE_DIR, "credits.db"))
+ledger = None
+if not firebase_initialized:
+    ledger = Timed(open_ledger(LEDGER_PATH, CREDITS_FILE, CLAIMS_FILE), "ledger",
+                   timed=("get", "get_balance", "get_plan", "deduct", "grant", "claim_daily", "grant_many", "balances"))
+
+# ---- Credit reservations ----
+# Charges are reserved before calling Vertex and refunded if the call fails.
+# In Firebase mode each reservation is a single conditional write.
+if firebase_initialized:
+    credit_store = FirebaseCreditStore(db)
+else:
+    credit_store = LedgerCreditStore(ledger)
+
+# ---- Bulk credits ----
+# /bulk-credits/grant and /bulk-credits/read take NDJSON ({"userId", "amount"} per
+# line) and stream back one result line per user, then a summary. Users are handled
+# BULK_CREDITS_CHUNK at a time: one multi-path update per chunk in Firebase mode, one
+# transaction in file mode. A chunk that fails is "failed" (nothing applied, safe to
+# retry) or, when Firebase timed out or dropped the connection mid-update, "unknown"
+# (it may have been applied: read the balances before retrying). Callers need
+# `Authorization: Bearer <BULK_CREDITS_TOKEN>`; without the variable set both routes answer 403.
+BULK_CREDITS_TOKEN = os.environ.get("BULK_CREDITS_TOKEN")
+BULK_CREDITS_CHUNK = int(os.environ.get("BULK_CREDITS_CHUNK", "500"))
+# Realtime Database keys can't contain . $ # [ ] / or control characters
+USER_ID = re.compile(r"^[^.$#\[\]/\x00-\x1f\x7f]{1,768}$")
+
+# ---- Rate limiting ----
+# Token buckets in front of Imagen and the daily claim, so one userId can't burn the
+# shared Vertex quota. RATE_LIMIT_<GENERATE|CLAIM>_<USER|GLOBAL> take "10/min",
+# "100/10s" or 0 (off). With RATE_LIMIT_DB set, all worker processes share the
+# buckets in that SQLite file; otherwise each process limits on its own.
+rate_limiter = RateLimiter(os.environ.get("RATE_LIMIT_DB"))
+rate_limiter.add("generate", per_user=os.environ.get("RATE_LIMIT_GENERATE_USER", "20/min"),
+                 overall=os.environ.get("RATE_LIMIT_GENERATE_GLOBAL", "0"))
+rate_limiter.add("claim-daily", per_user=os.environ.get("RATE_LIMIT_CLAIM_USER", "5/min"),
+                 overall=os.environ.get("RATE_LIMIT_CLAIM_GLOBAL", "0"))
+
+def _rate_limited(name, user_id):
+    """429 response when `user_id` is over the `name` limit, else None"""
+    wait = rate_limiter.check(name, user_id)
+    if not wait:
+        return None
+    retry_after = max(1, math.ceil(wait))
+    log.debug("Rate limited", extra={"limit": name, "userId": user_id, "retryAfter": retry_after})
+    return jsonify({
+        "error": f"Too many requests. Try again in {retry_after} seconds.",
+        "retryAfter": retry_after
+    }), 429, {"Retry-After": str(retry_after)}
 
 # ---- Stripe Configuration ----
-# Initialize Stripe with your secret key
-stripe.api_key = 'sk_test_YOUR_STRIPE_SECRET_KEY'  # Replace with your actual Stripe secret key
+STRIPE_SECRET_KEY = 'sk_test_YOUR_STRIPE_SECRET_KEY'  # Replace with your actual Stripe secret key
 STRIPE_WEBHOOK_SECRET = 'whsec_YOUR_WEBHOOK_SECRET'  # Replace with your webhook secret
 
+def _init_stripe():
+    import stripe
+    # Initialize Stripe with your secret key
+    stripe.api_key = STRIPE_SECRET_KEY
+    return stripe
+
+# Payments are not needed to serve generations, so Stripe doesn't gate readiness
+stripe = Timed(dependencies.add(LazyClient("stripe", _init_stripe, required=False)).proxy(), "stripe",
+               timed=("create", "list_line_items", "construct_event"),
+               chained=("checkout", "Session", "Webhook"))
+
 # Plan configurations
 STRIPE_PLANS = {
     'price_starter': {
@@ -58,19 +370,284 @@ STRIPE_PLANS = {
     }
 }
 
+# Plan names the frontend sends -> Stripe price IDs
+PLAN_PRICES = {
+    'starter': 'price_starter',  # Replace with your actual Stripe price ID
+    'pro': 'price_pro',          # Replace with your actual Stripe price ID
+    'enterprise': 'price_enterprise'  # Replace with your actual Stripe price ID
+}
+
+# ---- Stripe webhook events ----
+# /stripe-webhook only verifies and stores the event (keyed by its id, so
+# Stripe's retries and duplicate deliveries are dropped) and answers 200.
+# A worker applies it: the plan comes from the checkout session's metadata,
+# and the grant is keyed by the event id so it lands exactly once.
+STRIPE_EVENT_WORKERS = int(os.environ.get("STRIPE_EVENT_WORKERS", "1"))
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.environ.get("STRIPE_EVENT_MAX_ATTEMPTS", "8"))
+
+def _apply_checkout_completed(event):
+    session = event['data']['object']
+    metadata = session.get('metadata') or {}
+    user_id = metadata.get('user_id')
+    if not user_id:
+        raise EventRejected(f"No user_id in checkout session {session.get('id')} metadata")
+    # Sessions created before price_id was added to the metadata only carry the plan name
+    price_id = metadata.get('price_id') or PLAN_PRICES.get(metadata.get('plan'))
+    plan_config = STRIPE_PLANS.get(price_id)
+    if not plan_config:
+        raise EventRejected(f"Unknown plan {metadata.get('plan')!r} / price {price_id!r} "
+                            f"in checkout session {session.get('id')}")
+
+    credits_to_add = plan_config['credits']
+    plan = next((name for name, price in PLAN_PRICES.items() if price == price_id), None)
+    new_balance = credit_store.grant(user_id, credits_to_add, key=f"stripe:{event['id']}", plan=plan)
+    log.info("Payment credited", extra={"userId": user_id, "credits": credits_to_add,
+                                        "balance": new_balance, "priceId": price_id, "eventId": event['id']})
+    return {"userId": user_id, "credits": credits_to_add, "balance": new_balance}
+
+stripe_events = WebhookEventQueue(
+    WebhookEventStore(os.environ.get("STRIPE_EVENTS_DB", os.path.join(BASE_DIR, "stripe_events.db"))),
+    {'checkout.session.completed': _apply_checkout_completed},
+    workers=STRIPE_EVENT_WORKERS,
+    max_attempts=STRIPE_EVENT_MAX_ATTEMPTS
+)
+if BACKGROUND_TASKS:
+    stripe_events.start()
+
 # ---- Vertex AI (your settings) ----
-vertexai.init(project="perseptra-468600", location="us-central1")
-model = ImageGenerationModel.from_pretrained("imagen-4.0-generate-preview-06-06")
+IMAGEN_MODEL_ID = "imagen-4.0-generate-preview-06-06"   # the standard tier
+IMAGEN_FAST_MODEL_ID = "imagen-4.0-fast-generate-001"
+IMAGEN_ULTRA_MODEL_ID = "imagen-4.0-ultra-generate-001"
+IMAGEN_MAX_IMAGES = 4  # most images Imagen returns from one call
 
-def _extract_first_image_bytes(gen_result):
-    """Be tolerant of SDK return shapes and attributes."""
+def _init_imagen(model_id=IMAGEN_MODEL_ID):
+    import vertexai
+    from vertexai.preview.vision_models import ImageGenerationModel
+    vertexai.init(project="perseptra-468600", location="us-central1")
+    return ImageGenerationModel.from_pretrained(model_id)
+
+model = Timed(dependencies.add(LazyClient("vertex_imagen", _init_imagen)).proxy(), "vertex",
+              timed=("generate_images",))
+# The other tiers are optional: /readyz doesn't wait for them
+fast_model = Timed(dependencies.add(LazyClient("vertex_imagen_fast", lambda: _init_imagen(IMAGEN_FAST_MODEL_ID),
+                                               required=False)).proxy(), "vertex", timed=("generate_images",))
+ultra_model = Timed(dependencies.add(LazyClient("vertex_imagen_ultra", lambda: _init_imagen(IMAGEN_ULTRA_MODEL_ID),
+                                                required=False)).proxy(), "vertex", timed=("generate_images",))
+
+# Imagen calls run on VERTEX_MAX_CONCURRENCY slots; VERTEX_QUEUE_SIZE more requests may
+# wait up to VERTEX_QUEUE_TIMEOUT seconds for one, and nobody waits on Vertex longer
+# than VERTEX_DEADLINE_SECONDS. The breaker opens when BREAKER_ERROR_RATE of the last
+# BREAKER_WINDOW calls failed, or BREAKER_SLOW_RATE took over BREAKER_SLOW_SECONDS, and
+# then answers 503 (credits refunded) for BREAKER_OPEN_SECONDS. Request threads never
+# pile up behind a slow Vertex, so cheap routes keep answering.
+vertex_guard = UpstreamGuard(
+    "vertex",
+    slots=int(os.environ.get("VERTEX_MAX_CONCURRENCY", "8")),
+    queue_size=int(os.environ.get("VERTEX_QUEUE_SIZE", "16")),
+    queue_timeout=float(os.environ.get("VERTEX_QUEUE_TIMEOUT", "5")),
+    deadline=float(os.environ.get("VERTEX_DEADLINE_SECONDS", "60")),
+    breaker=CircuitBreaker(
+        "vertex",
+        window=int(os.environ.get("BREAKER_WINDOW", "20")),
+        min_calls=int(os.environ.get("BREAKER_MIN_CALLS", "10")),
+        error_rate=float(os.environ.get("BREAKER_ERROR_RATE", "0.5")),
+        slow_seconds=float(os.environ.get("BREAKER_SLOW_SECONDS", "30")),
+        slow_rate=float(os.environ.get("BREAKER_SLOW_RATE", "0.5")),
+        open_seconds=float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+    )
+)
+
+# Transient Vertex errors are retried (VERTEX_ATTEMPTS calls in all, jittered backoff
+# from VERTEX_RETRY_BASE_SECONDS) within VERTEX_BUDGET_SECONDS. VERTEX_HEDGE_QUANTILE
+# (e.g. 0.95) sends a second call when the first runs longer than that share of recent
+# calls and uses whichever answers first; each hedge is a billed call, so it's off by default.
+vertex_policy = CallPolicy(
+    vertex_guard,
+    attempts=int(os.environ.get("VERTEX_ATTEMPTS", "3")),
+    base_delay=float(os.environ.get("VERTEX_RETRY_BASE_SECONDS", "0.5")),
+    budget=float(os.environ.get("VERTEX_BUDGET_SECONDS", "90")),
+    hedge_quantile=float(os.environ.get("VERTEX_HEDGE_QUANTILE", "0")) or None
+)
+
+# ---- Model tiers ----
+# /generate and /generate-batch take a `quality` of fast, standard or ultra. Without one
+# the user's plan picks (PLAN_TIERS: default tier, best tier allowed). When the tier's
+# recent latency plus the wait for a Vertex slot would go past IMAGEN_SLO_SECONDS, the
+# request drops to a faster tier rather than time out. Credits are charged per image
+# at the tier actually used; usd_per_image only feeds the cost metrics.
+IMAGEN_SLO_SECONDS = float(os.environ.get("IMAGEN_SLO_SECONDS", "20"))
+PLAN_TIERS = {
+    None: ("standard", "standard"),
+    "starter": ("standard", "ultra"),
+    "pro": ("standard", "ultra"),
+    "enterprise": ("ultra", "ultra"),
+}
+model_router = ModelRouter([
+    Tier("fast", fast_model, IMAGEN_FAST_MODEL_ID, credits=1, usd_per_image=0.02, expected_seconds=4),
+    Tier("standard", model, IMAGEN_MODEL_ID, credits=1, usd_per_image=0.04, expected_seconds=8),
+    # Imagen 4 Ultra makes one image per call
+    Tier("ultra", ultra_model, IMAGEN_ULTRA_MODEL_ID, credits=2, usd_per_image=0.06, expected_seconds=12,
+         max_images=1),
+], load=vertex_guard.stats, slo_seconds=IMAGEN_SLO_SECONDS, plans=PLAN_TIERS)
+
+def _generate_images(prompt, tier=None, **params):
+    """The tier's generate_images with vertex_policy's retries / hedging, behind vertex_guard"""
+    with applog.stage("model_call"):
+        return model_router.call(tier or model_router.default, vertex_policy.call, prompt=prompt, **params)
+
+def _choose_tier(user_id, quality, images=1):
+    """(tier, reason) for a request; see model_router.py"""
+    try:
+        plan = credit_store.plan(user_id)
+    except DependencyUnavailable:
+        raise
+    except Exception as e:
+        log.warning(f"Could not look up the plan: {e}", extra={"userId": user_id})
+        plan = None
+    return model_router.choose(quality, plan, images)
+
+def _bad_quality(quality):
+    """Error message for an unknown `quality`, else None"""
+    if quality is None or quality in model_router.by_name:
+        return None
+    return f"quality must be one of {', '.join(model_router.by_name)}"
+
+def _credits_message(cost, what):
+    return f"Insufficient credits. You need {cost} credit{'' if cost == 1 else 's'} to generate {what}."
+
+# ---- Result cache (optional) ----
+# Identical prompts (same model + params) are answered from disk instead of
+# calling Imagen again. A hit is charged RESULT_CACHE_HIT_COST per credit of the
+# tier's price (so 2 for a cached ultra image with the default of 1).
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE", "0") == "1"
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_MB", "500")) * 1024 * 1024
+RESULT_CACHE_HIT_COST = int(os.environ.get("RESULT_CACHE_HIT_COST", "1"))
+result_cache = None
+if RESULT_CACHE_ENABLED:
+    result_cache = ResultCache(os.path.join(STATIC_DIR, "cache"), RESULT_CACHE_MAX_BYTES)
+
+def _cache_hit_cost(tier):
+    """Credits charged for a result cache hit at this tier (the cache key includes its model)"""
+    return RESULT_CACHE_HIT_COST * tier.credits
+
+# ---- Request coalescing ----
+# Concurrent /generate calls with the same prompt + params share one Imagen call.
+# Set SINGLE_FLIGHT_LOCK_DIR to coalesce across worker processes too.
+single_flight = SingleFlight(lock_dir=os.environ.get("SINGLE_FLIGHT_LOCK_DIR") or None)
+
+# ---- Micro-batching (optional) ----
+# With MICRO_BATCH_WINDOW_MS > 0, /generate requests for the same prompt that arrive
+# within the window are merged into one multi-image call and each gets its own image.
+# This replaces single-flight coalescing for /generate while it is on.
+MICRO_BATCH_WINDOW_MS = int(os.environ.get("MICRO_BATCH_WINDOW_MS", "0"))
+micro_batcher = None
+if MICRO_BATCH_WINDOW_MS > 0:
+    micro_batcher = MicroBatcher(lambda args, count: _generate_image_batch(args, count),
+                                 window=MICRO_BATCH_WINDOW_MS / 1000.0, max_batch=IMAGEN_MAX_IMAGES)
+
+# ---- Pre-warming (optional) ----
+# With PREWARM=1, /generate keeps approximate counts of the most requested prompts and,
+# while Vertex is quiet, pre-generates PREWARM_VARIANTS images for each trending one into
+# STATIC_DIR/prewarm. A later /generate for that prompt takes one of them (charged as
+# usual) instead of waiting on Imagen. PREWARM_MAX_IMAGES_PER_HOUR and
+# PREWARM_MAX_USD_PER_DAY cap the spend of each worker process; images nobody claims
+# within PREWARM_TTL_HOURS are deleted. /prewarm-stats has the hit rate and spend;
+# /prewarm-stats/trending lists the top request keys (hashes, never prompt text) and
+# needs `Authorization: Bearer <ADMIN_TOKEN>`.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+PREWARM_ENABLED = os.environ.get("PREWARM", "0") == "1"
+prewarmer = None
+if PREWARM_ENABLED:
+    prewarmer = Prewarmer(
+        VariantPool(os.path.join(STATIC_DIR, "prewarm"),
+                    ttl=float(os.environ.get("PREWARM_TTL_HOURS", "24")) * 3600),
+        lambda sample, count: _prewarm_images(*sample, count),
+        lambda sample: model_router.by_name[sample[1]].usd_per_image,
+        # model_router.load, so the ASGI server's slot counts are used when it runs
+        load=lambda: model_router.load(),
+        interval=float(os.environ.get("PREWARM_INTERVAL_SECONDS", "10")),
+        idle_share=float(os.environ.get("PREWARM_IDLE_SHARE", "0.25")),
+        min_count=int(os.environ.get("PREWARM_MIN_COUNT", "3")),
+        variants=int(os.environ.get("PREWARM_VARIANTS", "2")),
+        max_pool=int(os.environ.get("PREWARM_MAX_POOL", "200")),
+        max_images_per_hour=int(os.environ.get("PREWARM_MAX_IMAGES_PER_HOUR", "60")),
+        max_usd_per_day=float(os.environ.get("PREWARM_MAX_USD_PER_DAY", "5"))
+    )
+    if BACKGROUND_TASKS:
+        prewarmer.start()
+
+def _prewarm_images(prompt, tier_name, count):
+    """Image bytes for the pre-warmer: one Imagen call at the tier the requests used"""
+    tier = model_router.by_name[tier_name]
+    res = _generate_images(prompt, tier, number_of_images=min(count, tier.max_images))
+    return _extract_all_image_bytes(res)
+
+def _take_prewarmed(request_key, owner):
+    """Filename of a pre-generated image for this request, moved into storage; else None"""
+    if prewarmer is None:
+        return None
+    try:
+        path = prewarmer.claim(request_key)
+        if path is None:
+            return None
+        filename = f"generated_{time.time_ns()}.png"
+        storage.save_file(filename, path, owner=owner)
+    except Exception as e:
+        log.warning(f"Could not use a pre-generated image: {e}")
+        return None
+    _queue_derivatives(filename)
+    return filename
+
+# ---- Video jobs (Veo) ----
+# /generate-video only queues a job; a bounded pool of background workers drives
+# the long-running Veo operation. Jobs are kept in SQLite and resume after a restart.
+# Point VEO_API_BASE at fake_vertex.py to run without Google Cloud.
+VEO_MODEL_ID = "veo-3.0-generate-001"
+VEO_API_BASE = os.environ.get("VEO_API_BASE", "https://us-central1-aiplatform.googleapis.com")
+VIDEO_JOB_WORKERS = int(os.environ.get("VIDEO_JOB_WORKERS", "2"))
+VIDEO_JOB_QUEUE_MAX = int(os.environ.get("VIDEO_JOB_QUEUE_MAX", "100"))
+VIDEO_JOB_POLL_SECONDS = float(os.environ.get("VIDEO_JOB_POLL_SECONDS", "5"))       # first poll, then backoff
+VIDEO_JOB_MAX_POLL_SECONDS = float(os.environ.get("VIDEO_JOB_MAX_POLL_SECONDS", "20"))
+# Put the moov atom first so players can start before the whole file is in
+VIDEO_FASTSTART = os.environ.get("VIDEO_FASTSTART", "1") == "1"
+VIDEO_JOB_SSE_SECONDS = 5  # keep-alive / cross-process recheck interval for /jobs/<id>/events
+
+def _refund_video_job(job):
+    # Keyed, so a retry after an unclear failure (a timeout after the write) can't refund twice
+    credit_store.grant(job["user_id"], job["cost"], key=f"video-refund:{job['id']}")
+
+def _store_video(filename, path, job):
+    # The video was decoded into a temp file in STATIC_DIR, so storing it is a rename
+    if VIDEO_FASTSTART:
+        faststart(path)
+    storage.save_file(filename, path, owner=job["user_id"])
+
+_veo_token = os.environ.get("VEO_ACCESS_TOKEN")
+veo_client = VeoClient(VEO_API_BASE, "perseptra-468600", "us-central1", VEO_MODEL_ID,
+                       token_provider=(lambda: _veo_token) if _veo_token else None,
+                       poll_interval=VIDEO_JOB_POLL_SECONDS, max_poll_interval=VIDEO_JOB_MAX_POLL_SECONDS,
+                       max_concurrent=VIDEO_JOB_WORKERS)
+video_jobs = VideoJobQueue(
+    VideoJobStore(os.environ.get("VIDEO_JOBS_DB", os.path.join(BASE_DIR, "video_jobs.db"))),
+    veo_client,
+    output_dir=STATIC_DIR,
+    workers=VIDEO_JOB_WORKERS,
+    max_pending=VIDEO_JOB_QUEUE_MAX,
+    on_failed=_refund_video_job,
+    save_file=_store_video
+)
+if BACKGROUND_TASKS:
+    video_jobs.start()
+
+def _image_list(gen_result):
     # gen_result can be a list or an object with .images
     imgs = gen_result.images if hasattr(gen_result, "images") else gen_result
     if not imgs:
         raise RuntimeError("No images returned from Vertex AI")
+    return imgs
 
-    img = imgs[0]
-
+def _image_bytes(img):
+    """Be tolerant of SDK return shapes and attributes."""
     # Try common attributes
     for attr in ("_image_bytes", "image_bytes", "bytes", "data"):
         b = getattr(img, attr, None)
@@ -91,108 +668,49 @@ def _extract_first_image_bytes(gen_result):
 
     raise RuntimeError("Could not extract image bytes from model response")
 
-def check_and_deduct_credits(user_id, cost=1):
-    """Check if user has enough credits and deduct them"""
-    if not firebase_initialized:
-        # Fallback for testing - use simple file storage
-        import json
-        import os
-        
-        credits_file = "user_credits.json"
-        
-        # Load existing credits
-        if os.path.exists(credits_file):
-            with open(credits_file, 'r') as f:
-                credits_data = json.load(f)
-        else:
-            credits_data = {}
-        
-        current_credits = credits_data.get(user_id, 0)
-        
-        if current_credits < cost:
-            return False, current_credits
-        
-        # Deduct credits
-        new_balance = current_credits - cost
-        credits_data[user_id] = new_balance
-        
-        # Save back to file
-        with open(credits_file, 'w') as f:
-            json.dump(credits_data, f, indent=2)
-        
-        print(f"Credits deducted for user {user_id}: {cost} credits. New balance: {new_balance}")
-        return True, new_balance
-    
+def _extract_first_image_bytes(gen_result):
+    return _image_bytes(_image_list(gen_result)[0])
+
+def _extract_all_image_bytes(gen_result):
+    return [_image_bytes(img) for img in _image_list(gen_result)]
+
+def _unavailable(e):
+    """503 for a dependency that is down or refusing calls (credits already refunded)"""
+    retry_after = getattr(e, "retry_after", None)
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))} if retry_after else {}
+    return jsonify({"error": str(e)}), 503, headers
+
+def reserve_credits(user_id, cost=1):
+    """Reserve credits for one generation.
+
+    Returns (reservation, balance). `reservation` is None when the user can't pay.
+    Use the reservation as a context manager around the work so a failure refunds it.
+    """
     try:
-        # Get current credits
-        ref = db.reference(f'credits/{user_id}')
-        snapshot = ref.get()
-        
-        if snapshot is None:
-            # User doesn't exist, create with 0 credits
-            ref.set({'balance': 0})
-            return False, 0
-        
-        current_credits = snapshot.get('balance', 0)
-        
-        if current_credits < cost:
-            return False, current_credits
-        
-        # Deduct credits
-        new_balance = current_credits - cost
-        ref.update({'balance': new_balance})
-        
-        return True, new_balance
-        
-    except Exception as e:
-        print(f"Error checking/deducting credits: {e}")
-        return False, 0
+        with applog.stage("credit_check"):
+            reservation = credit_store.reserve(user_id, cost)
+    except InsufficientCredits as e:
+        return None, e.balance
+    except DependencyUnavailable:
+        raise
+    except Exception:
+        log.exception("Error checking/deducting credits", extra={"userId": user_id, "cost": cost})
+        return None, 0
+    
+    log.debug("Credits deducted", extra={"userId": user_id, "cost": cost, "balance": reservation.balance})
+    return reservation, reservation.balance
 
 def add_credits_to_user(user_id, amount):
     """Add credits to a user's account"""
     if not firebase_initialized:
-        # Fallback for testing - use simple file storage
-        import json
-        import os
-        
-        credits_file = "user_credits.json"
-        
-        # Load existing credits
-        if os.path.exists(credits_file):
-            with open(credits_file, 'r') as f:
-                credits_data = json.load(f)
-        else:
-            credits_data = {}
-        
-        current_credits = credits_data.get(user_id, 0)
-        new_balance = current_credits + amount
-        credits_data[user_id] = new_balance
-        
-        # Save back to file
-        with open(credits_file, 'w') as f:
-            json.dump(credits_data, f, indent=2)
-        
-        print(f"Credits added for user {user_id}: {amount} credits. New balance: {new_balance}")
+        # Fallback for testing - local SQLite ledger
+        new_balance = ledger.grant(user_id, amount)
+        log.info("Credits added", extra={"userId": user_id, "amount": amount, "balance": new_balance})
         return new_balance
     
-    try:
-        ref = db.reference(f'credits/{user_id}')
-        snapshot = ref.get()
-        
-        if snapshot is None:
-            # User doesn't exist, create with the amount
-            ref.set({'balance': amount})
-            return amount
-        else:
-            # Add to existing balance
-            current_credits = snapshot.get('balance', 0)
-            new_balance = current_credits + amount
-            ref.update({'balance': new_balance})
-            return new_balance
-            
-    except Exception as e:
-        print(f"Error adding credits: {e}")
-        return 0
+    # Errors propagate: /add-credits answers 500 and Stripe retries the webhook,
+    # rather than both reporting credits that were never added
+    return credit_store.grant(user_id, amount)
 
 @app.route("/", methods=["GET"])
 def root():
@@ -201,12 +719,107 @@ def root():
 
 @app.route("/html", methods=["GET"])
 def serve_html():
-    # Serve image.html from the SAME folder as index.py
-    return send_from_directory(BASE_DIR, "image.html")
+    # image.html from the SAME folder as index.py
+    return _send_page("image.html")
+
+@app.route("/<page>.html", methods=["GET"])
+def serve_page(page):
+    # The pages link to each other as index.html, video.html, ...
+    return _send_page(f"{page}.html")
 
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"ok": True, "firebase_initialized": firebase_initialized})
+    return jsonify({
+        "ok": True,
+        "ready": dependencies.ready(),
+        "dependencies": dependencies.status(),
+        "importSeconds": round(IMPORT_SECONDS, 3),
+        "firebase_initialized": firebase_initialized,
+        "singleFlight": single_flight.stats(),
+        "microBatch": micro_batcher.stats() if micro_batcher else None,
+        "storage": storage.stats(),
+        "derivatives": derivatives.stats() if derivatives else None,
+        "vertex": dict(vertex_guard.stats(), policy=vertex_policy.stats()),
+        "modelTiers": model_router.stats(),
+        "prewarm": prewarmer.stats() if prewarmer else None,
+        "profiler": profiler.stats() if profiler else None,
+        "rateLimits": rate_limiter.stats(),
+        "stripeEvents": stripe_events.stats(),
+        "pages": assets.stats(),
+        "logging": applog.stats()
+    })
+
+@app.route("/livez", methods=["GET"])
+def livez():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({"alive": True})
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """Readiness: every required cloud client is initialized"""
+    ready = dependencies.ready()
+    return jsonify({"ready": ready, "dependencies": dependencies.status()}), (200 if ready else 503)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    """Hit/miss counters for the /generate result cache"""
+    if result_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(result_cache.stats(), enabled=True,
+                        hitCost={tier.name: _cache_hit_cost(tier) for tier in model_router.tiers}))
+
+def _profiles_forbidden():
+    """403 response unless the request carries PROFILE_TOKEN as a Bearer token, else None"""
+    if not PROFILE_TOKEN or not _token_matches(request.headers.get("Authorization", ""), f"Bearer {PROFILE_TOKEN}"):
+        return jsonify({"error": "Profiles need a valid PROFILE_TOKEN"}), 403
+    return None
+
+@app.route("/profiles", methods=["GET"])
+def list_profiles():
+    """Recent request profiles, newest first (needs `Authorization: Bearer <PROFILE_TOKEN>`)"""
+    forbidden = _profiles_forbidden()
+    if forbidden:
+        return forbidden
+    profiles = profiler.store.list(request.args.get("limit", type=int)) if profiler else []
+    for meta in profiles:
+        meta["url"] = url_for("download_profile", profile_id=meta["id"])
+    return jsonify({"enabled": profiler is not None, "profiles": profiles})
+
+@app.route("/profiles/<profile_id>", methods=["GET"])
+def download_profile(profile_id):
+    """One profile as folded stacks (`flamegraph.pl <file> > profile.svg`)"""
+    forbidden = _profiles_forbidden()
+    if forbidden:
+        return forbidden
+    path = profiler.store.path(profile_id) if profiler else None
+    if path is None:
+        return jsonify({"error": "No such profile"}), 404
+    with open(path, "rb") as f:
+        return Response(f.read(), mimetype="text/plain", headers={
+            "Content-Disposition": f"attachment; filename={profile_id}.folded",
+            "Cache-Control": "no-store"
+        })
+
+@app.route("/prewarm-stats", methods=["GET"])
+def prewarm_stats():
+    """Hit rate, images and spend of the trending-prompt pre-warmer"""
+    if prewarmer is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(prewarmer.stats(), enabled=True))
+
+@app.route("/prewarm-stats/trending", methods=["GET"])
+def prewarm_trending():
+    """Most requested keys and their counts (needs `Authorization: Bearer <ADMIN_TOKEN>`)"""
+    if not ADMIN_TOKEN or not _token_matches(request.headers.get("Authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        return jsonify({"error": "Needs a valid ADMIN_TOKEN"}), 403
+    if prewarmer is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, "trending": prewarmer.trending(request.args.get("limit", 20, type=int))})
 
 @app.route("/test-claim", methods=["GET"])
 def test_claim():
@@ -234,6 +847,9 @@ def generate():
         data = request.get_json(silent=True) or {}
         prompt = (data.get("prompt") or "").strip()
         user_id = data.get("userId")
+        quality = data.get("quality")
+        # ?inline=1 returns the PNG bytes in the response instead of a URL
+        inline = request.args.get("inline") == "1"
         
         if not prompt:
             return jsonify({"error": "No prompt provided"}), 400
@@ -241,24 +857,54 @@ def generate():
         if not user_id:
             return jsonify({"error": "User ID required"}), 400
 
-        # Check and deduct credits
-        success, remaining_credits = check_and_deduct_credits(user_id, cost=1)
-        if not success:
+        if _bad_quality(quality):
+            return jsonify({"error": _bad_quality(quality)}), 400
+
+        limited = _rate_limited("generate", user_id)
+        if limited:
+            return limited
+
+        tier, tier_reason = _choose_tier(user_id, quality)
+
+        # IMPORTANT: Imagen 4.0 does NOT take a `size` argument.
+        gen_params = {"number_of_images": 1}
+
+        request_key = ResultCache.key(prompt, tier.model_id, gen_params)
+        if prewarmer is not None:
+            prewarmer.observe(request_key, (prompt, tier.name))
+
+        # Popular prompts are served straight from the result cache
+        cache_key = None
+        if result_cache is not None:
+            cache_key = request_key
+            cached_name = result_cache.get(cache_key)
+            if cached_name:
+                return _cached_generate_response(user_id, "cache/" + cached_name, tier, inline)
+
+        # Reserve credits; they are refunded if generation or the file write fails
+        reservation, remaining_credits = reserve_credits(user_id, cost=tier.credits)
+        if reservation is None:
             return jsonify({
-                "error": "Insufficient credits. You need 1 credit to generate an image.",
+                "error": _credits_message(tier.credits, "an image"),
                 "currentCredits": remaining_credits
             }), 402
 
-        # IMPORTANT: Imagen 4.0 does NOT take a `size` argument.
-        res = model.generate_images(prompt=prompt, number_of_images=1)
-
-        img_bytes = _extract_first_image_bytes(res)
+        if inline:
+            # Nothing is written to disk in inline mode
+            with reservation:
+                img_bytes = _extract_first_image_bytes(_generate_images(prompt, tier, **gen_params))
+            response = _inline_image_response(img_bytes, remaining_credits)
+            response.headers["X-Image-Tier"] = tier.name
+            return response
 
-        # Unique filename (ns timestamp)
-        filename = f"generated_{time.time_ns()}.png"
-        filepath = os.path.join(STATIC_DIR, filename)
-        with open(filepath, "wb") as f:
-            f.write(img_bytes)
+        # A trending prompt may have an image ready; otherwise wait on Imagen
+        filename = _take_prewarmed(request_key, user_id)
+        prewarmed = filename is not None
+        if prewarmed:
+            reservation.commit()
+        else:
+            with reservation:
+                filename = _generate_shared(user_id, request_key, prompt, gen_params, cache_key, tier)
 
         # Absolute URL (works even if image.html is opened via file://)
         absolute_url = request.host_url.rstrip("/") + url_for("static", filename=filename)
@@ -267,12 +913,178 @@ def generate():
             "filename": filename,
             "relative_url": f"/static/{filename}",
             "url": absolute_url,
-            "remainingCredits": remaining_credits
+            "remainingCredits": remaining_credits,
+            "tier": tier.name,
+            "degraded": tier_reason == "degraded",
+            "prewarmed": prewarmed
+        })
+
+    except DependencyUnavailable as e:
+        return _unavailable(e)
+
+    except Exception as e:
+        log.exception("Error in /generate")
+        return jsonify({"error": str(e)}), 500
+
+def _generate_shared(user_id, request_key, prompt, gen_params, cache_key=None, tier=None):
+    """One image file for /generate, sharing the Imagen call with identical requests in flight.
+
+    Each caller keeps its own reservation, so everyone is charged (or refunded) once.
+    """
+    tier = tier or model_router.default
+    if micro_batcher is not None and tier.max_images > 1:
+        # Near-simultaneous requests for this prompt become one multi-image call
+        filename = micro_batcher.submit(request_key, (prompt, gen_params, cache_key, tier))
+        storage.set_owner(filename, user_id)
+        return filename
+    # A shared image counts towards the quota of the caller that made it
+    filename, shared = single_flight.do(
+        request_key, lambda: _generate_image_file(prompt, gen_params, cache_key, user_id, tier))
+    return filename
+
+def _generate_image_file(prompt, gen_params, cache_key=None, owner=None, tier=None):
+    """Call Imagen, write the image into STATIC_DIR and return its filename"""
+    res = _generate_images(prompt, tier, **gen_params)
+
+    filename = _write_generated_image(_extract_first_image_bytes(res), owner)
+    if cache_key:
+        _cache_put(cache_key, filename)
+    return filename
+
+def _generate_image_batch(args, count):
+    """Micro-batch runner: one Imagen call for `count` waiting requests"""
+    prompt, gen_params, cache_key, tier = args
+    res = _generate_images(prompt, tier, **dict(gen_params, number_of_images=count))
+    filenames = [_write_generated_image(b) for b in _extract_all_image_bytes(res)]
+    if cache_key:
+        _cache_put(cache_key, filenames[0])
+    return filenames
+
+def _generate_batch_files(prompt, count, user_id, tier=None):
+    """Up to `count` image files from one Imagen call (fewer if some were filtered out)"""
+    res = _generate_images(prompt, tier, number_of_images=count)
+    return [_write_generated_image(b, user_id) for b in _extract_all_image_bytes(res)]
+
+def _write_generated_image(img_bytes, owner=None):
+    """Save image bytes into STATIC_DIR and return the filename"""
+    # Unique filename (ns timestamp); written atomically so it's never served half-done
+    filename = f"generated_{time.time_ns()}.png"
+    with applog.stage("file_write"):
+        storage.save(filename, img_bytes, owner=owner)
+    _queue_derivatives(filename)
+    return filename
+
+def _queue_derivatives(filename):
+    if derivatives is not None:
+        try:
+            derivatives.submit(storage.path(filename))
+        except Exception as e:
+            log.warning(f"Could not queue image derivatives: {e}")
+
+def _cache_put(cache_key, filename):
+    try:
+        result_cache.put(cache_key, storage.path(filename))
+    except Exception as e:
+        log.warning(f"Result cache write failed: {e}")
+
+def _inline_image_response(img_bytes, remaining_credits):
+    """PNG bytes for /generate?inline=1"""
+    return Response(img_bytes, mimetype="image/png", headers={
+        "Cache-Control": "no-store",
+        "X-Remaining-Credits": str(remaining_credits)
+    })
+
+def _cached_generate_response(user_id, filename, tier, inline=False):
+    """Build the /generate response for a result cache hit at `tier`"""
+    cost = _cache_hit_cost(tier)
+    if cost > 0:
+        reservation, remaining_credits = reserve_credits(user_id, cost=cost)
+        if reservation is None:
+            return jsonify({
+                "error": _credits_message(cost, "an image"),
+                "currentCredits": remaining_credits
+            }), 402
+        reservation.commit()
+    else:
+        remaining_credits = credit_store.balance(user_id)
+
+    if inline:
+        with open(storage.path(filename), "rb") as f:
+            return _inline_image_response(f.read(), remaining_credits)
+
+    absolute_url = request.host_url.rstrip("/") + url_for("static", filename=filename)
+    return jsonify({
+        "filename": filename,
+        "relative_url": f"/static/{filename}",
+        "url": absolute_url,
+        "remainingCredits": remaining_credits,
+        "tier": tier.name,
+        "cached": True
+    })
+
+@app.route("/generate-batch", methods=["POST"])
+def generate_batch():
+    """Generate several images for one prompt in a single Imagen call (1 credit per image)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        prompt = (data.get("prompt") or "").strip()
+        user_id = data.get("userId")
+        
+        if not prompt:
+            return jsonify({"error": "No prompt provided"}), 400
+        
+        if not user_id:
+            return jsonify({"error": "User ID required"}), 400
+
+        try:
+            count = int(data.get("count", IMAGEN_MAX_IMAGES))
+        except (TypeError, ValueError):
+            count = 0
+        if not 1 <= count <= IMAGEN_MAX_IMAGES:
+            return jsonify({"error": f"count must be between 1 and {IMAGEN_MAX_IMAGES}"}), 400
+
+        quality = data.get("quality")
+        if _bad_quality(quality):
+            return jsonify({"error": _bad_quality(quality)}), 400
+
+        # One Imagen call, so one request against the same limit as /generate
+        limited = _rate_limited("generate", user_id)
+        if limited:
+            return limited
+
+        tier, tier_reason = _choose_tier(user_id, quality, images=count)
+        reservation, remaining_credits = reserve_credits(user_id, cost=count * tier.credits)
+        if reservation is None:
+            return jsonify({
+                "error": _credits_message(count * tier.credits, f"{count} images"),
+                "currentCredits": remaining_credits
+            }), 402
+
+        with reservation:
+            filenames = _generate_batch_files(prompt, count, user_id, tier)
+            if len(filenames) < count:
+                # Some images were filtered out; only charge for what came back
+                reservation.reduce_to(len(filenames) * tier.credits)
+
+        host_url = request.host_url.rstrip("/")
+        return jsonify({
+            "images": [{
+                "filename": filename,
+                "relative_url": f"/static/{filename}",
+                "url": host_url + url_for("static", filename=filename)
+            } for filename in filenames],
+            "count": len(filenames),
+            "creditsCharged": reservation.cost,
+            "remainingCredits": reservation.balance,
+            "tier": tier.name,
+            "degraded": tier_reason == "degraded"
         })
 
+    except DependencyUnavailable as e:
+        return _unavailable(e)
+
     except Exception as e:
-        print("\n--- ERROR in /generate ---")
-        traceback.print_exc()
+        log.exception("Error in /generate-batch")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/generate-video", methods=["POST"])
@@ -290,47 +1102,101 @@ def generate_video():
         if not user_id:
             return jsonify({"error": "User ID required"}), 400
 
-        # Check and deduct credits (video costs 25 credits)
-        success, remaining_credits = check_and_deduct_credits(user_id, cost=25)
-        if not success:
+        # Validate everything before reserving: a bad field is a 400, not lost credits
+        try:
+            seconds = int(duration)
+        except (TypeError, ValueError, OverflowError):
+            return jsonify({"error": "duration must be a whole number of seconds"}), 400
+        if not isinstance(quality, str):
+            return jsonify({"error": "quality must be a string"}), 400
+
+        # Veo takes 4-8 second clips; "quality" picks the resolution
+        params = {
+            "durationSeconds": min(max(seconds, 4), 8),
+            "resolution": "1080p" if quality in ("fullhd", "1080p") else "720p",
+            "duration": duration,
+            "quality": quality
+        }
+
+        # Reserve credits (video costs 25 credits)
+        reservation, remaining_credits = reserve_credits(user_id, cost=25)
+        if reservation is None:
             return jsonify({
                 "error": "Insufficient credits. You need 25 credits to generate a video.",
                 "currentCredits": remaining_credits
             }), 402
 
-        # For now, simulate video generation with a placeholder
-        # In a real implementation, you would use a video generation API like Runway ML, Pika Labs, etc.
-        
-        # Create a placeholder video file (this is just for demonstration)
-        # In production, you would integrate with actual video generation services
-        
-        # Unique filename (ns timestamp)
-        filename = f"generated_video_{time.time_ns()}.mp4"
-        filepath = os.path.join(STATIC_DIR, filename)
-        
-        # Create a simple placeholder video file (this is just for demo purposes)
-        # In reality, you would call a video generation API here
-        with open(filepath, "wb") as f:
-            # Write a minimal MP4 header (this is just a placeholder)
-            f.write(b'\x00\x00\x00\x20ftypmp42')
-        
-        # Absolute URL
-        absolute_url = request.host_url.rstrip("/") + url_for("static", filename=filename)
+        # Queue the job; the credits are refunded if the job fails later on
+        try:
+            with reservation:
+                job_id = video_jobs.submit(user_id, prompt, params, cost=25)
+        except JobQueueFull as e:
+            return jsonify({"error": str(e), "currentCredits": reservation.balance}), 503
 
-        return jsonify({
-            "filename": filename,
-            "relative_url": f"/static/{filename}",
-            "url": absolute_url,
-            "remainingCredits": remaining_credits,
-            "duration": duration,
-            "quality": quality
-        })
+        job = _video_job_json(video_jobs.get(job_id))
+        job["remainingCredits"] = remaining_credits
+        return jsonify(job), 202
+
+    except DependencyUnavailable as e:
+        return _unavailable(e)
 
     except Exception as e:
-        print("\n--- ERROR in /generate-video ---")
-        traceback.print_exc()
+        log.exception("Error in /generate-video")
         return jsonify({"error": str(e)}), 500
 
+def _video_job_json(job):
+    """Public view of a video job row"""
+    result = {
+        "jobId": job["id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "polls": job["polls"],
+        "createdAt": job["created_at"],
+        "updatedAt": job["updated_at"],
+        "duration": job["params"].get("duration"),
+        "quality": job["params"].get("quality"),
+        "statusUrl": url_for("get_job", job_id=job["id"]),
+        "eventsUrl": url_for("job_events", job_id=job["id"])
+    }
+    if job["status"] == "succeeded":
+        filename = job["filename"]
+        result["filename"] = filename
+        result["relative_url"] = f"/static/{filename}"
+        result["url"] = request.host_url.rstrip("/") + url_for("static", filename=filename)
+    if job["status"] == "failed":
+        result["error"] = job["error"]
+    return result
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Status of a video generation job"""
+    job = video_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(_video_job_json(job))
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """Server-sent events stream of a video job's progress, ending with its final state"""
+    if video_jobs.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def stream():
+        last_update = None
+        while True:
+            job = video_jobs.get(job_id)
+            if job["updated_at"] != last_update:
+                last_update = job["updated_at"]
+                yield f"data: {json.dumps(_video_job_json(job))}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            if job["status"] in TERMINAL_STATES:
+                return
+            video_jobs.wait_for_change(timeout=VIDEO_JOB_SSE_SECONDS)
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/add-credits", methods=["POST"])
 def add_credits():
     """Add credits to a user (for testing purposes)"""
@@ -351,45 +1217,129 @@ def add_credits():
         })
         
     except Exception as e:
-        print(f"Error adding credits: {e}")
+        log.exception("Error adding credits", extra={"userId": user_id})
         return jsonify({"error": str(e)}), 500
 
+def _bulk_forbidden():
+    """403 response unless the request carries BULK_CREDITS_TOKEN, else None"""
+    expected = f"Bearer {BULK_CREDITS_TOKEN}".encode()
+    given = request.headers.get("Authorization", "").encode()
+    if not BULK_CREDITS_TOKEN or not hmac.compare_digest(given, expected):
+        return jsonify({"error": "Bulk credit operations need a valid BULK_CREDITS_TOKEN"}), 403
+    return None
+
+def _bulk_items(needs_amount):
+    """(item, None) or (None, error result) for each NDJSON line of the request body"""
+    # request.stream is unbuffered: reading lines from it directly reads a byte at a time
+    for number, line in enumerate(io.BufferedReader(request.stream, 64 * 1024), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        if not isinstance(item, dict):
+            yield None, {"line": number, "status": "invalid", "error": "Not a JSON object"}
+            continue
+        user_id, amount = item.get("userId"), item.get("amount")
+        if not isinstance(user_id, str) or not USER_ID.match(user_id):
+            yield None, {"line": number, "userId": user_id, "status": "invalid", "error": "Bad userId"}
+        elif needs_amount and (type(amount) is not int or amount <= 0):
+            yield None, {"line": number, "userId": user_id, "status": "invalid",
+                         "error": "amount must be a positive integer"}
+        else:
+            yield item, None
+
+def _bulk_response(process, needs_amount, action):
+    """Stream process(chunk) -> results for each chunk of valid items, then a summary"""
+    def stream():
+        started = time.perf_counter()
+        counts = {}
+        chunk = []
+
+        def flush():
+            results = process(chunk)
+            chunk.clear()
+            return results
+
+        def lines(results):
+            for result in results:
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+            return "".join(json.dumps(result) + "\n" for result in results)
+
+        for item, invalid in _bulk_items(needs_amount):
+            if invalid is not None:
+                yield lines([invalid])
+                continue
+            chunk.append(item)
+            if len(chunk) >= BULK_CREDITS_CHUNK:
+                yield lines(flush())
+        if chunk:
+            yield lines(flush())
+        summary = dict(counts, seconds=round(time.perf_counter() - started, 3))
+        log.info(f"Bulk credit {action} finished", extra=summary)
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
+
+def _grant_chunk(chunk, read_back):
+    try:
+        balances = credit_store.grant_many(((item["userId"], item["amount"]) for item in chunk), read_back)
+    except GrantOutcomeUnknown as e:
+        # A timeout or dropped connection may come after Firebase applied the update:
+        # retrying could grant twice, so the caller has to check the balances first
+        log.exception("Bulk grant chunk outcome unknown", extra={"users": len(chunk)})
+        return [{"userId": item["userId"], "amount": item["amount"], "status": "unknown", "error": str(e)}
+                for item in chunk]
+    except Exception as e:
+        # Rejected (or the ledger transaction rolled back): nothing was applied, safe to retry
+        log.exception("Bulk grant chunk failed", extra={"users": len(chunk)})
+        return [{"userId": item["userId"], "amount": item["amount"], "status": "failed", "error": str(e)}
+                for item in chunk]
+    results = []
+    for item in chunk:
+        result = {"userId": item["userId"], "amount": item["amount"], "status": "granted"}
+        if balances.get(item["userId"]) is not None:
+            result["balance"] = balances[item["userId"]]
+        results.append(result)
+    return results
+
+def _read_chunk(chunk):
+    try:
+        balances = credit_store.balances(item["userId"] for item in chunk)
+    except Exception as e:
+        log.exception("Bulk read chunk failed", extra={"users": len(chunk)})
+        return [{"userId": item["userId"], "status": "failed", "error": str(e)} for item in chunk]
+    return [{"userId": item["userId"], "status": "ok", "balance": balances[item["userId"]]} for item in chunk]
+
+@app.route("/bulk-credits/grant", methods=["POST"])
+def bulk_grant_credits():
+    """Grant credits to many users: NDJSON {"userId", "amount"} lines in, a result per line out"""
+    # New balances cost a read per user in Firebase mode, so they're opt-in (?balances=1);
+    # the local ledger returns them with the writes anyway
+    read_back = request.args.get("balances") == "1"
+    return _bulk_forbidden() or _bulk_response(lambda chunk: _grant_chunk(chunk, read_back), True, "grant")
+
+@app.route("/bulk-credits/read", methods=["POST"])
+def bulk_read_credits():
+    """Balances of many users: NDJSON {"userId"} lines in, {"userId", "balance"} lines out"""
+    return _bulk_forbidden() or _bulk_response(_read_chunk, False, "read")
+
 @app.route("/get-credits/<user_id>", methods=["GET"])
 def get_credits(user_id):
     """Get current credit balance for a user"""
     try:
         if not firebase_initialized:
-            # Fallback for testing - use simple file storage
-            import json
-            import os
+            # Fallback for testing - local SQLite ledger
             from datetime import datetime
             
-            credits_file = "user_credits.json"
-            claims_file = "daily_claims.json"
-            
-            # Load existing credits
-            if os.path.exists(credits_file):
-                with open(credits_file, 'r') as f:
-                    credits_data = json.load(f)
-            else:
-                credits_data = {}
-            
-            # Load daily claims
-            if os.path.exists(claims_file):
-                with open(claims_file, 'r') as f:
-                    claims_data = json.load(f)
-            else:
-                claims_data = {}
-            
-            balance = credits_data.get(user_id, 0)
-            last_claim_date = claims_data.get(user_id)
+            balance, last_claim_date = ledger.get(user_id)
             
             # Check if user can claim daily credits
             today = datetime.now().strftime("%Y-%m-%d")
             can_claim_daily = last_claim_date != today
             
-            print(f"User {user_id} balance: {balance}, can claim daily: {can_claim_daily}")
-            
             return jsonify({
                 "balance": balance,
                 "canClaimDaily": can_claim_daily,
@@ -417,118 +1367,61 @@ def get_credits(user_id):
         })
         
     except Exception as e:
-        print(f"Error getting credits: {e}")
+        log.exception("Error getting credits", extra={"userId": user_id})
         return jsonify({"error": str(e)}), 500
 
 @app.route("/claim-daily-credits", methods=["POST"])
 def claim_daily_credits():
     """Claim daily free credits (15 credits per day)"""
     try:
-        print("Claim daily credits endpoint called")
         data = request.get_json(silent=True) or {}
-        print("Request data:", data)
         user_id = data.get("userId")
         
         if not user_id:
-            print("No user ID provided")
             return jsonify({"error": "User ID required"}), 400
         
-        print(f"Processing claim for user: {user_id}")
+        limited = _rate_limited("claim-daily", user_id)
+        if limited:
+            return limited
         
         if not firebase_initialized:
-            # Fallback for testing - use simple file storage
-            import json
-            import os
+            # Fallback for testing - local SQLite ledger
             from datetime import datetime
             
-            credits_file = "user_credits.json"
-            claims_file = "daily_claims.json"
-            
-            # Load existing credits
-            if os.path.exists(credits_file):
-                with open(credits_file, 'r') as f:
-                    credits_data = json.load(f)
-            else:
-                credits_data = {}
-            
-            # Load daily claims
-            if os.path.exists(claims_file):
-                with open(claims_file, 'r') as f:
-                    claims_data = json.load(f)
-            else:
-                claims_data = {}
-            
-            # Check if user has already claimed today
+            # Check-and-claim happens in one statement, so a double submit can't claim twice
             today = datetime.now().strftime("%Y-%m-%d")
-            last_claim_date = claims_data.get(user_id)
+            claimed, new_balance = ledger.claim_daily(user_id, 15, today)
             
-            if last_claim_date == today:
-                current_balance = credits_data.get(user_id, 0)
+            if not claimed:
                 return jsonify({
                     "error": "You have already claimed your daily credits today. Come back tomorrow!",
-                    "currentBalance": current_balance
+                    "currentBalance": new_balance
                 }), 400
             
-            # Add daily credits
-            current_balance = credits_data.get(user_id, 0)
-            new_balance = current_balance + 15
-            credits_data[user_id] = new_balance
-            claims_data[user_id] = today
-            
-            # Save back to files
-            with open(credits_file, 'w') as f:
-                json.dump(credits_data, f, indent=2)
-            with open(claims_file, 'w') as f:
-                json.dump(claims_data, f, indent=2)
-            
-            print(f"Daily credits claimed for user {user_id}: +15 credits. New balance: {new_balance}")
+            log.debug("Daily credits claimed", extra={"userId": user_id, "balance": new_balance})
             
-            response_data = {
+            return jsonify({
                 "success": True,
                 "creditsAdded": 15,
                 "newBalance": new_balance,
                 "message": "Daily credits claimed successfully! (File Mode)"
-            }
-            print("Returning response:", response_data)
-            return jsonify(response_data)
+            })
         
         # Get current date in YYYY-MM-DD format
         from datetime import datetime
         today = datetime.now().strftime("%Y-%m-%d")
         
-        # Check if user has already claimed today
-        ref = db.reference(f'credits/{user_id}')
-        snapshot = ref.get()
-        
-        if snapshot is None:
-            # User doesn't exist, create with daily credits
-            ref.set({
-                'balance': 15,
-                'lastClaimDate': today
-            })
-            return jsonify({
-                "success": True,
-                "creditsAdded": 15,
-                "newBalance": 15,
-                "message": "Daily credits claimed successfully!"
-            })
-        
-        last_claim_date = snapshot.get('lastClaimDate')
-        current_balance = snapshot.get('balance', 0)
+        # Check-and-claim is one conditional write, so it can't overwrite a
+        # concurrent deduct or grant (or claim twice)
+        claimed, new_balance = credit_store.claim_daily(user_id, 15, today)
         
-        if last_claim_date == today:
+        if not claimed:
             return jsonify({
                 "error": "You have already claimed your daily credits today. Come back tomorrow!",
-                "currentBalance": current_balance
+                "currentBalance": new_balance
             }), 400
         
-        # Add daily credits
-        new_balance = current_balance + 15
-        ref.update({
-            'balance': new_balance,
-            'lastClaimDate': today
-        })
-        
+        log.debug("Daily credits claimed", extra={"userId": user_id, "balance": new_balance})
         return jsonify({
             "success": True,
             "creditsAdded": 15,
@@ -537,9 +1430,7 @@ def claim_daily_credits():
         })
         
     except Exception as e:
-        print(f"Error claiming daily credits: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Error claiming daily credits")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/create-checkout-session", methods=["POST"])
@@ -553,14 +1444,7 @@ def create_checkout_session():
         if not plan or not user_id:
             return jsonify({"error": "Missing plan or userId"}), 400
         
-        # Map plan names to Stripe price IDs
-        plan_to_price = {
-            'starter': 'price_starter',  # Replace with your actual Stripe price ID
-            'pro': 'price_pro',          # Replace with your actual Stripe price ID
-            'enterprise': 'price_enterprise'  # Replace with your actual Stripe price ID
-        }
-        
-        price_id = plan_to_price.get(plan)
+        price_id = PLAN_PRICES.get(plan)
         if not price_id:
             return jsonify({"error": "Invalid plan"}), 400
         
@@ -576,7 +1460,8 @@ def create_checkout_session():
             cancel_url='http://127.0.0.1:5000/pricing.html?canceled=true',
             metadata={
                 'user_id': user_id,
-                'plan': plan
+                'plan': plan,
+                'price_id': price_id  # lets the webhook credit the plan without another API call
             }
         )
         
@@ -586,21 +1471,19 @@ def create_checkout_session():
         })
         
     except Exception as e:
-        print(f"Error creating checkout session: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Error creating checkout session")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/stripe-webhook", methods=["POST"])
 def stripe_webhook():
-    """Handle Stripe webhook events for successful payments"""
+    """Verify a Stripe webhook event and queue it; credits are granted in the background"""
     try:
         # Get the webhook payload
         payload = request.get_data()
         sig_header = request.headers.get('Stripe-Signature')
         
         if not sig_header:
-            print("No Stripe signature found")
+            log.warning("Stripe webhook without a signature")
             return jsonify({"error": "No signature"}), 400
         
         try:
@@ -609,67 +1492,36 @@ def stripe_webhook():
                 payload, sig_header, STRIPE_WEBHOOK_SECRET
             )
         except ValueError as e:
-            print(f"Invalid payload: {e}")
+            log.warning(f"Invalid Stripe webhook payload: {e}")
             return jsonify({"error": "Invalid payload"}), 400
         except stripe.error.SignatureVerificationError as e:
-            print(f"Invalid signature: {e}")
+            log.warning(f"Invalid Stripe webhook signature: {e}")
             return jsonify({"error": "Invalid signature"}), 400
         
-        # Handle the event
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            
-            # Extract user ID from metadata
-            user_id = session.get('metadata', {}).get('user_id')
-            if not user_id:
-                print("No user_id found in session metadata")
-                return jsonify({"error": "No user_id"}), 400
-            
-            # Determine which plan was purchased
-            line_items = stripe.checkout.Session.list_line_items(session['id'])
-            if not line_items.data:
-                print("No line items found in session")
-                return jsonify({"error": "No line items"}), 400
-            
-            # Get the price ID from the first line item
-            price_id = line_items.data[0].price.id
-            
-            # Find the plan configuration
-            plan_config = None
-            for plan_id, config in STRIPE_PLANS.items():
-                if plan_id == price_id:
-                    plan_config = config
-                    break
-            
-            if not plan_config:
-                print(f"Unknown price ID: {price_id}")
-                return jsonify({"error": "Unknown plan"}), 400
-            
-            # Add credits to user's account
-            credits_to_add = plan_config['credits']
-            new_balance = add_credits_to_user(user_id, credits_to_add)
-            
-            print(f"Payment successful! Added {credits_to_add} credits to user {user_id}. New balance: {new_balance}")
-            
-            return jsonify({
-                "success": True,
-                "message": f"Added {credits_to_add} credits to user {user_id}",
-                "new_balance": new_balance
-            })
-        
-        elif event['type'] == 'payment_intent.succeeded':
-            print("Payment intent succeeded")
-            return jsonify({"success": True})
-        
-        else:
-            print(f"Unhandled event type: {event['type']}")
-            return jsonify({"success": True})
+        # Store it and answer straight away; a worker applies it (see stripe_events)
+        if stripe_events.handles(event['type']):
+            queued = stripe_events.submit(event['id'], event['type'], payload.decode('utf-8'))
+            if not queued:
+                log.debug("Duplicate Stripe event", extra={"eventId": event['id']})
+            return jsonify({"received": True, "duplicate": not queued})
+
+        log.debug(f"Unhandled Stripe event type: {event['type']}")
+        return jsonify({"received": True})
             
     except Exception as e:
-        print(f"Webhook error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Stripe webhook error")
         return jsonify({"error": str(e)}), 500
 
+# ---- Startup ----
+# Warm the cloud clients up in the background (WARM_UP=0 leaves them fully lazy)
+if BACKGROUND_TASKS and os.environ.get("WARM_UP", "1") == "1":
+    dependencies.warm_up()
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+IMPORT_TIME_BUDGET_MS = int(os.environ.get("IMPORT_TIME_BUDGET_MS", "1500"))
+log.info(f"index.py imported in {IMPORT_SECONDS * 1000:.0f} ms")
+if IMPORT_SECONDS * 1000 > IMPORT_TIME_BUDGET_MS:
+    log.warning(f"Import took longer than the {IMPORT_TIME_BUDGET_MS} ms budget")
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
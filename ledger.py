@@ -0,0 +1,235 @@
+# ledger.py
+"""Local credit ledger (SQLite, WAL mode) used when Firebase is not available.
+
+One row per user holding the balance, the last daily-claim date and the
+plan last bought. Every
+deduct / grant / claim is a single conditional statement, so concurrent
+requests can't overwrite each other and each call costs one indexed row
+lookup no matter how many users are stored. A grant with a key (a payment's
+event id) also records the key, in the same transaction, so it is applied
+at most once.
+
+One-shot import of the old JSON files:
+
+    python ledger.py import [user_credits.json] [daily_claims.json]
+"""
+import os
+import sys
+import json
+import sqlite3
+import logging
+import threading
+
+MAX_SQL_VARIABLES = 500   # "?" per statement; older SQLite builds allow 999
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id          TEXT PRIMARY KEY,
+    balance          INTEGER NOT NULL DEFAULT 0,
+    last_claim_date  TEXT,
+    plan             TEXT
+) WITHOUT ROWID
+"""
+
+GRANTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS grants (
+    grant_key   TEXT PRIMARY KEY,
+    user_id     TEXT NOT NULL,
+    amount      INTEGER NOT NULL
+) WITHOUT ROWID
+"""
+
+
+class CreditLedger:
+    """Thread-safe credit ledger. Each thread gets its own connection."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(SCHEMA)
+        self._conn().execute(GRANTS_SCHEMA)
+        columns = [row[1] for row in self._conn().execute("PRAGMA table_info(users)")]
+        if "plan" not in columns:
+            # Ledgers created before plans were recorded
+            self._conn().execute("ALTER TABLE users ADD COLUMN plan TEXT")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None -> autocommit, every statement is its own transaction
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id):
+        """Return (balance, last_claim_date). Unknown users have (0, None)."""
+        row = self._conn().execute(
+            "SELECT balance, last_claim_date FROM users WHERE user_id = ?",
+            (user_id,)).fetchone()
+        if row is None:
+            return 0, None
+        return row[0], row[1]
+
+    def get_balance(self, user_id):
+        return self.get(user_id)[0]
+
+    def deduct(self, user_id, cost):
+        """Atomically take `cost` credits. Returns (success, balance)."""
+        row = self._conn().execute(
+            "UPDATE users SET balance = balance - ? "
+            "WHERE user_id = ? AND balance >= ? RETURNING balance",
+            (cost, user_id, cost)).fetchone()
+        if row is None:
+            return False, self.get_balance(user_id)
+        return True, row[0]
+
+    def get_plan(self, user_id):
+        row = self._conn().execute("SELECT plan FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def grant(self, user_id, amount, key=None, plan=None):
+        """Atomically add `amount` credits (creating the user). Returns the new balance.
+
+        With a `key`, only the first grant with that key adds anything; repeats
+        return the current balance. A `plan` (the one just bought) is recorded
+        along with the credits.
+        """
+        conn = self._conn()
+        if key is None and plan is None:
+            return self._add(conn, user_id, amount)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            first = key is None or conn.execute(
+                "INSERT INTO grants (grant_key, user_id, amount) VALUES (?, ?, ?) "
+                "ON CONFLICT(grant_key) DO NOTHING",
+                (key, user_id, amount)).rowcount == 1
+            if first:
+                balance = self._add(conn, user_id, amount)
+                if plan is not None:
+                    conn.execute("UPDATE users SET plan = ? WHERE user_id = ?", (plan, user_id))
+            else:
+                balance = self.get_balance(user_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return balance
+
+    def grant_many(self, grants):
+        """Add credits to many users in one transaction. Returns {user_id: new balance}.
+
+        `grants` is an iterable of (user_id, amount); all of them are applied or none.
+        """
+        conn = self._conn()
+        balances = {}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for user_id, amount in grants:
+                balances[user_id] = self._add(conn, user_id, amount)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return balances
+
+    def balances(self, user_ids):
+        """{user_id: balance} for many users (unknown users have 0)."""
+        user_ids = list(dict.fromkeys(user_ids))
+        balances = dict.fromkeys(user_ids, 0)
+        conn = self._conn()
+        for start in range(0, len(user_ids), MAX_SQL_VARIABLES):
+            batch = user_ids[start:start + MAX_SQL_VARIABLES]
+            rows = conn.execute(
+                f"SELECT user_id, balance FROM users WHERE user_id IN ({','.join('?' * len(batch))})",
+                batch)
+            balances.update(rows)
+        return balances
+
+    @staticmethod
+    def _add(conn, user_id, amount):
+        row = conn.execute(
+            "INSERT INTO users (user_id, balance) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance "
+            "RETURNING balance",
+            (user_id, amount)).fetchone()
+        return row[0]
+
+    def claim_daily(self, user_id, amount, today):
+        """Grant the daily credits once per `today`. Returns (claimed, balance)."""
+        row = self._conn().execute(
+            "INSERT INTO users (user_id, balance, last_claim_date) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET "
+            "balance = balance + excluded.balance, "
+            "last_claim_date = excluded.last_claim_date "
+            "WHERE users.last_claim_date IS NOT excluded.last_claim_date "
+            "RETURNING balance",
+            (user_id, amount, today)).fetchone()
+        if row is None:
+            return False, self.get_balance(user_id)
+        return True, row[0]
+
+    def count_users(self):
+        return self._conn().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def import_json(self, credits_file, claims_file=None):
+        """Load the legacy user_credits.json / daily_claims.json into the ledger.
+
+        Balances and claim dates from the files overwrite what is stored.
+        Returns the number of users imported.
+        """
+        credits_data = _load_json(credits_file)
+        claims_data = _load_json(claims_file) if claims_file else {}
+
+        rows = []
+        for user_id in set(credits_data) | set(claims_data):
+            rows.append((user_id, int(credits_data.get(user_id, 0)), claims_data.get(user_id)))
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO users (user_id, balance, last_claim_date) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "balance = excluded.balance, last_claim_date = excluded.last_claim_date",
+                rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+
+def _load_json(path):
+    if path and os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def open_ledger(path, credits_file=None, claims_file=None):
+    """Open the ledger at `path`. On first creation, import the legacy JSON files."""
+    is_new = not os.path.exists(path)
+    ledger = CreditLedger(path)
+    if is_new and credits_file and os.path.exists(credits_file):
+        count = ledger.import_json(credits_file, claims_file)
+        log.info(f"Imported {count} users from {credits_file} into {path}")
+    return ledger
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("Usage: python ledger.py import [user_credits.json] [daily_claims.json]")
+        sys.exit(1)
+
+    credits_file = sys.argv[2] if len(sys.argv) > 2 else os.path.join(base_dir, "user_credits.json")
+    claims_file = sys.argv[3] if len(sys.argv) > 3 else os.path.join(base_dir, "daily_claims.json")
+    ledger = CreditLedger(os.environ.get("CREDITS_DB", os.path.join(base_dir, "credits.db")))
+    count = ledger.import_json(credits_file, claims_file)
+    print(f"Imported {count} users into {ledger.path}")
@@ -0,0 +1,318 @@
+# metrics.py
+"""In-process metrics, exported in the Prometheus text format by /metrics.
+
+    REQUESTS = metrics.counter("http_requests_total", "Requests", ("route", "status"))
+    REQUESTS.inc(route="/generate", status="200")
+
+    with metrics.timed("vertex", "generate_images"):
+        ...
+
+Updates never take a lock: every thread adds into its own dict, and the
+dicts are summed when /metrics is scraped. A thread's values are folded into
+a shared total once it exits, at the next scrape or when enough new threads
+have registered, so thread-per-request servers don't pile up dead shards.
+Histograms also export estimated p50/p90/p99 as a `<name>_quantile` gauge so
+they can be read without PromQL.
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.9, 0.99)
+MIN_RETIRE_AT = 64
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._local = threading.local()
+        self._shards = []      # (thread, dict) for every thread that recorded something
+        self._retired = {}     # totals from threads that have exited
+        self._retire_at = MIN_RETIRE_AT   # fold dead shards once this many are registered
+        self._lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+                if len(self._shards) >= self._retire_at:
+                    self._retire_dead()
+        return shard
+
+    def _retire_dead(self):
+        """Fold the shards of exited threads into _retired. Caller holds _lock."""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                # Its shard can't change any more; keep the values, drop the dict
+                for key, value in _snapshot(shard):
+                    self._retired[key] = self._retired.get(key, 0) + value
+        self._shards = live
+        # Doubling keeps the scans amortized O(1) per new thread
+        self._retire_at = max(MIN_RETIRE_AT, 2 * len(live))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        """Sum of every thread's values: {(metric name, labels): value}."""
+        with self._lock:
+            self._retire_dead()
+            totals = dict(self._retired)
+            for thread, shard in self._shards:
+                for key, value in _snapshot(shard):
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self):
+        by_name = {}
+        for (name, labels), value in self.collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for metric in self.metrics:
+            series = sorted(by_name.get(metric.name, ()), key=lambda item: repr(item[0]))
+            lines.extend(metric.render(series))
+        return "\n".join(lines) + "\n"
+
+
+def _snapshot(shard):
+    # The owning thread may add a key while we copy; just try again
+    while True:
+        try:
+            return list(shard.items())
+        except RuntimeError:
+            continue
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def _labels(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def _series(self, totals):
+        return [(labels, value) for (name, labels), value in totals.items() if name == self.name]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self.registry.shard()
+        key = (self.name, self._labels(labels))
+        shard[key] = shard.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.registry.collect().get((self.name, self._labels(labels)), 0)
+
+    def render(self, series):
+        lines = self._header()
+        for labels, value in series:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    """Up/down value. Per-thread parts add up because each inc has its dec in the same thread."""
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self.registry.shard()
+        key = self._labels(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        for part, amount in (((i,), 1), (("count",), 1), (("sum",), value)):
+            k = (self.name, key + part)
+            shard[k] = shard.get(k, 0) + amount
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _grouped(self, series):
+        n = len(self.labelnames)
+        grouped = {}
+        for labels, value in series:
+            grouped.setdefault(labels[:n], {})[labels[n]] = value
+        return grouped
+
+    def quantiles(self, **labels):
+        series = self._series(self.registry.collect())
+        parts = self._grouped(series).get(self._labels(labels), {})
+        return {q: _estimate(self.buckets, parts, q) for q in QUANTILES}
+
+    def render(self, series):
+        lines = self._header()
+        quantile_lines = []
+        for labels, parts in self._grouped(series).items():
+            cumulative = 0
+            for i, bound in enumerate(self.buckets + (float("inf"),)):
+                cumulative += parts.get(i, 0)
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{self.name}_bucket"
+                             f"{_format_labels(self.labelnames + ('le',), labels + (le,))} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_number(parts.get('sum', 0))}")
+            lines.append(f"{self.name}_count{label_text} {parts.get('count', 0)}")
+            for q in QUANTILES:
+                quantile_lines.append(
+                    f"{self.name}_quantile"
+                    f"{_format_labels(self.labelnames + ('quantile',), labels + (str(q),))} "
+                    f"{_number(_estimate(self.buckets, parts, q))}")
+        if quantile_lines:
+            lines.append(f"# HELP {self.name}_quantile Estimated from {self.name} buckets")
+            lines.append(f"# TYPE {self.name}_quantile gauge")
+            lines.extend(quantile_lines)
+        return lines
+
+
+def _estimate(buckets, parts, q):
+    """Quantile by linear interpolation inside the bucket, like histogram_quantile()."""
+    count = parts.get("count", 0)
+    if not count:
+        return 0.0
+    rank = q * count
+    cumulative = 0
+    lower = 0.0
+    for i, upper in enumerate(buckets):
+        in_bucket = parts.get(i, 0)
+        if cumulative + in_bucket >= rank and in_bucket:
+            return lower + (upper - lower) * (rank - cumulative) / in_bucket
+        cumulative += in_bucket
+        lower = upper
+    return buckets[-1]  # in the +Inf bucket: the largest finite bound is all we know
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+# ---- Default registry and the metrics shared across modules ----
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return Counter(REGISTRY, name, help, labelnames)
+
+
+def gauge(name, help, labelnames=()):
+    return Gauge(REGISTRY, name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return Histogram(REGISTRY, name, help, labelnames, buckets)
+
+
+DEPENDENCY_SECONDS = histogram("dependency_call_seconds", "Time spent in calls to external dependencies",
+                               ("dependency", "operation"))
+DEPENDENCY_ERRORS = counter("dependency_errors_total", "Dependency calls that raised",
+                            ("dependency", "operation"))
+
+
+@contextmanager
+def timed(dependency, operation):
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        DEPENDENCY_ERRORS.inc(dependency=dependency, operation=operation)
+        raise
+    finally:
+        DEPENDENCY_SECONDS.observe(time.perf_counter() - started,
+                                   dependency=dependency, operation=operation)
+
+
+class Timed:
+    """Proxy that times the named methods of a client.
+
+    `chained` attributes return another Timed proxy, so calls further down are
+    timed too, e.g. Timed(db, "firebase", timed=("get", "update"), chained=("reference",))
+    times db.reference(path).get().
+    """
+
+    def __init__(self, target, dependency, timed=(), chained=()):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_dependency", dependency)
+        object.__setattr__(self, "_timed", frozenset(timed))
+        object.__setattr__(self, "_chained", frozenset(chained))
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name in self._timed:
+            return _timed_call(value, self._dependency, name)
+        if name in self._chained:
+            if callable(value) and not isinstance(value, type):
+                return _chained_call(value, self)
+            return Timed(value, self._dependency, self._timed, self._chained)
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def __repr__(self):
+        return f"<timed {self._dependency} {self._target!r}>"
+
+
+def _timed_call(fn, dependency, operation):
+    def call(*args, **kwargs):
+        with timed(dependency, operation):
+            return fn(*args, **kwargs)
+    return call
+
+
+def _chained_call(fn, parent):
+    def call(*args, **kwargs):
+        return Timed(fn(*args, **kwargs), parent._dependency, parent._timed, parent._chained)
+    return call
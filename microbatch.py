@@ -0,0 +1,83 @@
+# microbatch.py
+"""Merge near-simultaneous requests for the same thing into one batched call.
+
+    batcher = MicroBatcher(run_batch, window=0.05, max_batch=4)
+    result = batcher.submit(key, args)
+
+The first caller for `key` opens a batch and waits up to `window` seconds (or
+until `max_batch` callers have joined), then calls run_batch(args, n) once.
+run_batch must return a list; caller i gets item i. Callers left without an
+item (the upstream returned fewer than asked for) get ShortBatch, and an
+exception from run_batch is raised in every caller of that batch.
+"""
+import threading
+
+
+class ShortBatch(Exception):
+    """The batched call returned fewer results than there were callers."""
+
+
+class _Batch:
+    def __init__(self, args):
+        self.args = args
+        self.size = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class MicroBatcher:
+    def __init__(self, run_batch, window=0.05, max_batch=4):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0      # upstream calls made
+        self.requests = 0     # callers served
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, args):
+        with self._lock:
+            self.requests += 1
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch(args)
+            slot = batch.size
+            batch.size += 1
+            if batch.size >= self.max_batch:
+                # Full: nobody else may join, the leader can go now
+                del self._open[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+                self.batches += 1
+            try:
+                batch.results = list(self.run_batch(batch.args, batch.size))
+            except BaseException as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        if slot >= len(batch.results):
+            raise ShortBatch(f"Batch returned {len(batch.results)} results for {batch.size} requests")
+        return batch.results[slot]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "windowMs": int(self.window * 1000),
+                "maxBatch": self.max_batch,
+                "requests": self.requests,
+                "upstreamCalls": self.batches,
+                "saved": self.requests - self.batches,
+            }
@@ -0,0 +1,133 @@
+# model_router.py
+"""Pick an Imagen model tier (fast / standard / ultra) for each request.
+
+    router = ModelRouter([Tier("fast", fast_model, "imagen-4.0-fast-generate-001", usd_per_image=0.02),
+                          Tier("standard", model, "imagen-4.0-generate-001", usd_per_image=0.04)],
+                         load=vertex_guard.stats, slo_seconds=20)
+    tier, reason = router.choose(quality="standard", plan="pro")
+    res = router.call(tier, vertex_policy.call, prompt=prompt, number_of_images=1)
+
+Tiers are listed fastest first. A request gets the tier it asks for
+(`quality`), else its plan's default, capped at the plan's best tier. If that
+tier's recent latency plus the expected wait for a Vertex slot would miss
+`slo_seconds`, it steps down to a faster tier, so a busy or slow upstream
+costs quality before it costs timeouts. `reason` says which of these decided.
+
+Latency is a moving average of each tier's recent calls, starting from its
+`expected_seconds`. The wait comes from the guard's queue: with every slot busy,
+the requests ahead of this one divided by the slots, times a call's usual length.
+Calls, images, seconds and cost per tier go to /metrics and stats().
+"""
+import time
+import threading
+
+import metrics
+from admission import UpstreamRejected, DeadlineExceeded
+
+LATENCY_WEIGHT = 0.2   # weight of the newest call in the moving averages
+
+TIER_CHOICES = metrics.counter("imagen_tier_choices_total", "Imagen tier picked per request", ("tier", "reason"))
+TIER_SECONDS = metrics.histogram("imagen_tier_seconds", "Imagen call latency by tier", ("tier",))
+TIER_IMAGES = metrics.counter("imagen_tier_images_total", "Images returned by tier", ("tier",))
+TIER_COST = metrics.counter("imagen_cost_usd_total", "Estimated Imagen spend by tier", ("tier",))
+
+
+class Tier:
+    def __init__(self, name, model, model_id, credits=1, usd_per_image=0.0, expected_seconds=8.0, max_images=4):
+        self.name = name
+        self.model = model                 # has generate_images()
+        self.model_id = model_id
+        self.credits = credits             # charged per image
+        self.usd_per_image = usd_per_image
+        self.max_images = max_images       # most images one call may ask for
+        self.latency = expected_seconds    # moving average of recent calls
+        self.calls = 0
+        self.failures = 0
+        self.images = 0
+
+
+class ModelRouter:
+    def __init__(self, tiers, load=None, slo_seconds=20.0, default="standard", plans=None):
+        self.tiers = list(tiers)
+        self.by_name = {tier.name: tier for tier in self.tiers}
+        self.load = load                   # () -> {"slots", "running", "queued"}
+        self.slo_seconds = slo_seconds
+        self.default = self.by_name[default]
+        # plan -> (default tier, best tier); None is users without a plan
+        self.plans = plans or {}
+        self.service_seconds = self.default.latency   # moving average over all tiers
+        self._lock = threading.Lock()
+
+    def choose(self, quality=None, plan=None, images=1):
+        """(tier, reason): reason is "requested", "plan", "capped" or "degraded"."""
+        default, best = self.plans.get(plan) or self.plans.get(None) or (self.default.name, self.tiers[-1].name)
+        wanted = quality if quality in self.by_name else default
+        reason = "requested" if quality in self.by_name else "plan"
+        position = self._position(wanted)
+        limit = min(self._position(best), max(i for i, t in enumerate(self.tiers) if t.max_images >= images))
+        if position > limit:
+            position, reason = limit, "capped"
+
+        wait = self.queue_wait()
+        while position > 0 and wait + self.tiers[position].latency > self.slo_seconds:
+            position, reason = position - 1, "degraded"
+        tier = self.tiers[position]
+        TIER_CHOICES.inc(tier=tier.name, reason=reason)
+        return tier, reason
+
+    def queue_wait(self):
+        """Expected seconds before a new call gets a Vertex slot."""
+        if self.load is None:
+            return 0.0
+        load = self.load()
+        slots = max(load["slots"], 1)
+        if load["running"] < slots:
+            return 0.0
+        return (load["queued"] + 1) / slots * self.service_seconds
+
+    def call(self, tier, invoke, **params):
+        """invoke(tier.model.generate_images, **params), timed and costed for the tier."""
+        started = time.perf_counter()
+        try:
+            result = invoke(tier.model.generate_images, **params)
+        except UpstreamRejected as e:
+            # Turned away before reaching Vertex says nothing about its speed
+            if isinstance(e, DeadlineExceeded):
+                self._record(tier, time.perf_counter() - started, failed=True)
+            raise
+        except Exception:
+            self._record(tier, time.perf_counter() - started, failed=True)
+            raise
+        images = len(getattr(result, "images", None) or [])
+        self._record(tier, time.perf_counter() - started, images=images)
+        return result
+
+    def _record(self, tier, seconds, failed=False, images=0):
+        with self._lock:
+            tier.calls += 1
+            tier.failures += failed
+            tier.images += images
+            tier.latency += LATENCY_WEIGHT * (seconds - tier.latency)
+            self.service_seconds += LATENCY_WEIGHT * (seconds - self.service_seconds)
+        TIER_SECONDS.observe(seconds, tier=tier.name)
+        if images:
+            TIER_IMAGES.inc(images, tier=tier.name)
+            TIER_COST.inc(images * tier.usd_per_image, tier=tier.name)
+
+    def _position(self, name):
+        return self.tiers.index(self.by_name[name])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sloSeconds": self.slo_seconds,
+                "queueWaitSeconds": round(self.queue_wait(), 3),
+                "tiers": {tier.name: {
+                    "model": tier.model_id,
+                    "latencySeconds": round(tier.latency, 3),
+                    "calls": tier.calls,
+                    "failures": tier.failures,
+                    "images": tier.images,
+                    "costUsd": round(tier.images * tier.usd_per_image, 4),
+                } for tier in self.tiers}
+            }
@@ -0,0 +1,319 @@
+# prewarm.py
+"""Pre-generate images for trending prompts while Vertex is idle.
+
+    prewarmer = Prewarmer(VariantPool(dir, ttl=86400), generate, cost_per_image, load=vertex_guard.stats)
+    prewarmer.observe(request_key, (prompt, tier))    # every /generate
+    path = prewarmer.claim(request_key)               # a ready image for this request, or None
+    prewarmer.start()
+
+Prompt frequency is tracked with a Space-Saving sketch (SpaceSaving): the
+`capacity` most frequent request keys in fixed memory, however many distinct
+prompts go by. Counts are halved every `half_life` seconds, so the ranking
+follows what is popular now rather than all time.
+
+Every `interval` seconds, if Vertex is quiet (running + queued calls at most
+`idle_share` of its slots), the top prompts seen at least `min_count` times get
+their pools topped up to `variants` images. Spending stops at
+`max_images_per_hour` and `max_usd_per_day` (counted per process), and at
+`max_pool` images waiting.
+
+Images wait on disk in VariantPool, one directory per request key, so they
+survive restarts and every worker can hand them out. A claim is a rename,
+so each image goes to exactly one request; the user gets a fresh image
+without waiting for Vertex. Images not claimed within `ttl` seconds are
+deleted and counted as wasted.
+
+stats() is aggregate counters only. trending() lists request keys (hashes)
+with their counts; neither ever returns prompt text.
+"""
+import os
+import time
+import heapq
+import logging
+import threading
+from collections import deque
+from operator import itemgetter
+
+import metrics
+from delivery import atomic_write
+
+PREWARM_IMAGES = metrics.counter("prewarm_images_total", "Pre-generated images by outcome", ("outcome",))
+PREWARM_LOOKUPS = metrics.counter("prewarm_lookups_total", "/generate requests checked against the pool",
+                                  ("result",))
+
+log = logging.getLogger(__name__)
+
+
+class SpaceSaving:
+    """Approximate counts of the most frequent keys in a stream (Metwally et al., "Space-Saving").
+
+    At most `capacity` keys are tracked. A new key replaces the least counted
+    one and starts from its count, so counts can be over (never under) the
+    truth by at most `error(key)`, and any key seen more than total/capacity
+    times is always tracked. Not thread-safe; callers lock.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}     # key -> count
+        self.errors = {}     # key -> count inherited when it took a slot
+        self.samples = {}    # key -> last value passed to add()
+        self._heap = []      # (count, key); entries go stale as counts grow
+
+    def add(self, key, sample=None, weight=1):
+        self.total += weight
+        if key in self.counts:
+            self.counts[key] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = weight
+            self.errors[key] = 0
+        else:
+            victim, floor = self._pop_min()
+            del self.counts[victim], self.errors[victim], self.samples[victim]
+            self.counts[key] = floor + weight
+            self.errors[key] = floor
+        self.samples[key] = sample
+        heapq.heappush(self._heap, (self.counts[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def _pop_min(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                return key, count
+
+    def _rebuild(self):
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def decay(self):
+        """Halve every count (keys that reach 0 are dropped)."""
+        self.total //= 2
+        for key in list(self.counts):
+            self.counts[key] //= 2
+            self.errors[key] //= 2
+            if not self.counts[key]:
+                del self.counts[key], self.errors[key], self.samples[key]
+        self._rebuild()
+
+    def error(self, key):
+        return self.errors.get(key, 0)
+
+    def top(self, n):
+        """[(key, count, sample)] for the n most frequent keys."""
+        return [(key, count, self.samples[key])
+                for key, count in heapq.nlargest(n, self.counts.items(), key=itemgetter(1))]
+
+
+class VariantPool:
+    """Ready images on disk: `directory/<key>/<time_ns>.png`."""
+
+    def __init__(self, directory, ttl=86400.0, ext=".png"):
+        self.directory = directory
+        self.ttl = ttl
+        self.ext = ext
+        os.makedirs(directory, exist_ok=True)
+
+    def _images(self, key):
+        try:
+            return sorted(name for name in os.listdir(os.path.join(self.directory, key))
+                          if name.endswith(self.ext) and not name.startswith("."))
+        except FileNotFoundError:
+            return []
+
+    def count(self, key):
+        return len(self._images(key))
+
+    def add(self, key, data):
+        directory = os.path.join(self.directory, key)
+        for attempt in range(2):
+            os.makedirs(directory, exist_ok=True)
+            try:
+                atomic_write(os.path.join(directory, f"{time.time_ns()}{self.ext}"), data)
+                return
+            except FileNotFoundError:
+                if attempt:     # expire() removed the empty directory in between
+                    raise
+
+    def claim(self, key):
+        """Take the oldest image for `key`. Returns its new path (ours alone), or None."""
+        directory = os.path.join(self.directory, key)
+        for name in self._images(key):
+            claimed = os.path.join(self.directory, f".claimed-{time.time_ns()}-{name}")
+            try:
+                os.rename(os.path.join(directory, name), claimed)
+            except FileNotFoundError:
+                continue    # another request (or worker) got it first
+            return claimed
+        return None
+
+    def expire(self):
+        """Delete images older than ttl. Returns how many were deleted (unclaimed)."""
+        cutoff = time.time() - self.ttl
+        deleted = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                # A claim that was never moved on (the process died in between)
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                continue
+            for image in os.scandir(entry.path):
+                if image.stat().st_mtime < cutoff:
+                    try:
+                        os.remove(image.path)
+                        deleted += not image.name.startswith(".")
+                    except FileNotFoundError:
+                        pass
+            try:
+                os.rmdir(entry.path)    # only succeeds once it's empty
+            except OSError:
+                pass
+        return deleted
+
+    def total(self):
+        return sum(self.count(entry.name) for entry in os.scandir(self.directory) if entry.is_dir())
+
+
+class Prewarmer:
+    def __init__(self, pool, generate, cost_per_image, load=None, capacity=1000, half_life=3600.0,
+                 interval=10.0, idle_share=0.25, min_count=3, variants=2, top=20, max_pool=200,
+                 max_images_per_hour=60, max_usd_per_day=5.0):
+        self.pool = pool
+        self.generate = generate               # (sample, count) -> [image bytes]
+        self.cost_per_image = cost_per_image   # sample -> USD
+        self.load = load                       # () -> {"slots", "running", "queued"}
+        self.half_life = half_life
+        self.interval = interval
+        self.idle_share = idle_share
+        self.min_count = min_count
+        self.variants = variants
+        self.top = top
+        self.max_pool = max_pool
+        self.max_images_per_hour = max_images_per_hour
+        self.max_usd_per_day = max_usd_per_day
+        self.sketch = SpaceSaving(capacity)
+        self.lookups = 0
+        self.hits = 0
+        self.generated = 0
+        self.expired = 0
+        self.spent_usd = 0.0
+        self._spending = deque()     # (time, images, usd) for the last day
+        self._decayed_at = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # -- request path --
+    def observe(self, key, sample):
+        with self._lock:
+            self.sketch.add(key, sample)
+
+    def claim(self, key):
+        """Path of a pre-generated image for `key` (now the caller's to move), or None."""
+        path = self.pool.claim(key)
+        with self._lock:
+            self.lookups += 1
+            self.hits += path is not None
+        PREWARM_LOOKUPS.inc(result="hit" if path else "miss")
+        if path:
+            PREWARM_IMAGES.inc(outcome="served")
+        return path
+
+    # -- background --
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="prewarm", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                log.warning(f"Prewarm round failed: {e}")
+
+    def idle(self):
+        if self.load is None:
+            return True
+        load = self.load()
+        return load["running"] + load["queued"] <= load["slots"] * self.idle_share
+
+    def run_once(self):
+        """Expire old images, then top up trending prompts while Vertex stays idle. Returns images made."""
+        expired = self.pool.expire()
+        with self._lock:
+            self.expired += expired
+            if time.monotonic() - self._decayed_at >= self.half_life:
+                self.sketch.decay()
+                self._decayed_at = time.monotonic()
+            trending = self.sketch.top(self.top)
+        if expired:
+            PREWARM_IMAGES.inc(expired, outcome="expired")
+
+        made = 0
+        waiting = self.pool.total()
+        for key, count, sample in trending:
+            if count < self.min_count or waiting >= self.max_pool or not self.idle():
+                break
+            wanted = min(self.variants - self.pool.count(key), self.max_pool - waiting)
+            wanted = min(wanted, self._allowance(self.cost_per_image(sample)))
+            if wanted <= 0:
+                continue
+            images = self.generate(sample, wanted)
+            for data in images:
+                self.pool.add(key, data)
+            self._spent(len(images), len(images) * self.cost_per_image(sample))
+            made += len(images)
+            waiting += len(images)
+        if made:
+            log.info(f"Pre-generated {made} images for trending prompts", extra={"waiting": waiting})
+        return made
+
+    def _allowance(self, usd_per_image):
+        """Images the spend caps still allow at this price."""
+        now = time.time()
+        with self._lock:
+            while self._spending and self._spending[0][0] < now - 86400:
+                self._spending.popleft()
+            hour = sum(images for at, images, _ in self._spending if at >= now - 3600)
+            day_usd = sum(usd for _, _, usd in self._spending)
+        allowed = self.max_images_per_hour - hour
+        if usd_per_image > 0:
+            allowed = min(allowed, int((self.max_usd_per_day - day_usd) / usd_per_image + 1e-9))
+        return max(allowed, 0)
+
+    def _spent(self, images, usd):
+        with self._lock:
+            self._spending.append((time.time(), images, usd))
+            self.generated += images
+            self.spent_usd += usd
+        PREWARM_IMAGES.inc(images, outcome="generated")
+
+    def trending(self, n=20):
+        """The n most requested keys with their counts. Keys only: samples hold users' prompts."""
+        with self._lock:
+            top = [(key, count, self.sketch.error(key)) for key, count, _ in self.sketch.top(n)]
+        return [{"key": key, "count": count, "maxOvercount": error, "waiting": self.pool.count(key)}
+                for key, count, error in top]
+
+    def stats(self):
+        """Aggregate counters only (no keys or prompts)."""
+        with self._lock:
+            stats = {
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hitRate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "generated": self.generated,
+                "expired": self.expired,
+                "spentUsd": round(self.spent_usd, 4),
+                "spentUsdToday": round(sum(usd for _, _, usd in self._spending), 4),
+                "trackedPrompts": len(self.sketch.counts),
+            }
+        stats["waiting"] = self.pool.total()
+        return stats
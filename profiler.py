@@ -0,0 +1,158 @@
+# profiler.py
+"""Sampled wall-clock profiles of single requests, saved as folded stacks.
+
+    profiler = Profiler(ProfileStore("profiles", max_profiles=100), interval=0.01)
+    session = profiler.start()                    # on the request's thread
+    ...
+    meta = profiler.finish(session, "generate", {"status": 200})
+    profiler.store.list()                         # newest first
+    profiler.store.path(meta["id"])               # profiles/<id>.folded
+
+One background thread wakes every `interval` seconds and records the current
+stack of each thread with a running session (sys._current_frames()). Nothing is
+traced or instrumented, so a profiled request runs its normal code; the cost is
+one stack walk per tick, and no thread exists until the first session starts.
+Sampling is by wall clock: time blocked on Firebase, Vertex or a file write
+shows up under the frame that is waiting.
+
+Profiles are in the folded format, one "outer;...;inner count" line per
+distinct stack, which flamegraph.pl, inferno and speedscope read directly:
+
+    flamegraph.pl generate.folded > generate.svg
+
+Each profile's route, status, duration and sample count are kept next to it
+as <id>.json. The store keeps the newest `max_profiles` and deletes the rest.
+"""
+import os
+import re
+import sys
+import json
+import time
+import threading
+from collections import Counter
+
+from delivery import atomic_write
+
+PROFILE_ID = re.compile(r"^[0-9]+-[A-Za-z0-9_-]+$")
+
+
+class Session:
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.started = time.perf_counter()
+        self.samples = Counter()     # folded stack -> samples
+
+
+class Profiler:
+    def __init__(self, store, interval=0.01, max_depth=128):
+        self.store = store
+        self.interval = interval
+        self.max_depth = max_depth
+        self.profiles = 0
+        self._sessions = {}      # thread id -> Session
+        self._labels = {}        # code object -> "name (file.py:line)"
+        self._wake = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Start sampling the calling thread."""
+        session = Session(threading.get_ident())
+        with self._wake:
+            self._sessions[session.thread_id] = session
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            self._wake.notify()
+        return session
+
+    def finish(self, session, name, meta=None):
+        """Stop sampling and save the profile. Returns its metadata (with "id")."""
+        with self._wake:
+            self._sessions.pop(session.thread_id, None)
+            self.profiles += 1
+        meta = dict(meta or {}, durationMs=round((time.perf_counter() - session.started) * 1000, 2),
+                    samples=sum(session.samples.values()), intervalMs=self.interval * 1000)
+        return self.store.save(name, session.samples, meta)
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._sessions:
+                    self._wake.wait()
+                # Under the lock, so a session never gains samples after finish()
+                frames = sys._current_frames()
+                for session in self._sessions.values():
+                    frame = frames.get(session.thread_id)
+                    if frame is not None:
+                        session.samples[self._fold(frame)] += 1
+                del frames, frame
+            time.sleep(self.interval)
+
+    def _fold(self, frame):
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                label = self._labels[code] = label.replace(";", ":")
+            labels.append(label)
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def stats(self):
+        with self._wake:
+            return {"active": len(self._sessions), "profiles": self.profiles,
+                    "intervalMs": self.interval * 1000}
+
+
+class ProfileStore:
+    """The newest `max_profiles` profiles: <id>.folded plus <id>.json metadata."""
+
+    def __init__(self, directory, max_profiles=100):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, name, samples, meta):
+        profile_id = f"{time.time_ns()}-{re.sub(r'[^A-Za-z0-9_-]', '_', name)[:80]}"
+        folded = "".join(f"{stack} {count}\n"
+                         for stack, count in sorted(samples.items(), key=lambda item: -item[1]))
+        meta = dict(meta, id=profile_id, name=name, created=time.time())
+        with self._lock:
+            atomic_write(os.path.join(self.directory, f"{profile_id}.folded"), folded.encode())
+            atomic_write(os.path.join(self.directory, f"{profile_id}.json"), json.dumps(meta).encode())
+            self._prune()
+        return meta
+
+    def _ids(self):
+        """Profile ids, newest first."""
+        ids = [name[:-5] for name in os.listdir(self.directory)
+               if name.endswith(".json") and PROFILE_ID.match(name[:-5])]
+        return sorted(ids, key=lambda profile_id: int(profile_id.split("-", 1)[0]), reverse=True)
+
+    def _prune(self):
+        for profile_id in self._ids()[self.max_profiles:]:
+            for ext in (".json", ".folded"):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + ext))
+                except FileNotFoundError:
+                    pass
+
+    def list(self, limit=None):
+        profiles = []
+        for profile_id in self._ids()[:limit]:
+            try:
+                with open(os.path.join(self.directory, f"{profile_id}.json"), "rb") as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue    # pruned (or half-written by another process) meanwhile
+        return profiles
+
+    def path(self, profile_id):
+        """Path of the folded profile, or None for an unknown (or malformed) id."""
+        if not PROFILE_ID.match(profile_id):
+            return None
+        path = os.path.join(self.directory, f"{profile_id}.folded")
+        return path if os.path.exists(path) else None
@@ -0,0 +1,213 @@
+# ratelimit.py
+"""Token-bucket rate limits, per user and overall, for each limited route.
+
+    limiter = RateLimiter()
+    limiter.add("generate", per_user="10/min", overall="100/min")
+    retry_after = limiter.check("generate", user_id)   # 0.0 -> go ahead
+
+A bucket holds up to `count` tokens and refills at count/period per second;
+each request takes one. A request needs a token from the user's bucket and
+from the route's overall bucket, and is turned away (with the seconds until
+one is free) when either is empty.
+
+By default buckets live in memory, spread over sharded dicts so threads rarely
+share a lock, and a check costs a couple of microseconds. A bucket that has
+refilled completely holds nothing worth keeping, so each shard drops those now
+and then. With `path` set, buckets live in a SQLite file instead and every
+worker process using that file shares the same limits; each take is one
+conditional upsert, like the credit ledger.
+"""
+import re
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+
+import metrics
+
+RATE_LIMITED = metrics.counter("rate_limited_total", "Requests turned away by a rate limit", ("limit", "scope"))
+
+_UNITS = {"s": 1, "sec": 1, "second": 1, "m": 60, "min": 60, "minute": 60,
+          "h": 3600, "hour": 3600, "d": 86400, "day": 86400}
+_RATE_RE = re.compile(r"^\s*(\d+)\s*/\s*(\d*)\s*([a-z]+)\s*$")
+
+
+class Rate(namedtuple("Rate", "count period")):
+    """`count` requests per `period` seconds, in bursts of up to `count`."""
+
+    @property
+    def per_second(self):
+        return self.count / self.period
+
+    @classmethod
+    def parse(cls, spec):
+        """"10/min", "5/s", "100/10s" -> Rate. None, "" and "0" mean no limit."""
+        if spec is None or isinstance(spec, Rate):
+            return spec
+        spec = str(spec).strip().lower()
+        if spec in ("", "0", "off", "none"):
+            return None
+        match = _RATE_RE.match(spec)
+        if match is None or match.group(3) not in _UNITS:
+            raise ValueError(f"Bad rate limit {spec!r}; expected e.g. '10/min' or '100/10s'")
+        count = int(match.group(1))
+        period = int(match.group(2) or 1) * _UNITS[match.group(3)]
+        return cls(count, period) if count > 0 else None
+
+
+class MemoryBuckets:
+    """Buckets for one process, in `shards` dicts with a lock each."""
+
+    def __init__(self, shards=16, sweep_interval=60.0):
+        self.sweep_interval = sweep_interval
+        self._shards = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._next_sweep = [0.0] * shards
+
+    def take(self, key, rate, now, cost=1):
+        """Take `cost` tokens. Returns 0.0, or the seconds until they'd be there."""
+        i = hash(key) % len(self._shards)
+        buckets = self._shards[i]
+        with self._locks[i]:
+            if now >= self._next_sweep[i]:
+                self._sweep(buckets, now)
+                self._next_sweep[i] = now + self.sweep_interval
+            bucket = buckets.get(key)
+            tokens = rate.count if bucket is None else min(rate.count, bucket[0] + (now - bucket[1]) * rate.per_second)
+            if tokens < cost:
+                return (cost - tokens) / rate.per_second
+            tokens -= cost
+            # Third item: when the bucket is full again and can be forgotten
+            buckets[key] = (tokens, now, now + (rate.count - tokens) / rate.per_second)
+            return 0.0
+
+    def give_back(self, key, rate, now, cost=1):
+        i = hash(key) % len(self._shards)
+        with self._locks[i]:
+            bucket = self._shards[i].get(key)
+            if bucket is not None:
+                tokens = min(rate.count, bucket[0] + cost)
+                self._shards[i][key] = (tokens, bucket[1], bucket[2] - cost / rate.per_second)
+
+    @staticmethod
+    def _sweep(buckets, now):
+        for key in [key for key, bucket in buckets.items() if bucket[2] <= now]:
+            del buckets[key]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key      TEXT PRIMARY KEY,
+    tokens   REAL NOT NULL,
+    updated  REAL NOT NULL,
+    full_at  REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+
+class SqliteBuckets:
+    """Buckets shared by every process using the same SQLite file."""
+
+    def __init__(self, path, sweep_interval=60.0):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = 0.0
+        self._conn().execute(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")   # losing a few tokens in a crash is fine
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, now, cost=1):
+        conn = self._conn()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            conn.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+        # Refill and take in one statement; no row back means not enough tokens
+        row = conn.execute(
+            "INSERT INTO buckets (key, tokens, updated, full_at) VALUES (:key, :count - :cost, :now, "
+            "  :now + :cost / :per_second) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            "  tokens = min(:count, tokens + (:now - updated) * :per_second) - :cost, updated = :now, "
+            "  full_at = :now + (:count - min(:count, tokens + (:now - updated) * :per_second) + :cost) "
+            "    / :per_second "
+            "WHERE min(:count, tokens + (:now - updated) * :per_second) >= :cost "
+            "RETURNING tokens",
+            {"key": key, "count": rate.count, "cost": cost, "now": now,
+             "per_second": rate.per_second}).fetchone()
+        if row is not None:
+            return 0.0
+        row = conn.execute("SELECT min(?, tokens + (? - updated) * ?) FROM buckets WHERE key = ?",
+                           (rate.count, now, rate.per_second, key)).fetchone()
+        return (cost - row[0]) / rate.per_second
+
+    def give_back(self, key, rate, now, cost=1):
+        self._conn().execute(
+            "UPDATE buckets SET tokens = min(?, tokens + ?), full_at = full_at - ? WHERE key = ?",
+            (rate.count, cost, cost / rate.per_second, key))
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+class RateLimiter:
+    def __init__(self, path=None, shards=16, sweep_interval=60.0):
+        if path:
+            self.buckets = SqliteBuckets(path, sweep_interval)
+        else:
+            self.buckets = MemoryBuckets(shards, sweep_interval)
+        self.limits = {}
+
+    def add(self, name, per_user=None, overall=None):
+        """Limit `name`; rates are Rate objects or strings like "10/min"."""
+        per_user, overall = Rate.parse(per_user), Rate.parse(overall)
+        if per_user or overall:
+            self.limits[name] = (per_user, overall)
+        else:
+            self.limits.pop(name, None)
+
+    def check(self, name, user_id, cost=1):
+        """Take a token for `user_id` from limit `name`.
+
+        Returns 0.0 when the request may go ahead, else the seconds to wait.
+        Names without a limit always go ahead.
+        """
+        limit = self.limits.get(name)
+        if limit is None:
+            return 0.0
+        per_user, overall = limit
+        now = time.time()
+        if per_user:
+            wait = self.buckets.take(f"{name}:user:{user_id}", per_user, now, cost)
+            if wait:
+                RATE_LIMITED.inc(limit=name, scope="user")
+                return wait
+        if overall:
+            wait = self.buckets.take(f"{name}:*", overall, now, cost)
+            if wait:
+                if per_user:
+                    # The user's token wasn't used after all
+                    self.buckets.give_back(f"{name}:user:{user_id}", per_user, now, cost)
+                RATE_LIMITED.inc(limit=name, scope="overall")
+                return wait
+        return 0.0
+
+    def stats(self):
+        return {
+            "backend": "sqlite" if isinstance(self.buckets, SqliteBuckets) else "memory",
+            "buckets": len(self.buckets),
+            "limits": {name: {"perUser": f"{u.count}/{u.period}s" if u else None,
+                              "overall": f"{o.count}/{o.period}s" if o else None}
+                       for name, (u, o) in self.limits.items()},
+        }
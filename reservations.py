@@ -0,0 +1,363 @@
+# reservations.py
+"""Credit reservations: reserve before calling Vertex, refund if it fails.
+
+    reservation = credit_store.reserve(user_id, cost)   # raises InsufficientCredits
+    with reservation:
+        ...generate, write file...                       # exception -> refund
+
+With Firebase on, a reservation is one conditional write (`set_if_unchanged`)
+against the last ETag we saw for that user. Only a cold cache or a lost race
+costs an extra round trip, and a lost race retries against the fresh value the
+server sends back, so two requests can never spend the same balance.
+
+Bulk grants (grant_many) are a single multi-path update of server-side
+increments: no reads, all users in it or none, and safe next to concurrent
+reservations on the same users.
+"""
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+MAX_RETRIES = 25          # same limit firebase_admin uses for Reference.transaction
+ETAG_CACHE_SIZE = 10000   # users whose last (etag, value) we remember
+REFUND_ATTEMPTS = 5       # a refund that fails loses the user's credits, so try harder
+GRANT_KEYS_KEPT = 20      # keyed grants (payments, refunds) remembered per user for dedup
+READ_CONCURRENCY = 32     # parallel reads when fetching many balances
+# firebase_admin error codes that mean the server refused a write without applying it
+REJECTED_CODES = {"INVALID_ARGUMENT", "PERMISSION_DENIED", "UNAUTHENTICATED", "NOT_FOUND", "FAILED_PRECONDITION"}
+
+log = logging.getLogger(__name__)
+
+CREDIT_OPERATIONS = metrics.counter("credit_operations_total", "Credit reservations and refunds", ("operation",))
+CREDITS_MOVED = metrics.counter("credits_total", "Credits deducted or refunded", ("operation",))
+
+
+class InsufficientCredits(Exception):
+    def __init__(self, balance, cost):
+        super().__init__(f"Insufficient credits: balance {balance}, need {cost}")
+        self.balance = balance
+        self.cost = cost
+
+
+class ReservationAborted(Exception):
+    """The conditional write kept losing races and gave up."""
+
+
+class GrantOutcomeUnknown(Exception):
+    """A bulk grant failed in a way that doesn't say whether it was applied (timeout,
+    dropped connection): retrying it could grant twice. Check the balances first."""
+
+    def __init__(self, cause):
+        super().__init__(f"Grant may or may not have been applied: {cause}")
+        self.cause = cause
+
+
+class _AlreadyClaimed(Exception):
+    def __init__(self, balance):
+        super().__init__("Daily credits already claimed")
+        self.balance = balance
+
+
+class _AlreadyGranted(Exception):
+    def __init__(self, balance):
+        super().__init__("Grant already applied")
+        self.balance = balance
+
+
+class Reservation:
+    """Credits taken from a user for one piece of work.
+
+    Use as a context manager: leaving the block normally commits, leaving it
+    with an exception refunds. `commit()` / `refund()` can also be called directly;
+    whichever comes first wins.
+    """
+
+    def __init__(self, store, user_id, cost, balance):
+        self.store = store
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.cost = cost
+        self.balance = balance  # balance right after the reservation
+        self.state = "reserved"
+        self._lock = threading.Lock()
+        CREDIT_OPERATIONS.inc(operation="deduct")
+        CREDITS_MOVED.inc(cost, operation="deduct")
+
+    def commit(self):
+        with self._lock:
+            if self.state == "reserved":
+                self.state = "committed"
+
+    def refund(self):
+        with self._lock:
+            if self.state != "reserved":
+                return self.balance
+            self.state = "refunded"
+        if self.cost:
+            self.balance = self._give_back(self.cost, f"refund:{self.id}")
+            CREDIT_OPERATIONS.inc(operation="refund")
+            CREDITS_MOVED.inc(self.cost, operation="refund")
+            log.info("Credits refunded", extra={"userId": self.user_id, "amount": self.cost, "balance": self.balance})
+        return self.balance
+
+    def reduce_to(self, cost):
+        """Lower the charge (e.g. fewer images came back than were paid for)."""
+        with self._lock:
+            if self.state == "refunded" or cost >= self.cost:
+                return self.balance
+            difference = self.cost - cost
+            self.cost = cost
+        # The charge only ever goes down, so each reduction gets its own key
+        self.balance = self._give_back(difference, f"refund:{self.id}:{cost}")
+        CREDIT_OPERATIONS.inc(operation="refund")
+        CREDITS_MOVED.inc(difference, operation="refund")
+        log.info("Credits refunded", extra={"userId": self.user_id, "amount": difference, "balance": self.balance})
+        return self.balance
+
+    def _give_back(self, amount, key):
+        # Keyed: an attempt that was applied but timed out makes the retry a no-op
+        for attempt in range(REFUND_ATTEMPTS):
+            try:
+                return self.store.grant(self.user_id, amount, key=key)
+            except Exception as e:
+                if attempt == REFUND_ATTEMPTS - 1:
+                    raise
+                log.warning(f"Refund failed ({e}), retrying", extra={"userId": self.user_id, "attempt": attempt + 1})
+                time.sleep(0.05 * 2 ** attempt)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            try:
+                self.refund()
+            except Exception:
+                log.exception("Refund failed, credits lost", extra={"userId": self.user_id, "amount": self.cost})
+        return False
+
+
+class LedgerCreditStore:
+    """Reservations on top of the local SQLite ledger (file mode)."""
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+
+    def reserve(self, user_id, cost):
+        success, balance = self.ledger.deduct(user_id, cost)
+        if not success:
+            raise InsufficientCredits(balance, cost)
+        return Reservation(self, user_id, cost, balance)
+
+    def grant(self, user_id, amount, key=None, plan=None):
+        return self.ledger.grant(user_id, amount, key=key, plan=plan)
+
+    def claim_daily(self, user_id, amount, today):
+        return self.ledger.claim_daily(user_id, amount, today)
+
+    def balance(self, user_id):
+        return self.ledger.get_balance(user_id)
+
+    def plan(self, user_id):
+        return self.ledger.get_plan(user_id)
+
+    def grant_many(self, grants, read_back=True):
+        """Add credits to many users at once. Returns {user_id: new balance}.
+
+        The balances come with the writes here, so `read_back` costs nothing.
+        """
+        return self.ledger.grant_many(_sum_grants(grants).items())
+
+    def balances(self, user_ids):
+        return self.ledger.balances(user_ids)
+
+
+class FirebaseCreditStore:
+    """Reservations on Realtime Database `credits/<userId>` nodes.
+
+    `db` is `firebase_admin.db` (or `fake_firebase` in tests).
+    """
+
+    def __init__(self, db, root="credits", read_concurrency=READ_CONCURRENCY):
+        self.db = db
+        self.root = root
+        self.read_concurrency = read_concurrency
+        self._etags = OrderedDict()  # user_id -> (etag, value)
+        self._readers = None         # ThreadPoolExecutor for balances(), made on first use
+        self._lock = threading.Lock()
+
+    def _remember(self, user_id, etag, value):
+        with self._lock:
+            self._etags[user_id] = (etag, value)
+            self._etags.move_to_end(user_id)
+            while len(self._etags) > ETAG_CACHE_SIZE:
+                self._etags.popitem(last=False)
+
+    def _forget(self, user_id):
+        with self._lock:
+            self._etags.pop(user_id, None)
+
+    def _conditional_update(self, user_id, update_fn, use_cache=True):
+        """Apply update_fn(current_value) -> new_value with optimistic concurrency.
+
+        update_fn may raise to abort without writing.
+        """
+        ref = self.db.reference(f"{self.root}/{user_id}")
+        cached = None
+        if use_cache:
+            with self._lock:
+                cached = self._etags.get(user_id)
+        if cached is None:
+            value, etag = ref.get(etag=True)
+        else:
+            etag, value = cached
+
+        for attempt in range(MAX_RETRIES):
+            new_value = update_fn(value)
+            success, value, etag = ref.set_if_unchanged(etag, new_value)
+            if success:
+                self._remember(user_id, etag, new_value)
+                return new_value
+            # Lost a race: back off a little so hot users don't livelock
+            time.sleep(random.uniform(0, min(0.05, 0.001 * 2 ** attempt)))
+
+        self._forget(user_id)
+        raise ReservationAborted(f"Credit update for {user_id} aborted after {MAX_RETRIES} retries")
+
+    def reserve(self, user_id, cost):
+        def take(current):
+            current = dict(current or {})
+            balance = current.get("balance", 0)
+            if balance < cost:
+                raise InsufficientCredits(balance, cost)
+            current["balance"] = balance - cost
+            return current
+
+        try:
+            new_value = self._conditional_update(user_id, take)
+        except InsufficientCredits:
+            # The cached value may be stale (e.g. credits granted by another
+            # instance); check against the server before refusing
+            self._forget(user_id)
+            new_value = self._conditional_update(user_id, take, use_cache=False)
+        return Reservation(self, user_id, cost, new_value["balance"])
+
+    def grant(self, user_id, amount, key=None, plan=None):
+        """Add credits (and record a `plan`, if given).
+
+        With a `key`, only once: the user's node keeps its last few keys.
+        """
+        def add(current):
+            current = dict(current or {})
+            if key is not None:
+                keys = list(current.get("grantKeys") or [])
+                if key in keys:
+                    raise _AlreadyGranted(current.get("balance", 0))
+                current["grantKeys"] = (keys + [key])[-GRANT_KEYS_KEPT:]
+            current["balance"] = current.get("balance", 0) + amount
+            if plan is not None:
+                current["plan"] = plan
+            return current
+
+        try:
+            return self._conditional_update(user_id, add)["balance"]
+        except _AlreadyGranted as e:
+            # Keys are only ever added, so even a cached value is proof
+            return e.balance
+
+    def claim_daily(self, user_id, amount, today):
+        """Add the daily credits unless already claimed today. Returns (claimed, balance)."""
+        def claim(current):
+            current = dict(current or {})
+            if current.get("lastClaimDate") == today:
+                raise _AlreadyClaimed(current.get("balance", 0))
+            current["balance"] = current.get("balance", 0) + amount
+            current["lastClaimDate"] = today
+            return current
+
+        try:
+            new_value = self._conditional_update(user_id, claim)
+        except _AlreadyClaimed:
+            # Only trust "already claimed" from a fresh read
+            self._forget(user_id)
+            try:
+                new_value = self._conditional_update(user_id, claim, use_cache=False)
+            except _AlreadyClaimed as e:
+                return False, e.balance
+        return True, new_value["balance"]
+
+    def balance(self, user_id):
+        value = self.db.reference(f"{self.root}/{user_id}").get() or {}
+        return value.get("balance", 0)
+
+    def plan(self, user_id):
+        """The user's plan, from the cached node if we have it.
+
+        A cold read is remembered with its ETag, so the reservation that
+        usually follows doesn't need a read of its own.
+        """
+        with self._lock:
+            cached = self._etags.get(user_id)
+        if cached is None:
+            value, etag = self.db.reference(f"{self.root}/{user_id}").get(etag=True)
+            self._remember(user_id, etag, value)
+        else:
+            value = cached[1]
+        return (value or {}).get("plan")
+
+    def grant_many(self, grants, read_back=True):
+        """Add credits to many users in one atomic multi-path update.
+
+        Returns {user_id: new balance}. The balances take one read per user,
+        so without `read_back` (or if reading fails; the credits were still
+        added) they are None.
+
+        The update is all-or-nothing, but a timeout or dropped connection can
+        come after Firebase applied it. Only a definite rejection (or a
+        client-side ValueError) is re-raised as is, meaning nothing was
+        granted; anything else raises GrantOutcomeUnknown.
+        """
+        totals = _sum_grants(grants)
+        try:
+            self.db.reference(self.root).update(
+                {f"{user_id}/balance": {".sv": {"increment": amount}} for user_id, amount in totals.items()})
+        except ValueError:
+            raise
+        except Exception as e:
+            if getattr(e, "code", None) in REJECTED_CODES:
+                raise
+            raise GrantOutcomeUnknown(e) from e
+        with self._lock:
+            for user_id in totals:
+                self._etags.pop(user_id, None)
+        if not read_back:
+            return dict.fromkeys(totals)
+        try:
+            return self.balances(totals)
+        except Exception as e:
+            log.warning(f"Could not read balances back after a bulk grant: {e}", extra={"users": len(totals)})
+            return dict.fromkeys(totals)
+
+    def balances(self, user_ids):
+        """{user_id: balance} for many users, `read_concurrency` reads at a time."""
+        user_ids = list(dict.fromkeys(user_ids))
+        with self._lock:
+            if self._readers is None:
+                self._readers = ThreadPoolExecutor(self.read_concurrency, thread_name_prefix="credit-read")
+        return dict(zip(user_ids, self._readers.map(self.balance, user_ids)))
+
+
+def _sum_grants(grants):
+    """{user_id: total amount}, in first-seen order."""
+    totals = {}
+    for user_id, amount in grants:
+        totals[user_id] = totals.get(user_id, 0) + amount
+    return totals
@@ -0,0 +1,133 @@
+# result_cache.py
+"""Content-addressed cache of generated images.
+
+Entries are keyed by sha256(normalized prompt, model id, generation params)
+and stored as `<key>.png` in a cache directory under STATIC_DIR, so a hit is
+just a URL. The first generation of a prompt is hard-linked into the cache
+(no extra disk when the filesystem allows it), which means evicting a cache
+entry never removes the file the original user was given.
+
+The cache keeps itself under `max_bytes`, evicting least recently used
+entries first. LRU order survives restarts through file mtimes.
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt):
+    """Case- and whitespace-insensitive form of a prompt."""
+    return _WHITESPACE.sub(" ", prompt).strip().lower()
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes, ext=".png"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ext = ext
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> size, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Rebuild the index from disk, oldest mtime first."""
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.ext):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            found.append((st.st_mtime, name[:-len(self.ext)], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(prompt, model_id, params=None):
+        raw = json.dumps({
+            "prompt": normalize_prompt(prompt),
+            "model": model_id,
+            "params": params or {},
+        }, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def filename(self, key):
+        return key + self.ext
+
+    def path(self, key):
+        return os.path.join(self.directory, self.filename(key))
+
+    def get(self, key):
+        """Return the cached file's name (relative to the cache dir), or None."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(self.path(key))  # keep LRU order across restarts
+        except FileNotFoundError:
+            # Deleted behind our back
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._bytes -= size
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return self.filename(key)
+
+    def put(self, key, source_path):
+        """Add an already-written file to the cache."""
+        target = self.path(key)
+        tmp = target + ".tmp"
+        try:
+            os.link(source_path, tmp)
+        except OSError:
+            shutil.copyfile(source_path, tmp)
+        os.replace(tmp, target)
+        size = os.path.getsize(target)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old
+            self._entries[key] = size
+            self._bytes += size
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held (or during __init__)
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,132 @@
+# singleflight.py
+"""Coalesce identical in-flight calls into one.
+
+    result, shared = single_flight.do(key, fn)
+
+While a call for `key` is running, other callers with the same key wait for
+it and get its result (or its exception) instead of calling `fn` again.
+Nothing is remembered once the call finishes, so this is not a cache.
+
+With `lock_dir` set, the same thing happens across processes (e.g. several
+gunicorn workers): the leader holds a file lock for the key and leaves a small
+marker with its result, which callers that were waiting on the lock pick up.
+This needs the `filelock` package and a JSON-serializable result.
+"""
+import os
+import json
+import time
+import threading
+
+try:
+    from filelock import FileLock
+except ImportError:  # only needed for lock_dir
+    FileLock = None
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, lock_dir=None, marker_ttl=300):
+        if lock_dir is not None:
+            if FileLock is None:
+                raise RuntimeError("SingleFlight lock_dir needs the 'filelock' package")
+            os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+        self.marker_ttl = marker_ttl
+        self.upstream_calls = 0   # times fn actually ran
+        self.coalesced = 0        # callers served by someone else's call
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Run fn() once per key at a time. Returns (result, shared)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._lead(key, fn)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, shared
+
+    def _run(self, fn):
+        with self._lock:
+            self.upstream_calls += 1
+        return fn()
+
+    def _lead(self, key, fn):
+        if self.lock_dir is None:
+            return self._run(fn), False
+
+        waiting_since = time.time()
+        base = os.path.join(self.lock_dir, key)
+        with FileLock(base + ".lock"):
+            # Did another process finish this call while we waited for the lock?
+            marker = _read_marker(base + ".json")
+            if marker and marker["finished_at"] >= waiting_since:
+                with self._lock:
+                    self.coalesced += 1
+                return marker["result"], True
+
+            result = self._run(fn)
+            _write_marker(base + ".json", {"finished_at": time.time(), "result": result})
+            self._sweep()
+            return result, False
+
+    def _sweep(self):
+        """Drop markers nobody can be waiting for any more."""
+        cutoff = time.time() - self.marker_ttl
+        for name in os.listdir(self.lock_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "upstreamCalls": self.upstream_calls,
+                "coalesced": self.coalesced,
+                "inFlight": len(self._calls),
+                "crossProcess": self.lock_dir is not None,
+            }
+
+
+def _read_marker(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_marker(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
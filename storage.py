@@ -0,0 +1,239 @@
+# storage.py
+"""Lifecycle management for generated files in STATIC_DIR.
+
+New files go into hash-sharded subdirectories (static/ab/cd/generated_x.png)
+so no single directory grows without bound, but their URLs stay
+/static/generated_x.png: `relative_path()` maps a name to its shard, and
+falls back to the old flat location so existing URLs keep resolving.
+
+Every stored file is recorded in a small SQLite index (name, owner userId,
+size, creation time). A background sweeper deletes files older than the TTL
+and then the oldest files until the total is under `max_bytes`. With a
+per-user quota, saving a file that takes a user over it removes that user's
+oldest files first. All limits are optional (0 = off).
+
+Move existing flat files into shards (and the index):
+
+    python storage.py migrate
+"""
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import metrics
+from delivery import atomic_write
+from derivatives import remove_variants
+
+log = logging.getLogger(__name__)
+
+BYTES_WRITTEN = metrics.counter("static_bytes_written_total", "Bytes of generated files written to STATIC_DIR")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name        TEXT PRIMARY KEY,
+    owner       TEXT,
+    size        INTEGER NOT NULL,
+    created_at  REAL NOT NULL
+)
+"""
+
+
+class StorageManager:
+    def __init__(self, root, index_path, ttl_seconds=0, max_bytes=0, user_quota_bytes=0,
+                 sweep_interval=300):
+        self.root = root
+        self.index_path = index_path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.user_quota_bytes = user_quota_bytes
+        self.sweep_interval = sweep_interval
+        self.deleted_files = 0
+        self.deleted_bytes = 0
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._sweeper = None
+        conn = self._conn()
+        conn.execute(SCHEMA)
+        conn.execute("CREATE INDEX IF NOT EXISTS files_created ON files (created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS files_owner ON files (owner, created_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # -- paths --
+    @staticmethod
+    def shard(name):
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        return f"{digest[:2]}/{digest[2:4]}"
+
+    def sharded_path(self, name):
+        return os.path.join(self.root, *self.shard(name).split("/"), name)
+
+    def relative_path(self, name):
+        """Where `name` lives under root: its shard if it's there, else the flat path."""
+        if "/" not in name and os.path.isfile(self.sharded_path(name)):
+            return f"{self.shard(name)}/{name}"
+        return name
+
+    def path(self, name):
+        return os.path.join(self.root, *self.relative_path(name).split("/"))
+
+    # -- writes --
+    def save(self, name, data, owner=None):
+        """Store bytes under `name` (a bare filename) and return it."""
+        path = self.sharded_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, data)
+        return self._record(name, owner, len(data))
+
+    def save_file(self, name, src_path, owner=None):
+        """Move a finished file (a temp file under root, so it's a rename) in as `name`."""
+        path = self.sharded_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+        return self._record(name, owner, os.path.getsize(path))
+
+    def _record(self, name, owner, size):
+        BYTES_WRITTEN.inc(size)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO files (name, owner, size, created_at) VALUES (?, ?, ?, ?)",
+            (name, owner, size, time.time()))
+        if owner and self.user_quota_bytes:
+            self._enforce_quota(owner, keep=name)
+        return name
+
+    def set_owner(self, name, owner):
+        self._conn().execute("UPDATE files SET owner = ? WHERE name = ?", (owner, name))
+        if owner and self.user_quota_bytes:
+            self._enforce_quota(owner, keep=name)
+
+    def delete(self, name):
+        row = self._conn().execute("SELECT size FROM files WHERE name = ?", (name,)).fetchone()
+        path = self.path(name)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        remove_variants(path)
+        self._conn().execute("DELETE FROM files WHERE name = ?", (name,))
+        if row:
+            self.deleted_files += 1
+            self.deleted_bytes += row[0]
+
+    def _enforce_quota(self, owner, keep):
+        conn = self._conn()
+        used = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE owner = ?",
+                            (owner,)).fetchone()[0]
+        if used <= self.user_quota_bytes:
+            return
+        for name, size in conn.execute(
+                "SELECT name, size FROM files WHERE owner = ? AND name != ? ORDER BY created_at",
+                (owner, keep)).fetchall():
+            self.delete(name)
+            used -= size
+            if used <= self.user_quota_bytes:
+                break
+
+    # -- eviction --
+    def sweep(self):
+        """Apply the TTL and the total size limit once. Returns the number of files removed."""
+        conn = self._conn()
+        removed = 0
+        if self.ttl_seconds:
+            cutoff = time.time() - self.ttl_seconds
+            for (name,) in conn.execute("SELECT name FROM files WHERE created_at < ?",
+                                        (cutoff,)).fetchall():
+                self.delete(name)
+                removed += 1
+        if self.max_bytes:
+            total = self.total_bytes()
+            if total > self.max_bytes:
+                for name, size in conn.execute(
+                        "SELECT name, size FROM files ORDER BY created_at").fetchall():
+                    self.delete(name)
+                    removed += 1
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+        return removed
+
+    def start_sweeper(self):
+        if not (self.ttl_seconds or self.max_bytes) or self._sweeper is not None:
+            return
+
+        def run():
+            while not self._stop.wait(self.sweep_interval):
+                try:
+                    removed = self.sweep()
+                    if removed:
+                        log.info(f"Storage sweeper removed {removed} files")
+                except Exception:
+                    log.exception("Storage sweep failed")
+
+        self._sweeper = threading.Thread(target=run, name="storage-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+
+    # -- reporting --
+    def total_bytes(self):
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+    def user_bytes(self, owner):
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE owner = ?",
+                                    (owner,)).fetchone()[0]
+
+    def stats(self):
+        files, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+        return {
+            "files": files,
+            "bytes": total,
+            "maxBytes": self.max_bytes,
+            "ttlSeconds": self.ttl_seconds,
+            "userQuotaBytes": self.user_quota_bytes,
+            "deletedFiles": self.deleted_files,
+            "deletedBytes": self.deleted_bytes,
+        }
+
+    # -- migration --
+    def migrate_flat_files(self, prefix="generated_"):
+        """Move flat `generated_*` files into shards and index them (owner unknown)."""
+        conn = self._conn()
+        moved = 0
+        for name in os.listdir(self.root):
+            flat = os.path.join(self.root, name)
+            if not name.startswith(prefix) or not os.path.isfile(flat):
+                continue
+            st = os.stat(flat)
+            target = self.sharded_path(name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(flat, target)
+            conn.execute(
+                "INSERT OR IGNORE INTO files (name, owner, size, created_at) VALUES (?, NULL, ?, ?)",
+                (name, st.st_size, st.st_mtime))
+            moved += 1
+        return moved
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Usage: python storage.py migrate")
+        sys.exit(1)
+
+    storage = StorageManager(os.path.join(base_dir, "static"),
+                             os.environ.get("STORAGE_DB", os.path.join(base_dir, "storage.db")))
+    print(f"Moved {storage.migrate_flat_files()} files into shards")
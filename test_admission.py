@@ -0,0 +1,91 @@
+import time
+import threading
+
+import pytest
+
+from admission import UpstreamGuard, CircuitBreaker, Overloaded, DeadlineExceeded, CircuitOpen
+from clients import DependencyUnavailable
+
+
+def _run_concurrently(guard, fn, n):
+    results = []
+
+    def worker():
+        try:
+            results.append(guard.call(fn))
+        except DependencyUnavailable as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_slots_and_queue_are_bounded():
+    guard = UpstreamGuard("test", slots=2, queue_size=1, queue_timeout=5, deadline=5)
+    running, most = [0], [0]
+    lock = threading.Lock()
+
+    def slow_call():
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(0.2)
+        with lock:
+            running[0] -= 1
+        return "ok"
+
+    results = _run_concurrently(guard, slow_call, 6)
+    assert most[0] == 2
+    assert results.count("ok") == 3     # 2 running + 1 queued
+    assert all(isinstance(r, Overloaded) for r in results if r != "ok")
+    assert guard.stats()["rejected"] == 3
+
+
+def test_queue_timeout_and_deadline():
+    guard = UpstreamGuard("test", slots=1, queue_size=5, queue_timeout=0.05, deadline=0.1)
+    release = threading.Event()
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        guard.call(release.wait)
+    assert time.monotonic() - started < 0.5
+    # The abandoned call still holds the only slot, so the next caller can't get in
+    with pytest.raises(Overloaded):
+        guard.call(lambda: "never")
+    assert guard.stats()["running"] == 1
+    release.set()
+    time.sleep(0.05)
+    assert guard.call(lambda: "ok") == "ok"
+
+
+def test_breaker_opens_on_errors_then_recovers():
+    breaker = CircuitBreaker("test", window=10, min_calls=4, error_rate=0.5, open_seconds=0.1)
+    guard = UpstreamGuard("test", slots=2, deadline=5, breaker=breaker)
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise RuntimeError("vertex down")
+
+    for _ in range(4):
+        with pytest.raises(RuntimeError):
+            guard.call(failing)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen) as info:
+        guard.call(failing)
+    assert len(calls) == 4 and info.value.retry_after >= 0.1
+
+    time.sleep(0.15)
+    assert guard.call(lambda: "ok") == "ok"    # the trial call
+    assert breaker.state == "closed"
+
+
+def test_breaker_opens_on_slow_calls():
+    breaker = CircuitBreaker("test", window=4, min_calls=4, slow_seconds=0.02, slow_rate=0.5)
+    guard = UpstreamGuard("test", slots=1, deadline=5, breaker=breaker)
+    for delay in (0, 0.03, 0, 0.03):
+        guard.call(time.sleep, delay)
+    assert breaker.stats()["state"] == "open"
@@ -0,0 +1,58 @@
+import io
+import json
+import time
+import queue
+import logging
+
+import applog
+from applog import _ContextFilter, _QueueHandler, LOG_DROPPED
+
+
+def test_lines_carry_request_id_extras_and_stages():
+    applog.stop()
+    out = io.StringIO()
+    applog.setup(level="DEBUG", fmt="json", sample="", stream=out)
+    log = logging.getLogger("test_applog")
+    try:
+        request_id = applog.begin_request("req-1")
+        with applog.stage("model_call"):
+            time.sleep(0.01)
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError:
+            log.exception("call failed", extra={"userId": "u1"})
+        stages = applog.stages()
+        applog.end_request()
+        log.info("outside a request")
+    finally:
+        applog.stop()
+
+    first, second = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert request_id == "req-1"
+    assert first["requestId"] == "req-1" and first["userId"] == "u1" and first["level"] == "ERROR"
+    assert "RuntimeError: boom" in first["exc"]
+    assert "requestId" not in second
+    assert stages["model_call"] >= 10
+
+
+def test_sampling_keeps_or_drops_a_whole_request():
+    sampler = _ContextFilter(applog.parse_sample("DEBUG=0.25"))
+    kept = 0
+    for i in range(1000):
+        applog.begin_request(f"request-{i}")
+        decisions = {sampler.filter(logging.makeLogRecord({"levelno": logging.DEBUG})) for _ in range(3)}
+        assert len(decisions) == 1
+        kept += decisions.pop()
+        assert sampler.filter(logging.makeLogRecord({"levelno": logging.WARNING}))
+    applog.end_request()
+    assert 150 < kept < 350
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = _QueueHandler(queue.Queue(1))
+    before = LOG_DROPPED.value()
+    record = logging.makeLogRecord({"msg": "hello %s", "args": ("world",)})
+    handler.handle(record)
+    handler.handle(record)
+    assert handler.queue.get_nowait().msg == "hello world"
+    assert LOG_DROPPED.value() == before + 1
@@ -0,0 +1,107 @@
+import os
+import gzip
+import tempfile
+
+from flask import Flask, request, Response
+
+from assets import AssetStore
+
+PAGE = '<img src="Media/image.png?v=2"><video src="/Media/clip.mp4"></video><a href="Media/missing.png">x</a>'
+
+
+def _store(cache_dir=None):
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, "Media"))
+    with open(os.path.join(root, "index.html"), "w") as f:
+        f.write(PAGE * 50)
+    for name, data in (("image.png", b"png"), ("clip.mp4", b"mp4")):
+        with open(os.path.join(root, "Media", name), "wb") as f:
+            f.write(data)
+    return AssetStore(root, os.path.join(root, "Media"), pages=("index.html",), cache_dir=cache_dir)
+
+
+def test_media_links_are_fingerprinted():
+    store = _store()
+    html = store.page("index.html").bodies[None].decode()
+    image = store.fingerprinted_name("image.png")
+    assert f'src="Media/{image}"' in html
+    assert f'src="/Media/{store.fingerprinted_name("clip.mp4")}"' in html
+    assert 'href="Media/missing.png"' in html     # no such file: left alone
+    assert "?v=2" not in html
+
+    assert store.resolve_media(image) == ("image.png", True)
+    assert store.resolve_media("image.0123456789.png") == ("image.png", False)
+    assert store.resolve_media("image.png") == ("image.png", False)
+
+
+def test_negotiates_encoding_and_revalidates():
+    store = _store()
+    app = Flask(__name__)
+
+    @app.route("/<name>")
+    def page(name):
+        p = store.page(name)
+        encoding, body = store.choose(p, request.accept_encodings)
+        response = Response(body, mimetype="text/html")
+        response.set_etag(f"{p.digest}-{encoding or 'identity'}")
+        if encoding:
+            response.content_encoding = encoding
+        return response.make_conditional(request)
+
+    client = app.test_client()
+    plain = client.get("/index.html")
+    assert "Content-Encoding" not in plain.headers
+
+    zipped = client.get("/index.html", headers={"Accept-Encoding": "gzip, deflate"})
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(zipped.data) == plain.data
+    assert len(zipped.data) < len(plain.data) / 5
+    assert zipped.headers["ETag"] != plain.headers["ETag"]
+
+    again = client.get("/index.html", headers={"Accept-Encoding": "gzip",
+                                               "If-None-Match": zipped.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.data == b""
+
+
+def test_compressed_copies_are_cached_and_pages_reload():
+    cache_dir = tempfile.mkdtemp()
+    store = _store(cache_dir)
+    first = store.page("index.html")
+    assert f"{first.digest}.gzip" in os.listdir(cache_dir)
+
+    # Another process finds the cached copy instead of compressing again
+    other = _store(cache_dir)
+    other.root = store.root
+    other.media_dir = store.media_dir
+    other.compressors = {"gzip": lambda data: b"not used"}
+    assert other.page("index.html").bodies["gzip"] == first.bodies["gzip"]
+
+    store.check_interval = 0
+    path = os.path.join(store.root, "index.html")
+    with open(path, "w") as f:
+        f.write("<p>changed</p>")
+    os.utime(path, ns=(first.mtime + 10 ** 9, first.mtime + 10 ** 9))
+    assert store.page("index.html").bodies[None] == b"<p>changed</p>"
+
+
+def test_pages_reload_when_a_linked_media_file_changes():
+    store = _store()
+    store.check_interval = 0
+    first = store.page("index.html")
+    assert store.page("index.html") is first
+    old_link = f'src="Media/{store.fingerprinted_name("image.png")}"'
+
+    path = os.path.join(store.media_dir, "image.png")
+    with open(path, "wb") as f:
+        f.write(b"new png")
+    os.utime(path, ns=(first.mtime + 10 ** 9, first.mtime + 10 ** 9))
+    html = store.page("index.html").bodies[None].decode()
+    assert old_link not in html
+    assert f'src="Media/{store.fingerprinted_name("image.png")}"' in html
+    assert store.page("index.html").digest != first.digest
+
+    # A linked file that didn't exist at load time counts too
+    with open(os.path.join(store.media_dir, "missing.png"), "wb") as f:
+        f.write(b"late")
+    assert 'href="Media/missing.png"' not in store.page("index.html").bodies[None].decode()
@@ -0,0 +1,82 @@
+import time
+import threading
+
+import pytest
+
+from admission import UpstreamGuard, DeadlineExceeded
+from callpolicy import CallPolicy, UPSTREAM_ATTEMPTS, HEDGE_WINS
+
+
+class ServiceUnavailable(Exception):
+    """Named like google.api_core.exceptions.ServiceUnavailable"""
+
+
+def _flaky(failures, error=ServiceUnavailable):
+    calls = []
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) <= failures:
+            raise error("try again")
+        return "image"
+    return fn, calls
+
+
+def test_transient_errors_are_retried_with_backoff():
+    guard = UpstreamGuard("test-retry", slots=2, deadline=5)
+    policy = CallPolicy(guard, attempts=3, base_delay=0.01, max_delay=0.02)
+    fn, calls = _flaky(2)
+    before = UPSTREAM_ATTEMPTS.value(dependency="test-retry", kind="retry")
+
+    assert policy.call(fn) == "image"
+    assert len(calls) == 3
+    assert UPSTREAM_ATTEMPTS.value(dependency="test-retry", kind="retry") == before + 2
+
+    fn, calls = _flaky(5)
+    with pytest.raises(ServiceUnavailable):
+        policy.call(fn)
+    assert len(calls) == 3
+
+    fn, calls = _flaky(1, error=ValueError)   # not transient
+    with pytest.raises(ValueError):
+        policy.call(fn)
+    assert len(calls) == 1
+
+
+def test_budget_caps_the_whole_call(monkeypatch):
+    monkeypatch.setattr("callpolicy.random.uniform", lambda low, high: high)
+    guard = UpstreamGuard("test-budget", slots=2, deadline=5)
+    policy = CallPolicy(guard, attempts=5, base_delay=10, budget=0.2)
+    fn, calls = _flaky(5)
+    started = time.monotonic()
+    with pytest.raises(ServiceUnavailable):
+        policy.call(fn)     # a retry would have to sleep past the budget
+    assert len(calls) == 1
+
+    release = threading.Event()
+    with pytest.raises(DeadlineExceeded):
+        policy.call(release.wait)
+    release.set()
+    assert time.monotonic() - started < 1
+
+
+def test_slow_call_is_hedged_and_the_fast_one_wins():
+    guard = UpstreamGuard("test-hedge", slots=4, deadline=5)
+    policy = CallPolicy(guard, hedge_quantile=0.9, hedge_min_seconds=0.01, min_samples=5)
+    for _ in range(5):
+        policy.call(lambda: time.sleep(0.01))
+    assert 0.01 <= policy.hedge_delay() < 0.1
+
+    calls = []
+
+    def sometimes_stuck():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(1)
+            return "slow"
+        return "fast"
+
+    started = time.monotonic()
+    assert policy.call(sometimes_stuck) == "fast"
+    assert time.monotonic() - started < 0.5
+    assert HEDGE_WINS.value(dependency="test-hedge") == 1
@@ -0,0 +1,191 @@
+import os
+import tempfile
+import threading
+
+import pytest
+
+import fake_firebase
+from ledger import CreditLedger
+from reservations import FirebaseCreditStore, LedgerCreditStore, InsufficientCredits, GrantOutcomeUnknown
+
+
+def _hammer(store, user_id, threads=16, attempts=25, cost=1):
+    """Reserve from many threads at once. Returns the number of successful reservations."""
+    won = []
+
+    def worker():
+        for _ in range(attempts):
+            try:
+                store.reserve(user_id, cost).commit()
+                won.append(1)
+            except InsufficientCredits:
+                pass
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return len(won)
+
+
+def test_firebase_reservations_never_overspend():
+    fake_db = fake_firebase.FakeDatabase(latency=0.001)
+    store = FirebaseCreditStore(fake_db)
+    store.grant("alice", 100)
+
+    assert _hammer(store, "alice") == 100
+    assert store.balance("alice") == 0
+
+
+def test_firebase_reserve_is_one_round_trip_when_warm():
+    fake_db = fake_firebase.FakeDatabase()
+    store = FirebaseCreditStore(fake_db)
+    store.grant("bob", 10)
+
+    before = fake_db.round_trips
+    store.reserve("bob", 1).commit()
+    assert fake_db.round_trips - before == 1
+
+
+def test_firebase_stale_cache_sees_grants_from_elsewhere():
+    fake_db = fake_firebase.FakeDatabase()
+    store = FirebaseCreditStore(fake_db)
+    store.grant("carol", 1)
+    store.reserve("carol", 1).commit()
+
+    # Another instance grants credits behind our back
+    FirebaseCreditStore(fake_db).grant("carol", 5)
+
+    reservation = store.reserve("carol", 3)
+    assert reservation.balance == 2
+
+
+def test_reservation_refunds_on_error():
+    fake_db = fake_firebase.FakeDatabase()
+    store = FirebaseCreditStore(fake_db)
+    store.grant("dave", 5)
+
+    with pytest.raises(RuntimeError):
+        with store.reserve("dave", 5):
+            raise RuntimeError("Vertex failed")
+
+    assert store.balance("dave") == 5
+
+
+def test_firebase_daily_claim_is_once_and_keeps_concurrent_grants():
+    fake_db = fake_firebase.FakeDatabase(latency=0.001)
+    store = FirebaseCreditStore(fake_db)
+    store.grant("gina", 10)
+
+    results = []
+    def claim():
+        results.append(store.claim_daily("gina", 15, "2025-01-01")[0])
+    threads = [threading.Thread(target=claim) for _ in range(4)]
+    threads += [threading.Thread(target=store.grant, args=("gina", 5)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results.count(True) == 1
+    assert store.balance("gina") == 10 + 15 + 4 * 5
+    assert store.claim_daily("gina", 15, "2025-01-02") == (True, 60)
+
+
+def test_refund_retries_transient_failures():
+    fake_db = fake_firebase.FakeDatabase()
+    store = FirebaseCreditStore(fake_db)
+    store.grant("hank", 5)
+    reservation = store.reserve("hank", 5)
+
+    fake_db.error_rate = 1.0
+    threading.Timer(0.1, setattr, (fake_db, "error_rate", 0.0)).start()
+    assert reservation.refund() == 5
+    assert store.balance("hank") == 5
+
+
+def test_refund_applied_before_a_timeout_is_not_repeated():
+    fake_db = fake_firebase.FakeDatabase()
+    store = FirebaseCreditStore(fake_db)
+    store.grant("ivy", 5)
+    reservation = store.reserve("ivy", 3)
+    reservation.reduce_to(2)
+
+    fake_db.lost_replies = 2     # the write lands, then the reply times out
+    assert reservation.refund() == 5
+    assert store.balance("ivy") == 5
+
+
+def test_ledger_reservations_never_overspend():
+    path = os.path.join(tempfile.mkdtemp(), "credits.db")
+    store = LedgerCreditStore(CreditLedger(path))
+    store.grant("erin", 100)
+
+    assert _hammer(store, "erin") == 100
+    assert store.balance("erin") == 0
+
+    with pytest.raises(InsufficientCredits):
+        store.reserve("erin", 1)
+
+
+def test_keyed_grant_applies_once():
+    path = os.path.join(tempfile.mkdtemp(), "credits.db")
+    for store in (LedgerCreditStore(CreditLedger(path)), FirebaseCreditStore(fake_firebase.FakeDatabase())):
+        assert store.grant("ivy", 200, key="stripe:evt_1") == 200
+        assert store.grant("ivy", 200, key="stripe:evt_1") == 200
+        assert store.grant("ivy", 5) == 205
+        assert store.grant("ivy", 200, key="stripe:evt_2") == 405
+        assert store.balance("ivy") == 405
+
+
+def test_bulk_grant_is_one_update_next_to_reservations():
+    fake_db = fake_firebase.FakeDatabase(latency=0.001)
+    store = FirebaseCreditStore(fake_db)
+    store.grant("jack", 10)
+    reservation = store.reserve("jack", 4)     # warm ETag cache for jack
+
+    before = fake_db.round_trips
+    grants = [(f"user-{i}", 5) for i in range(100)] + [("jack", 20), ("jack", 1)]
+    balances = store.grant_many(grants)
+    assert fake_db.round_trips - before == 1 + 101   # one update, then the reads back
+    assert balances["user-7"] == 5
+    assert balances["jack"] == 6 + 21
+
+    # The reservation's refund and new reservations see the bulk grant
+    assert reservation.refund() == 31
+    assert store.reserve("jack", 31).balance == 0
+    assert store.balances(["user-1", "nobody"]) == {"user-1": 5, "nobody": 0}
+
+
+def test_bulk_grant_failure_after_sending_is_reported_as_unknown():
+    fake_db = fake_firebase.FakeDatabase()
+    store = FirebaseCreditStore(fake_db)
+
+    class Rejected(Exception):
+        code = "PERMISSION_DENIED"
+
+    for error, expected in ((TimeoutError("read timed out"), GrantOutcomeUnknown), (Rejected(), Rejected)):
+        fake_db.reference = lambda path, error=error: _failing_update(error)
+        with pytest.raises(expected):
+            store.grant_many([("amy", 5)])
+
+
+def _failing_update(error):
+    class Reference:
+        def update(self, value):
+            raise error
+    return Reference()
+
+
+def test_ledger_bulk_grant_and_read():
+    path = os.path.join(tempfile.mkdtemp(), "credits.db")
+    store = LedgerCreditStore(CreditLedger(path))
+    store.grant("kim", 3)
+    balances = store.grant_many([(f"user-{i}", i) for i in range(1200)] + [("kim", 2), ("kim", 5)])
+    assert balances["kim"] == 10
+    assert balances["user-999"] == 999
+
+    read = store.balances([f"user-{i}" for i in range(1200)] + ["nobody"])
+    assert read["user-1199"] == 1199
+    assert read["nobody"] == 0
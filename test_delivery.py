@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+from flask import Flask
+from werkzeug.wsgi import FileWrapper
+
+from delivery import atomic_write, send_static
+
+
+def _app(directory, mode="python"):
+    app = Flask(__name__)
+    app.config["USE_X_SENDFILE"] = mode == "x-sendfile"
+
+    @app.route("/files/<path:filename>")
+    def static_file(filename):
+        return send_static(directory, filename, mode=mode)
+
+    return app
+
+
+def test_atomic_write_leaves_no_temp_files():
+    directory = tempfile.mkdtemp()
+    atomic_write(os.path.join(directory, "generated_1.png"), b"png")
+    assert os.listdir(directory) == ["generated_1.png"]
+
+
+def test_generated_files_are_immutable_and_revalidate():
+    directory = tempfile.mkdtemp()
+    atomic_write(os.path.join(directory, "generated_1.png"), b"png")
+    client = _app(directory).test_client()
+
+    first = client.get("/files/generated_1.png")
+    assert first.status_code == 200
+    assert first.data == b"png"
+    assert "immutable" in first.headers["Cache-Control"]
+    assert not first.headers["ETag"].startswith("W/")
+
+    again = client.get("/files/generated_1.png", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+
+
+def test_proxy_modes_send_headers_only():
+    directory = tempfile.mkdtemp()
+    atomic_write(os.path.join(directory, "generated_1.png"), b"png")
+
+    accel = _app(directory, "x-accel").test_client().get("/files/generated_1.png")
+    assert accel.headers["X-Accel-Redirect"] == "/_static/generated_1.png"
+    assert accel.data == b""
+
+    sendfile = _app(directory, "x-sendfile").test_client().get("/files/generated_1.png")
+    assert sendfile.headers["X-Sendfile"].endswith("generated_1.png")
+    assert sendfile.data == b""
+
+
+def test_missing_and_escaping_paths_404():
+    client = _app(tempfile.mkdtemp()).test_client()
+    assert client.get("/files/nope.png").status_code == 404
+    assert client.get("/files/../etc/passwd").status_code == 404
+
+
+def test_byte_ranges():
+    directory = tempfile.mkdtemp()
+    data = bytes(range(256)) * 40
+    atomic_write(os.path.join(directory, "generated_1.mp4"), data)
+    client = _app(directory).test_client()
+
+    full = client.get("/files/generated_1.mp4")
+    assert full.headers["Accept-Ranges"] == "bytes"
+    etag = full.headers["ETag"]
+
+    part = client.get("/files/generated_1.mp4", headers={"Range": "bytes=100-199"})
+    assert part.status_code == 206
+    assert part.headers["Content-Range"] == f"bytes 100-199/{len(data)}"
+    assert part.data == data[100:200]
+
+    tail = client.get("/files/generated_1.mp4", headers={"Range": "bytes=-50", "If-Range": etag})
+    assert tail.status_code == 206 and tail.data == data[-50:]
+
+    # The file the client has is not this one: If-Range says send it whole
+    stale = client.get("/files/generated_1.mp4", headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+    assert stale.status_code == 200 and stale.data == data
+
+    # Open-ended ranges go to the server's file wrapper (sendfile under gunicorn)
+    wrapped = []
+    def file_wrapper(f, size):
+        wrapped.append(f.tell())
+        return FileWrapper(f, size)
+    rest = client.get("/files/generated_1.mp4", headers={"Range": "bytes=1000-"},
+                      environ_overrides={"wsgi.file_wrapper": file_wrapper})
+    assert rest.status_code == 206 and rest.data == data[1000:]
+    assert wrapped == [1000]
+
+    outside = client.get("/files/generated_1.mp4", headers={"Range": f"bytes={len(data)}-"})
+    assert outside.status_code == 416
+    assert outside.headers["Content-Range"] == f"bytes */{len(data)}"
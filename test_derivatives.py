@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+from PIL import Image
+
+from derivatives import (DerivativePipeline, make_variants, pick_variant, remove_variants,
+                         supported_formats, variant_path)
+
+
+def _image(width=1000, height=600):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "generated_1.png")
+    # Noise-free gradient: PNG is big, WebP much smaller
+    img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    img.save(path)
+    return path
+
+
+def test_variants_are_smaller_and_never_upscaled():
+    path = _image()
+    make_variants(path, ("webp",))
+
+    full = variant_path(path, "webp")
+    assert os.path.getsize(full) < os.path.getsize(path)
+    with Image.open(variant_path(path, "webp", 640)) as img:
+        assert img.size == (640, 384)
+    assert not os.path.exists(variant_path(path, "webp", 1280))
+
+
+def test_pick_variant_follows_accept_and_width_hint():
+    path = _image()
+    make_variants(path, ("webp",))
+
+    assert pick_variant(path, "image/png,*/*", 320, ("webp",)) == path
+    assert pick_variant(path, "image/webp,*/*", None, ("webp",)) == variant_path(path, "webp")
+    assert pick_variant(path, "image/webp,*/*", 500, ("webp",)) == variant_path(path, "webp", 640)
+    # No variant wide enough: the full-size one
+    assert pick_variant(path, "image/webp,*/*", 1200, ("webp",)) == variant_path(path, "webp")
+    # Asked for AVIF first but only WebP exists
+    assert pick_variant(path, "image/avif,image/webp", None, ("avif", "webp")) == variant_path(path, "webp")
+
+    remove_variants(path)
+    assert pick_variant(path, "image/webp,*/*", None, ("webp",)) == path
+
+
+def test_pipeline_runs_in_worker_processes():
+    path = _image(400, 300)
+    pipeline = DerivativePipeline(workers=1)
+    try:
+        assert pipeline.submit(path).result(timeout=60) > 0
+    finally:
+        pipeline.shutdown()
+    for fmt in supported_formats():
+        assert os.path.exists(variant_path(path, fmt, 320))
+    assert pipeline.stats()["completed"] == 1
@@ -0,0 +1,54 @@
+import os
+import shutil
+import struct
+import tempfile
+
+from faststart import faststart, needs_faststart, top_level_atoms, _shift_offsets
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE = os.path.join(BASE_DIR, "Media", "video1.mp4")   # ftyp, moov, free, mdat
+
+
+def _moov_last(src, dst):
+    """Write `src` the way many encoders do: moov after the media data."""
+    with open(src, "rb") as f:
+        atoms = top_level_atoms(f)
+        parts = {kind: (f.seek(offset), f.read(size))[1] for kind, offset, size in atoms}
+    moov = bytearray(parts[b"moov"])
+    _shift_offsets(moov, 8, len(moov), -len(moov), float("inf"))
+    with open(dst, "wb") as f:
+        for kind, _, _ in atoms:
+            if kind != b"moov":
+                f.write(parts[kind])
+        f.write(moov)
+
+
+def test_moov_moves_to_the_front_and_offsets_follow():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "video.mp4")
+    _moov_last(SAMPLE, path)
+    assert needs_faststart(path)
+
+    assert faststart(path)
+    assert not needs_faststart(path)
+    with open(path, "rb") as f:
+        assert [kind for kind, _, _ in top_level_atoms(f)] == [b"ftyp", b"free", b"moov", b"mdat"]
+        rewritten = f.seek(0) or f.read()
+    with open(SAMPLE, "rb") as f:
+        original = f.read()
+    # Same moov (so the same chunk offsets) and media data at the same place as the original
+    assert len(rewritten) == len(original)
+    mdat = original.index(b"mdat") - 4
+    assert rewritten[mdat:] == original[mdat:]
+    moov = original.index(b"moov") - 4
+    moov_size = struct.unpack(">I", original[moov:moov + 4])[0]
+    assert original[moov:moov + moov_size] in rewritten
+    assert not [name for name in os.listdir(directory) if name.startswith(".tmp-")]
+
+
+def test_faststart_files_are_left_alone():
+    path = os.path.join(tempfile.mkdtemp(), "video.mp4")
+    shutil.copy(SAMPLE, path)
+    before = os.stat(path).st_mtime_ns
+    assert not faststart(path)
+    assert os.stat(path).st_mtime_ns == before
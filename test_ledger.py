@@ -0,0 +1,90 @@
+import os
+import json
+import tempfile
+import threading
+
+from ledger import CreditLedger, open_ledger
+
+
+def _ledger():
+    return CreditLedger(os.path.join(tempfile.mkdtemp(), "credits.db"))
+
+
+def _write_json(directory, name, data):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        json.dump(data, f)
+    return path
+
+
+def test_imports_the_legacy_json_files():
+    tmp = tempfile.mkdtemp()
+    credits_file = _write_json(tmp, "user_credits.json", {"alice": 12, "bob": "3"})
+    claims_file = _write_json(tmp, "daily_claims.json", {"alice": "2025-01-01", "carol": "2025-01-02"})
+    ledger = _ledger()
+    ledger.grant("alice", 100)
+
+    assert ledger.import_json(credits_file, claims_file) == 3
+    # The files overwrite what was stored; users only in the claims file start at 0
+    assert ledger.get("alice") == (12, "2025-01-01")
+    assert ledger.get("bob") == (3, None)
+    assert ledger.get("carol") == (0, "2025-01-02")
+    assert ledger.claim_daily("alice", 5, "2025-01-01") == (False, 12)
+    assert ledger.import_json(os.path.join(tmp, "missing.json")) == 0
+
+    # open_ledger imports only when it creates the database
+    path = os.path.join(tmp, "credits.db")
+    assert open_ledger(path, credits_file, claims_file).get_balance("alice") == 12
+    _write_json(tmp, "user_credits.json", {"alice": 99})
+    assert open_ledger(path, credits_file, claims_file).get_balance("alice") == 12
+
+
+def test_daily_credits_are_claimed_once_per_day():
+    ledger = _ledger()
+    ledger.grant("dan", 2)
+
+    assert ledger.claim_daily("dan", 10, "2025-03-01") == (True, 12)
+    assert ledger.claim_daily("dan", 10, "2025-03-01") == (False, 12)
+    assert ledger.claim_daily("dan", 10, "2025-03-02") == (True, 22)
+    assert ledger.get("dan") == (22, "2025-03-02")
+    # A first claim creates the user
+    assert ledger.claim_daily("new", 10, "2025-03-02") == (True, 10)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(ledger.claim_daily("dan", 10, "2025-03-03")))
+               for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [claimed for claimed, _ in results].count(True) == 1
+    assert ledger.get_balance("dan") == 32
+
+
+def test_concurrent_deducts_never_overspend():
+    ledger = _ledger()
+    ledger.grant("erin", 100)
+    results = []
+
+    def worker():
+        for _ in range(25):
+            results.append(ledger.deduct("erin", 3))
+
+    threads = [threading.Thread(target=worker) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [success for success, _ in results].count(True) == 33
+    assert min(balance for _, balance in results) == 1
+    assert ledger.get_balance("erin") == 1
+    assert ledger.deduct("erin", 3) == (False, 1)
+    assert ledger.deduct("nobody", 1) == (False, 0)
+
+
+def test_keyed_grants_apply_once():
+    ledger = _ledger()
+    assert ledger.grant("fay", 50, key="stripe:evt_1", plan="pro") == 50
+    assert ledger.grant("fay", 50, key="stripe:evt_1", plan="pro") == 50
+    assert ledger.grant("fay", 5) == 55
+    assert ledger.get_plan("fay") == "pro"
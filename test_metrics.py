@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from metrics import MIN_RETIRE_AT, Registry, Counter, Gauge, Histogram, Timed, DEPENDENCY_SECONDS, DEPENDENCY_ERRORS
+
+
+def test_counters_from_many_threads_add_up():
+    registry = Registry()
+    requests = Counter(registry, "requests_total", "Requests", ("route",))
+
+    def work():
+        for _ in range(1000):
+            requests.inc(route="/generate")
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert requests.value(route="/generate") == 8000
+    # Exited threads are folded into the shared total and their dicts dropped
+    assert all(t.is_alive() for t, _ in registry._shards)
+    assert 'requests_total{route="/generate"} 8000' in registry.render()
+
+
+def test_dead_thread_shards_are_folded_without_a_scrape():
+    registry = Registry()
+    requests = Counter(registry, "requests_total", "Requests")
+    for _ in range(5000):
+        t = threading.Thread(target=requests.inc)
+        t.start()
+        t.join()
+    assert len(registry._shards) < MIN_RETIRE_AT
+    assert registry.collect() == {("requests_total", ()): 5000}
+
+
+def test_histogram_buckets_and_quantiles():
+    registry = Registry()
+    latency = Histogram(registry, "latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+    for _ in range(98):
+        latency.observe(0.05, route="/a")
+    latency.observe(0.5, route="/a")
+    latency.observe(5.0, route="/a")
+
+    text = registry.render()
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 98' in text
+    assert 'latency_seconds_bucket{route="/a",le="1.0"} 99' in text
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 100' in text
+    assert 'latency_seconds_count{route="/a"} 100' in text
+    assert 'latency_seconds_quantile{route="/a",quantile="0.5"}' in text
+
+    q = latency.quantiles(route="/a")
+    assert q[0.5] < 0.1 and 0.1 < q[0.99] <= 1.0
+
+
+def test_gauge_tracks_in_flight():
+    registry = Registry()
+    in_flight = Gauge(registry, "in_flight", "In flight")
+    with in_flight.track():
+        assert in_flight.value() == 1
+    assert in_flight.value() == 0
+
+
+class _Ref:
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        return {"balance": 5}
+
+    def update(self, value):
+        raise RuntimeError("offline")
+
+
+class _Db:
+    def reference(self, path):
+        return _Ref(path)
+
+
+def test_timed_proxy_times_chained_calls():
+    db = Timed(_Db(), "testdb", timed=("get", "update"), chained=("reference",))
+    before = DEPENDENCY_SECONDS.quantiles(dependency="testdb", operation="get")
+
+    assert db.reference("credits/u1").get() == {"balance": 5}
+    assert db.reference("credits/u1").path == "credits/u1"
+    with pytest.raises(RuntimeError):
+        db.reference("credits/u1").update({"balance": 1})
+
+    assert before[0.5] == 0.0
+    assert DEPENDENCY_SECONDS.quantiles(dependency="testdb", operation="get")[0.5] > 0
+    assert DEPENDENCY_ERRORS.value(dependency="testdb", operation="update") == 1
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from microbatch import MicroBatcher, ShortBatch
+
+
+def _submit_together(batcher, keys):
+    results = [None] * len(keys)
+
+    def run(i, key):
+        try:
+            results[i] = batcher.submit(key, key)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i, key)) for i, key in enumerate(keys)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_requests_in_window_share_one_call():
+    calls = []
+
+    def run_batch(prompt, count):
+        calls.append(count)
+        return [f"{prompt}-{i}" for i in range(count)]
+
+    batcher = MicroBatcher(run_batch, window=0.2, max_batch=4)
+    results = _submit_together(batcher, ["cat"] * 3 + ["dog"])
+
+    assert sorted(results[:3]) == ["cat-0", "cat-1", "cat-2"]
+    assert results[3] == "dog-0"
+    assert sorted(calls) == [1, 3]
+    assert batcher.stats()["saved"] == 2
+
+
+def test_batches_are_capped_at_max_batch():
+    calls = []
+    batcher = MicroBatcher(lambda prompt, n: calls.append(n) or list(range(n)), window=0.2, max_batch=2)
+    _submit_together(batcher, ["cat"] * 4)
+    assert calls == [2, 2]
+
+
+def test_short_batch_and_errors():
+    batcher = MicroBatcher(lambda prompt, n: ["only-one"], window=0.2, max_batch=4)
+    results = _submit_together(batcher, ["cat"] * 2)
+    assert "only-one" in results
+    assert any(isinstance(r, ShortBatch) for r in results)
+
+    def boom(prompt, n):
+        raise RuntimeError("vertex down")
+
+    with pytest.raises(RuntimeError):
+        MicroBatcher(boom, window=0).submit("cat", "cat")
@@ -0,0 +1,94 @@
+import os
+import tempfile
+
+import pytest
+
+import fake_firebase
+import fake_imagen
+from ledger import CreditLedger
+from model_router import ModelRouter, Tier
+from reservations import FirebaseCreditStore, LedgerCreditStore
+
+PLANS = {None: ("standard", "standard"), "pro": ("standard", "ultra"), "enterprise": ("ultra", "ultra")}
+
+
+def _router(load=None):
+    model = fake_imagen.FakeImageGenerationModel()
+    return ModelRouter([
+        Tier("fast", model, "fast-model", usd_per_image=0.02, expected_seconds=2),
+        Tier("standard", model, "standard-model", usd_per_image=0.04, expected_seconds=6),
+        Tier("ultra", model, "ultra-model", credits=2, usd_per_image=0.06, expected_seconds=10, max_images=1),
+    ], load=load, slo_seconds=12, plans=PLANS)
+
+
+def _names(choice):
+    tier, reason = choice
+    return tier.name, reason
+
+
+def test_quality_hint_and_plan_pick_the_tier():
+    router = _router()
+    assert _names(router.choose()) == ("standard", "plan")
+    assert _names(router.choose(plan="enterprise")) == ("ultra", "plan")
+    assert _names(router.choose("fast", "enterprise")) == ("fast", "requested")
+    assert _names(router.choose("ultra", "pro")) == ("ultra", "requested")
+    # Without a plan, and for multi-image calls, ultra is out of reach
+    assert _names(router.choose("ultra")) == ("standard", "capped")
+    assert _names(router.choose("ultra", "pro", images=4)) == ("standard", "capped")
+
+
+def test_degrades_to_faster_tiers_under_load():
+    load = {"slots": 4, "running": 4, "queued": 0}
+    router = _router(lambda: load)
+
+    # One request ahead per slot: ~6s wait, ultra (10s) would miss the 12s SLO
+    load["queued"] = 3
+    assert _names(router.choose("ultra", "pro")) == ("standard", "degraded")
+
+    load["queued"] = 7          # ~12s wait: only fast is left
+    assert _names(router.choose(plan="enterprise")) == ("fast", "degraded")
+
+    load["running"] = 2         # free slots again
+    assert _names(router.choose(plan="enterprise")) == ("ultra", "plan")
+
+
+def test_slow_upstream_moves_requests_off_a_tier():
+    router = _router()
+    standard = router.by_name["standard"]
+    for _ in range(10):
+        router._record(standard, 20.0, images=1)
+    assert _names(router.choose()) == ("fast", "degraded")
+
+
+def test_call_tracks_latency_images_and_cost():
+    router = _router()
+    fast = router.by_name["fast"]
+    res = router.call(fast, lambda fn, **params: fn(**params), prompt="a cat", number_of_images=3)
+    assert len(res.images) == 3
+
+    fast.model.error_rate = 1.0
+    with pytest.raises(ConnectionError):
+        router.call(fast, lambda fn, **params: fn(**params), prompt="a cat")
+
+    stats = router.stats()["tiers"]["fast"]
+    assert (stats["calls"], stats["failures"], stats["images"]) == (2, 1, 3)
+    assert stats["costUsd"] == 0.06
+    assert stats["latencySeconds"] < 2
+
+
+def test_stores_record_the_plan_with_the_grant():
+    path = os.path.join(tempfile.mkdtemp(), "credits.db")
+    fake_db = fake_firebase.FakeDatabase()
+    for store in (LedgerCreditStore(CreditLedger(path)), FirebaseCreditStore(fake_db)):
+        assert store.plan("lee") is None
+        store.grant("lee", 1000, key="stripe:evt_9", plan="pro")
+        store.grant("lee", 1000, key="stripe:evt_9", plan="enterprise")   # duplicate: ignored
+        assert store.plan("lee") == "pro"
+        assert store.balance("lee") == 1000
+
+    # The plan read warms the ETag cache: the reservation after it is one round trip
+    cold = FirebaseCreditStore(fake_db)
+    before = fake_db.round_trips
+    cold.plan("lee")
+    cold.reserve("lee", 1).commit()
+    assert fake_db.round_trips - before == 2
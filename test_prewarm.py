@@ -0,0 +1,89 @@
+import os
+import time
+import random
+import tempfile
+from collections import Counter
+
+from prewarm import SpaceSaving, VariantPool, Prewarmer
+
+
+def test_sketch_keeps_the_heavy_hitters_in_bounded_memory():
+    rng = random.Random(7)
+    stream = [f"hot-{i}" for i in range(5) for _ in range(200)] + [f"cold-{i}" for i in range(5000)]
+    rng.shuffle(stream)
+    sketch = SpaceSaving(capacity=50)
+    for key in stream:
+        sketch.add(key, sample=key.upper())
+
+    assert len(sketch.counts) == 50
+    top = sketch.top(5)
+    assert sorted(key for key, _, _ in top) == [f"hot-{i}" for i in range(5)]
+    truth = Counter(stream)
+    for key, count, sample in top:
+        assert sample == key.upper()
+        assert truth[key] <= count <= truth[key] + sketch.error(key)
+
+    sketch.decay()
+    assert all(count < 200 for _, count, _ in sketch.top(5))
+    assert sketch.top(1)[0][0].startswith("hot-")
+
+
+def test_pool_hands_each_image_out_once_and_expires_the_rest():
+    pool = VariantPool(tempfile.mkdtemp(), ttl=60)
+    pool.add("k", b"one")
+    pool.add("k", b"two")
+    assert pool.count("k") == 2 and pool.total() == 2
+
+    first, second = pool.claim("k"), pool.claim("k")
+    assert pool.claim("k") is None
+    with open(first, "rb") as f1, open(second, "rb") as f2:
+        assert (f1.read(), f2.read()) == (b"one", b"two")
+
+    pool.add("other", b"stale")
+    stale = os.path.join(pool.directory, "other", os.listdir(os.path.join(pool.directory, "other"))[0])
+    os.utime(stale, (time.time() - 120, time.time() - 120))
+    assert pool.expire() == 1
+    assert not os.path.exists(os.path.join(pool.directory, "other"))
+    assert os.path.exists(first)     # claimed files are the claimer's
+
+
+def test_prewarms_trending_prompts_only_when_idle_and_within_caps():
+    load = {"slots": 4, "running": 0, "queued": 0}
+    calls = []
+
+    def generate(sample, count):
+        calls.append((sample, count))
+        return [b"png"] * count
+
+    warmer = Prewarmer(VariantPool(tempfile.mkdtemp()), generate, lambda sample: 0.04, load=lambda: load,
+                       min_count=3, variants=2, max_images_per_hour=5, max_usd_per_day=1.0)
+    for _ in range(5):
+        warmer.observe("cat", ("a cat", "standard"))
+    for _ in range(3):
+        warmer.observe("dog", ("a dog", "fast"))
+    warmer.observe("once", ("a fish", "standard"))
+
+    load["running"] = 3                      # busy: nothing is spent
+    assert warmer.run_once() == 0
+    load["running"] = 1
+    assert warmer.run_once() == 4
+    assert calls == [(("a cat", "standard"), 2), (("a dog", "fast"), 2)]
+    assert warmer.run_once() == 0            # pools already full
+
+    assert warmer.claim("cat") and warmer.claim("cat") and warmer.claim("dog")
+    assert warmer.claim("cat") is None and warmer.claim("once") is None
+    # The hourly cap leaves room for one more image
+    assert warmer.run_once() == 1
+
+    stats = warmer.stats()
+    assert (stats["lookups"], stats["hits"], stats["hitRate"]) == (5, 3, 0.6)
+    assert (stats["generated"], stats["spentUsd"], stats["waiting"]) == (5, 0.2, 2)
+    # Nothing reported carries the prompt text
+    assert "a cat" not in repr(stats) and "a cat" not in repr(warmer.trending())
+    assert [(t["key"], t["count"], t["waiting"]) for t in warmer.trending(2)] == [("cat", 5, 1), ("dog", 3, 1)]
+
+    # The daily budget caps it too
+    cheap_day = Prewarmer(VariantPool(tempfile.mkdtemp()), generate, lambda sample: 0.4,
+                          min_count=1, variants=4, max_usd_per_day=1.0)
+    cheap_day.observe("cat", ("a cat", "ultra"))
+    assert cheap_day.run_once() == 2
@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+
+from profiler import Profiler, ProfileStore
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROFILE_SCRIPT = """
+import json
+import index
+client = index.app.test_client()
+auth = {"Authorization": "Bearer s3cret"}
+client.get('/get-credits/someone')
+client.get('/get-credits/someone', headers={"X-Profile-Token": "s3cret"})
+client.get('/get-credits/someone', headers={"X-Profile-Token": "wrong"})
+listing = client.get('/profiles', headers=auth).get_json()
+profile = listing["profiles"][0]
+print(json.dumps({
+    "listing": listing,
+    "folded": client.get(profile["url"], headers=auth).get_data(as_text=True),
+    "unauthorized": client.get('/profiles').status_code,
+    "missing": client.get('/profiles/123-nope', headers=auth).status_code,
+}))
+"""
+
+
+def _waits_on_upstream():
+    time.sleep(0.15)
+
+
+def _parses():
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        json.loads('{"a": [1, 2, 3]}')
+
+
+def test_samples_only_the_profiled_thread():
+    profiler = Profiler(ProfileStore(tempfile.mkdtemp()), interval=0.002)
+    stop = threading.Event()
+    bystander = threading.Thread(target=stop.wait)
+    bystander.start()
+
+    session = profiler.start()
+    _waits_on_upstream()
+    _parses()
+    meta = profiler.finish(session, "generate-abc", {"route": "/generate"})
+    stop.set()
+    bystander.join()
+
+    with open(profiler.store.path(meta["id"])) as f:
+        lines = f.read().splitlines()
+    stacks = {line.rsplit(" ", 1)[0]: int(line.rsplit(" ", 1)[1]) for line in lines}
+    assert sum(stacks.values()) == meta["samples"] > 0
+    assert all("test_samples_only_the_profiled_thread (test_profiler.py:" in s for s in stacks)
+    assert not any("wait (threading.py" in s for s in stacks)
+    # Wall clock: the sleep gets about three times the samples of the busy loop
+    waiting = sum(n for s, n in stacks.items() if "_waits_on_upstream" in s)
+    parsing = sum(n for s, n in stacks.items() if "_parses" in s)
+    assert waiting > parsing > 0
+    assert meta["route"] == "/generate" and meta["durationMs"] >= 200
+    assert profiler.stats() == {"active": 0, "profiles": 1, "intervalMs": 2}
+
+
+def test_store_keeps_the_newest_profiles():
+    store = ProfileStore(tempfile.mkdtemp(), max_profiles=3)
+    ids = [store.save(f"claim-daily-credits-{i}", {"a;b": i + 1}, {})["id"] for i in range(5)]
+    assert [meta["id"] for meta in store.list()] == ids[:1:-1]
+    assert len(os.listdir(store.directory)) == 6
+    assert store.path(ids[0]) is None
+    assert store.path("../../etc/passwd") is None
+    with open(store.path(ids[-1])) as f:
+        assert f.read() == "a;b 5\n"
+
+
+def test_requests_are_profiled_on_an_authorized_header():
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, WARM_UP="0", PYTHONPATH=BASE_DIR, PROFILE_TOKEN="s3cret",
+               PROFILE_DIR=os.path.join(tmp, "profiles"),
+               CREDITS_DB=os.path.join(tmp, "credits.db"),
+               VIDEO_JOBS_DB=os.path.join(tmp, "video_jobs.db"),
+               STRIPE_EVENTS_DB=os.path.join(tmp, "stripe_events.db"),
+               STORAGE_DB=os.path.join(tmp, "storage.db"))
+    out = subprocess.run([sys.executable, "-c", PROFILE_SCRIPT], cwd=tmp, env=env,
+                         capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+
+    profiles = result["listing"]["profiles"]
+    assert len(profiles) == 1
+    assert profiles[0]["route"] == "/get-credits/<user_id>"
+    assert (profiles[0]["status"], profiles[0]["reason"]) == (200, "requested")
+    # A fast request may finish before the first tick: the file is then empty
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in result["folded"].splitlines()) == profiles[0]["samples"]
+    assert (result["unauthorized"], result["missing"]) == (403, 404)
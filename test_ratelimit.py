@@ -0,0 +1,83 @@
+import os
+import time
+import tempfile
+import threading
+
+import pytest
+
+from ratelimit import Rate, RateLimiter, MemoryBuckets, SqliteBuckets
+
+
+def test_parse_rates():
+    assert Rate.parse("10/min") == Rate(10, 60)
+    assert Rate.parse("100/10s").per_second == 10
+    assert Rate.parse("0") is None and Rate.parse("") is None
+    with pytest.raises(ValueError):
+        Rate.parse("10 per minute")
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_bucket_bursts_then_refills(backend):
+    if backend == "memory":
+        buckets = MemoryBuckets(shards=4)
+    else:
+        buckets = SqliteBuckets(os.path.join(tempfile.mkdtemp(), "limits.db"))
+    rate = Rate(3, 60)   # one token every 20 s
+
+    assert [buckets.take("u1", rate, 1000.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert buckets.take("u1", rate, 1000.0) == pytest.approx(20.0)
+    assert buckets.take("u1", rate, 1010.0) == pytest.approx(10.0)
+    assert buckets.take("u1", rate, 1020.0) == 0.0
+    assert buckets.take("u2", rate, 1020.0) == 0.0   # other users have their own bucket
+
+
+def test_overall_limit_does_not_spend_user_tokens():
+    limiter = RateLimiter()
+    limiter.add("generate", per_user="2/min", overall="3/min")
+
+    assert [limiter.check("generate", user) for user in ("a", "b", "c")] == [0.0, 0.0, 0.0]
+    assert limiter.check("generate", "a") > 0       # overall bucket empty
+    # ...and "a" got that token back, so it still has one left of its own
+    assert limiter.buckets.take("generate:user:a", Rate(2, 60), time.time()) == 0.0
+    assert limiter.check("unlimited", "a") == 0.0
+
+
+def test_full_buckets_are_evicted():
+    buckets = MemoryBuckets(shards=1, sweep_interval=10)
+    rate = Rate(5, 5)
+    for i in range(100):
+        buckets.take(f"user-{i}", rate, 1000.0)
+    assert len(buckets) == 100
+    buckets.take("late", rate, 1003.0)     # before the next sweep
+    assert len(buckets) == 101
+    buckets.take("later", rate, 1011.0)    # sweeps; every earlier bucket has refilled by now
+    assert len(buckets) == 1
+
+
+def test_sqlite_buckets_are_shared_between_limiters():
+    path = os.path.join(tempfile.mkdtemp(), "limits.db")
+    workers = [RateLimiter(path) for _ in range(4)]
+    for limiter in workers:
+        limiter.add("claim-daily", per_user="50/hour")
+    allowed = []
+
+    def hammer(limiter):
+        for _ in range(25):
+            allowed.append(limiter.check("claim-daily", "u1") == 0.0)
+
+    threads = [threading.Thread(target=hammer, args=(limiter,)) for limiter in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(allowed) == 50
+
+
+def test_memory_check_takes_microseconds():
+    limiter = RateLimiter()
+    limiter.add("generate", per_user="1000000/s", overall="1000000/s")
+    started = time.perf_counter()
+    for i in range(20000):
+        limiter.check("generate", f"user-{i % 500}")
+    per_check = (time.perf_counter() - started) / 20000
+    assert per_check < 50e-6, per_check
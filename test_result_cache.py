@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+from result_cache import ResultCache
+
+
+def _write(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return path
+
+
+def test_key_ignores_case_and_whitespace():
+    a = ResultCache.key("A  Beautiful sunset ", "imagen", {"number_of_images": 1})
+    b = ResultCache.key("a beautiful sunset", "imagen", {"number_of_images": 1})
+    c = ResultCache.key("a beautiful sunset", "imagen", {"number_of_images": 2})
+    assert a == b
+    assert a != c
+
+
+def test_lru_eviction_keeps_source_files():
+    static_dir = tempfile.mkdtemp()
+    cache = ResultCache(os.path.join(static_dir, "cache"), max_bytes=250)
+
+    sources = [_write(static_dir, f"generated_{i}.png", 100) for i in range(3)]
+    cache.put("a", sources[0])
+    cache.put("b", sources[1])
+    assert cache.get("a") == "a.png"       # "b" is now least recently used
+    cache.put("c", sources[2])
+
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+    assert cache.stats()["evictions"] == 1
+    assert all(os.path.exists(p) for p in sources)
+
+
+def test_index_survives_restart():
+    static_dir = tempfile.mkdtemp()
+    cache = ResultCache(os.path.join(static_dir, "cache"), max_bytes=1000)
+    cache.put("a", _write(static_dir, "generated_0.png", 10))
+
+    reopened = ResultCache(cache.directory, max_bytes=1000)
+    assert reopened.get("a") == "a.png"
+    assert reopened.stats()["bytes"] == 10
@@ -1,52 +1,54 @@
-import requests
+import os
+import sys
 import json
+import tempfile
+import subprocess
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = {"generate", "get-credits", "claim-daily", "add-credits", "stripe-webhook"}
+
+
+def run_bench(*args):
+    """Run bench.py (the app against fake Vertex / Firebase / Stripe) and return its results."""
+    out = os.path.join(tempfile.mkdtemp(), "results.json")
+    proc = subprocess.run(
+        [sys.executable, os.path.join(BASE_DIR, "bench.py"), "--out", out, "--duration", "2",
+         "--concurrency", "8", "--users", "5", "--imagen-latency", "0.05", "--imagen-jitter", "0",
+         "--firebase-latency", "0.002", "--stripe-latency", "0.01", *args],
+        capture_output=True, text=True, timeout=120)
+    assert os.path.exists(out), proc.stdout + proc.stderr
+    with open(out) as f:
+        return proc.returncode, json.load(f)
+
+
+@pytest.mark.parametrize("server", ["flask", "asgi"])
+@pytest.mark.parametrize("mode", ["file", "firebase"])
+def test_server(mode, server):
+    """Every endpoint answers under concurrent load and no credit update is lost"""
+    code, results = run_bench("--mode", mode, "--server", server)
+
+    assert results["correctness"]["ok"], results["correctness"]
+    assert set(results["endpoints"]) == ENDPOINTS
+    for name, endpoint in results["endpoints"].items():
+        assert endpoint["requests"] > 0
+        assert not any(status.startswith("5") or status == "error" for status in endpoint["statuses"]), \
+            (name, endpoint["statuses"])
+    assert code == 0
+
+
+@pytest.mark.parametrize("server", ["flask", "asgi"])
+def test_server_failures_are_refunded(server):
+    """With Vertex and Firebase failing some calls, balances still add up"""
+    # No retries, so some Imagen failures reach the client
+    code, results = run_bench("--mode", "firebase", "--server", server, "--imagen-error-rate", "0.2",
+                              "--firebase-error-rate", "0.05", "--env", "VERTEX_ATTEMPTS=1")
+
+    assert results["correctness"]["ok"], results["correctness"]
+    assert "500" in results["endpoints"]["generate"]["statuses"]
+    assert code == 0
 
-def test_server():
-    """Test the Flask server endpoints"""
-    
-    # Test the home endpoint
-    try:
-        response = requests.get('http://localhost:5000/')
-        print(f"✅ Home endpoint: {response.status_code}")
-    except Exception as e:
-        print(f"❌ Home endpoint failed: {e}")
-    
-    # Test the image endpoint
-    try:
-        response = requests.get('http://localhost:5000/image')
-        print(f"✅ Image endpoint: {response.status_code}")
-    except Exception as e:
-        print(f"❌ Image endpoint failed: {e}")
-    
-    # Test the generate-image endpoint (GET)
-    try:
-        response = requests.get('http://localhost:5000/generate-image')
-        print(f"✅ Generate-image GET endpoint: {response.status_code}")
-        print(f"   Response: {response.json()}")
-    except Exception as e:
-        print(f"❌ Generate-image GET endpoint failed: {e}")
-    
-    # Test the generate-image endpoint (POST) with a simple prompt
-    try:
-        test_data = {'prompt': 'a beautiful sunset over mountains'}
-        response = requests.post('http://localhost:5000/generate-image', 
-                               json=test_data,
-                               headers={'Content-Type': 'application/json'})
-        print(f"✅ Generate-image POST endpoint: {response.status_code}")
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('success'):
-                print(f"   ✅ Image generated successfully!")
-                print(f"   Filename: {result.get('filename')}")
-            else:
-                print(f"   ❌ Image generation failed: {result.get('error')}")
-        else:
-            print(f"   ❌ Request failed: {response.text}")
-    except Exception as e:
-        print(f"❌ Generate-image POST endpoint failed: {e}")
 
 if __name__ == "__main__":
-    print("Testing Flask server...")
-    print("Make sure the server is running on http://localhost:5000")
-    print("=" * 50)
-    test_server()
+    sys.exit(subprocess.call([sys.executable, os.path.join(BASE_DIR, "bench.py")] + sys.argv[1:]))
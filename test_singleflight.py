@@ -0,0 +1,78 @@
+import time
+import tempfile
+import threading
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def _run_together(callers):
+    results = [None] * len(callers)
+
+    def run(i, fn):
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i, fn)) for i, fn in enumerate(callers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _slow(value, delay=0.2):
+    def fn():
+        time.sleep(delay)
+        return value
+    return fn
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    flight = SingleFlight()
+    results = _run_together([lambda: flight.do("k", _slow("file.png"))] * 5)
+
+    assert [r[0] for r in results] == ["file.png"] * 5
+    assert sorted(r[1] for r in results) == [False, True, True, True, True]
+    assert flight.stats()["upstreamCalls"] == 1
+    assert flight.stats()["coalesced"] == 4
+
+
+def test_errors_reach_every_waiter():
+    flight = SingleFlight()
+
+    def boom():
+        time.sleep(0.2)
+        raise RuntimeError("vertex down")
+
+    results = _run_together([lambda: flight.do("k", boom)] * 3)
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+    # Nothing is remembered afterwards
+    assert flight.do("k", lambda: "ok") == ("ok", False)
+
+
+def test_file_lock_mode_coalesces_across_instances():
+    lock_dir = tempfile.mkdtemp()
+    workers = [SingleFlight(lock_dir=lock_dir) for _ in range(3)]  # one per "process"
+    results = _run_together([lambda w=w: w.do("k", _slow("file.png")) for w in workers])
+
+    assert [r[0] for r in results] == ["file.png"] * 3
+    assert sum(w.stats()["upstreamCalls"] for w in workers) == 1
+
+    # A later call is not served from the old marker
+    assert workers[0].do("k", lambda: "new.png") == ("new.png", False)
+
+
+def test_distinct_keys_do_not_wait_for_each_other():
+    flight = SingleFlight()
+    started = time.time()
+    _run_together([lambda: flight.do("a", _slow(1)), lambda: flight.do("b", _slow(2))])
+    assert time.time() - started < 0.35
+    assert flight.stats()["upstreamCalls"] == 2
+
+    with pytest.raises(ZeroDivisionError):
+        flight.do("c", lambda: 1 / 0)
@@ -0,0 +1,80 @@
+import os
+import sys
+import json
+import tempfile
+import threading
+import subprocess
+
+import pytest
+
+from clients import LazyClient, DependencyUnavailable
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import index
+client = index.app.test_client()
+credits = client.get('/get-credits/someone')
+print(json.dumps({
+    "importMs": index.IMPORT_SECONDS * 1000,
+    "firstResponseMs": (time.perf_counter() - started) * 1000,
+    "credits": credits.status_code,
+    "live": client.get('/livez').status_code,
+    "ready": client.get('/readyz').status_code,
+    "requestId": credits.headers.get("X-Request-ID"),
+}))
+"""
+
+
+def test_import_stays_within_budget_without_cloud_clients():
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, WARM_UP="0",
+               CREDITS_DB=os.path.join(tmp, "credits.db"),
+               VIDEO_JOBS_DB=os.path.join(tmp, "video_jobs.db"),
+               STRIPE_EVENTS_DB=os.path.join(tmp, "stripe_events.db"),
+               STORAGE_DB=os.path.join(tmp, "storage.db"))
+    out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=tmp, env=dict(env, PYTHONPATH=BASE_DIR),
+                         capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+
+    budget_ms = int(os.environ.get("IMPORT_TIME_BUDGET_MS", "1500"))
+    assert result["importMs"] < budget_ms
+    assert result["credits"] == 200
+    assert result["live"] == 200
+    assert result["ready"] == 503   # nothing warmed up, nothing initialized
+
+    # One JSON log line per request on stderr, tagged with the ID the client got back
+    lines = [json.loads(line) for line in out.stderr.splitlines() if line.startswith("{")]
+    request_lines = [line for line in lines if line.get("requestId") == result["requestId"]]
+    assert [(line["msg"], line["status"]) for line in request_lines] == [("request", 200)]
+
+
+def test_lazy_client_initializes_once():
+    calls = []
+    client = LazyClient("thing", lambda: calls.append(1) or object())
+    threads = [threading.Thread(target=client.get) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == [1]
+    assert client.status()["ready"]
+
+
+def test_lazy_client_failure_is_reported_and_retried_later():
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        raise RuntimeError("no credentials")
+
+    client = LazyClient("thing", factory, retry_after=0)
+    with pytest.raises(DependencyUnavailable):
+        client.proxy().generate_images
+    assert client.status()["error"] == "no credentials"
+    with pytest.raises(DependencyUnavailable):
+        client.get()
+    assert len(attempts) == 2
@@ -0,0 +1,54 @@
+import os
+import time
+import tempfile
+
+from storage import StorageManager
+
+
+def _storage(**kwargs):
+    root = tempfile.mkdtemp()
+    return StorageManager(root, os.path.join(root, "storage.db"), **kwargs)
+
+
+def test_files_are_sharded_and_flat_names_still_resolve():
+    storage = _storage()
+    storage.save("generated_1.png", b"new", owner="u1")
+    with open(os.path.join(storage.root, "generated_0.png"), "wb") as f:
+        f.write(b"legacy")
+
+    rel = storage.relative_path("generated_1.png")
+    assert rel.count("/") == 2 and rel.endswith("/generated_1.png")
+    with open(storage.path("generated_1.png"), "rb") as f:
+        assert f.read() == b"new"
+    assert storage.relative_path("generated_0.png") == "generated_0.png"
+
+    assert storage.migrate_flat_files() == 1
+    with open(storage.path("generated_0.png"), "rb") as f:
+        assert f.read() == b"legacy"
+    assert storage.stats()["files"] == 2
+
+
+def test_sweep_applies_ttl_then_size_limit():
+    storage = _storage(ttl_seconds=60, max_bytes=250)
+    storage.save("generated_old.png", b"x" * 10)
+    storage._conn().execute("UPDATE files SET created_at = ? WHERE name = ?",
+                            (time.time() - 120, "generated_old.png"))
+    for i in range(3):
+        storage.save(f"generated_{i}.png", b"x" * 100)
+
+    assert storage.sweep() == 2
+    assert not os.path.exists(storage.path("generated_old.png"))
+    assert not os.path.exists(storage.path("generated_0.png"))
+    assert storage.stats()["bytes"] == 200
+
+
+def test_user_quota_drops_that_users_oldest_files():
+    storage = _storage(user_quota_bytes=250)
+    for i in range(3):
+        storage.save(f"generated_a{i}.png", b"x" * 100, owner="alice")
+    storage.save("generated_b.png", b"x" * 100, owner="bob")
+
+    assert storage.user_bytes("alice") == 200
+    assert not os.path.exists(storage.path("generated_a0.png"))
+    assert os.path.exists(storage.path("generated_a2.png"))
+    assert storage.user_bytes("bob") == 100
@@ -0,0 +1,96 @@
+import os
+import io
+import json
+import base64
+import tempfile
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+import fake_vertex
+from veo import VeoClient, VideoDecoder
+
+
+def _serve(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _client(server, **kwargs):
+    kwargs.setdefault("token_provider", lambda: "test")
+    return VeoClient(f"http://127.0.0.1:{server.server_port}", "p", "us-central1", "veo-3.0-generate-001",
+                     poll_interval=0.02, max_poll_interval=0.1, **kwargs)
+
+
+@pytest.mark.parametrize("shape", ["videos", "predictions"])
+def test_decoder_streams_the_video_out_of_the_json(shape):
+    video = os.urandom(100000)
+    encoded = base64.b64encode(video).decode("ascii").replace("/", "\\/")   # as some encoders escape it
+    if shape == "videos":
+        response = {"videos": [{"bytesBase64Encoded": encoded, "mimeType": "video/mp4"}]}
+    else:
+        response = {"predictions": [{"video": [{"content": encoded}]}]}
+    body = json.dumps({"name": "op", "done": True, "response": response}).replace("\\\\/", "\\/").encode()
+
+    out = io.BytesIO()
+    decoder = VideoDecoder(lambda: out)
+    for i in range(0, len(body), 7):   # chunk edges land inside keys and escapes
+        decoder.feed(body[i:i + 7])
+    result = decoder.finish()
+
+    assert out.getvalue() == video
+    assert result["done"] is True
+    assert len(decoder._json) < 300      # only the JSON around the video was kept
+
+
+def test_concurrent_operations_share_the_pool():
+    video = os.urandom(2 * 1024 * 1024)
+    vertex = fake_vertex.create_app(op_seconds=0.2, video_bytes=video)
+    server = _serve(vertex)
+    client = _client(server, max_concurrent=4)
+    output_dir = tempfile.mkdtemp()
+    try:
+        futures = [client.submit(f"prompt {i}", {}, output_dir) for i in range(8)]
+        paths = [future.result(timeout=30) for future in futures]
+    finally:
+        client.close()
+        server.shutdown()
+
+    assert len(set(paths)) == 8
+    for path in paths:
+        with open(path, "rb") as f:
+            assert f.read() == video
+    assert vertex.stats["started"] == 8
+    # Once operations have finished, new ones aren't polled before they're likely done
+    assert client.expected_seconds() >= 0.2
+    assert client.poll_delay(0, 0) >= 0.1
+
+
+def test_rejected_token_is_refreshed_once():
+    class Token:
+        def __init__(self):
+            self.value, self.refreshes = "", 0
+
+        def __call__(self):
+            if not self.value:
+                self.refreshes += 1
+                self.value = "fresh"
+            return self.value
+
+        def invalidate(self):
+            self.value = ""
+
+    vertex = fake_vertex.create_app(op_seconds=0)
+    server = _serve(vertex)
+    token = Token()
+    token.value = "expired"
+    vertex.config["REJECT_TOKENS"] = {"expired"}
+    client = _client(server, token_provider=token)
+    try:
+        assert client.start("a kitten", {})
+        assert client.start("a puppy", {})
+    finally:
+        server.shutdown()
+    assert token.refreshes == 1
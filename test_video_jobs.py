@@ -0,0 +1,156 @@
+import os
+import time
+import tempfile
+import threading
+
+from werkzeug.serving import make_server
+
+import fake_firebase
+import fake_vertex
+from reservations import FirebaseCreditStore
+from veo import VeoClient
+from video_jobs import VideoJobStore, VideoJobQueue
+
+
+def _serve(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _make_queue(db_path, server, output_dir, **kwargs):
+    client = VeoClient(f"http://127.0.0.1:{server.server_port}", "p", "us-central1",
+                       "veo-3.0-generate-001", token_provider=lambda: "test",
+                       poll_interval=0.05, max_poll_interval=0.05)
+    return VideoJobQueue(VideoJobStore(db_path), client, output_dir, **kwargs)
+
+
+def _wait_for(queue, job_id, states, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in states:
+            return job
+        queue.wait_for_change(0.1)
+    raise AssertionError(f"job stuck in {queue.get(job_id)['status']}")
+
+
+def test_job_runs_to_completion():
+    vertex = fake_vertex.create_app(op_seconds=0.2)
+    server = _serve(vertex)
+    output_dir = tempfile.mkdtemp()
+    queue = _make_queue(os.path.join(output_dir, "jobs.db"), server, output_dir)
+    queue.start()
+    try:
+        job_id = queue.submit("u1", "a kitten", {"durationSeconds": 8})
+        job = _wait_for(queue, job_id, ("succeeded", "failed"))
+    finally:
+        queue.stop()
+        server.shutdown()
+
+    assert job["status"] == "succeeded"
+    with open(os.path.join(output_dir, job["filename"]), "rb") as f:
+        assert f.read() == fake_vertex.SAMPLE_VIDEO
+
+
+def test_restart_resumes_the_same_operation():
+    vertex = fake_vertex.create_app(op_seconds=0.5)
+    server = _serve(vertex)
+    output_dir = tempfile.mkdtemp()
+    db_path = os.path.join(output_dir, "jobs.db")
+
+    first = _make_queue(db_path, server, output_dir)
+    first.start()
+    job_id = first.submit("u1", "a kitten", {})
+    deadline = time.time() + 5
+    while not first.get(job_id)["operation_name"] and time.time() < deadline:
+        time.sleep(0.01)
+    first.stop()
+    assert first.get(job_id)["status"] == "queued"
+
+    second = _make_queue(db_path, server, output_dir)
+    second.start()
+    try:
+        job = _wait_for(second, job_id, ("succeeded", "failed"))
+    finally:
+        second.stop()
+        server.shutdown()
+
+    assert job["status"] == "succeeded"
+    assert vertex.stats["started"] == 1
+
+
+def test_failed_job_calls_on_failed_once():
+    vertex = fake_vertex.create_app(error_rate=1.0)
+    server = _serve(vertex)
+    output_dir = tempfile.mkdtemp()
+    refunds = []
+    queue = _make_queue(os.path.join(output_dir, "jobs.db"), server, output_dir,
+                        on_failed=refunds.append)
+    queue.start()
+    try:
+        job_id = queue.submit("u1", "a kitten", {}, cost=25)
+        job = _wait_for(queue, job_id, ("succeeded", "failed"))
+    finally:
+        queue.stop()
+        server.shutdown()
+
+    assert job["status"] == "failed"
+    assert [r["cost"] for r in refunds] == [25]
+
+
+def test_refund_that_fails_is_retried_by_recovery():
+    vertex = fake_vertex.create_app(error_rate=1.0)
+    server = _serve(vertex)
+    output_dir = tempfile.mkdtemp()
+    db_path = os.path.join(output_dir, "jobs.db")
+
+    def ledger_down(job):
+        raise ConnectionError("ledger unavailable")
+
+    first = _make_queue(db_path, server, output_dir, on_failed=ledger_down)
+    first.start()
+    try:
+        job_id = first.submit("u1", "a kitten", {}, cost=25)
+        _wait_for(first, job_id, ("succeeded", "failed"))
+    finally:
+        first.stop()
+    assert first.get(job_id)["refunded"] == 0
+
+    refunds = []
+    second = _make_queue(db_path, server, output_dir, on_failed=refunds.append)
+    second.start()
+    second.stop()
+    server.shutdown()
+    assert [r["id"] for r in refunds] == [job_id]
+    assert second.get(job_id)["refunded"] == 1
+
+
+def test_refund_applied_before_a_timeout_is_not_repeated():
+    vertex = fake_vertex.create_app(error_rate=1.0)
+    server = _serve(vertex)
+    output_dir = tempfile.mkdtemp()
+    db_path = os.path.join(output_dir, "jobs.db")
+    fake_db = fake_firebase.FakeDatabase()
+    credits = FirebaseCreditStore(fake_db)
+
+    def refund(job):
+        # As index.py's _refund_video_job
+        credits.grant(job["user_id"], job["cost"], key=f"video-refund:{job['id']}")
+
+    fake_db.lost_replies = 1        # the refund lands, then the reply times out
+    first = _make_queue(db_path, server, output_dir, on_failed=refund)
+    first.start()
+    try:
+        job_id = first.submit("u1", "a kitten", {}, cost=25)
+        _wait_for(first, job_id, ("succeeded", "failed"))
+    finally:
+        first.stop()
+    assert first.get(job_id)["refunded"] == 0
+
+    second = _make_queue(db_path, server, output_dir, on_failed=refund)
+    second.start()
+    second.stop()
+    server.shutdown()
+    assert second.get(job_id)["refunded"] == 1
+    assert credits.balance("u1") == 25
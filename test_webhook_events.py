@@ -0,0 +1,70 @@
+import os
+import json
+import tempfile
+
+from webhook_events import WebhookEventStore, WebhookEventQueue, EventRejected
+
+
+def _event(event_id, event_type="checkout.session.completed", **data):
+    return json.dumps({"id": event_id, "type": event_type, "data": {"object": data}})
+
+
+def _make_queue(handler, **kwargs):
+    store = WebhookEventStore(os.path.join(tempfile.mkdtemp(), "events.db"))
+    return WebhookEventQueue(store, {"checkout.session.completed": handler}, poll_interval=0.05, **kwargs)
+
+
+def test_duplicates_are_dropped_and_each_event_applies_once():
+    applied = []
+    events = _make_queue(lambda event: applied.append(event["id"]) or {"ok": True})
+    events.start()
+    try:
+        assert events.submit("evt_1", "checkout.session.completed", _event("evt_1"))
+        assert not events.submit("evt_1", "checkout.session.completed", _event("evt_1"))
+        assert events.submit("evt_2", "checkout.session.completed", _event("evt_2"))
+        assert events.wait_idle(timeout=5)
+    finally:
+        events.stop()
+
+    assert sorted(applied) == ["evt_1", "evt_2"]
+    assert events.stats()["done"] == 2
+    assert json.loads(events.store.get("evt_1")["result"]) == {"ok": True}
+
+
+def test_failures_are_retried_and_rejections_are_not():
+    calls = []
+
+    def handler(event):
+        calls.append(event["id"])
+        if event["id"] == "evt_bad":
+            raise EventRejected("no user_id")
+        if calls.count(event["id"]) < 3:
+            raise ConnectionError("ledger unavailable")
+
+    events = _make_queue(handler, retry_base=0.01)
+    events.start()
+    try:
+        events.submit("evt_flaky", "checkout.session.completed", _event("evt_flaky"))
+        events.submit("evt_bad", "checkout.session.completed", _event("evt_bad"))
+        assert events.wait_idle(timeout=5)
+    finally:
+        events.stop()
+
+    assert calls.count("evt_flaky") == 3 and calls.count("evt_bad") == 1
+    assert events.store.get("evt_flaky")["status"] == "done"
+    assert events.store.get("evt_bad")["status"] == "failed"
+
+
+def test_events_survive_a_restart():
+    path = os.path.join(tempfile.mkdtemp(), "events.db")
+    WebhookEventQueue(WebhookEventStore(path), {}).submit("evt_1", "checkout.session.completed", _event("evt_1"))
+
+    applied = []
+    events = WebhookEventQueue(WebhookEventStore(path), {"checkout.session.completed": applied.append},
+                               poll_interval=0.05)
+    events.start()
+    try:
+        assert events.wait_idle(timeout=5)
+    finally:
+        events.stop()
+    assert [event["id"] for event in applied] == ["evt_1"]
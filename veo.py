@@ -0,0 +1,326 @@
+# veo.py
+"""Client for Veo video generation on Vertex AI (predictLongRunning / fetchPredictOperation).
+
+    client = VeoClient(api_base, project, location, "veo-3.0-generate-001")
+    path = client.generate("a kitten playing with yarn", {"durationSeconds": 8}, "frames/")
+    futures = [client.submit(prompt, {}, "frames/") for prompt in prompts]   # many at once
+
+- One pooled requests.Session per client, so polls reuse their connections.
+- Credentials come from Application Default Credentials (GoogleToken) and
+  are refreshed a few minutes before they expire, not fetched per call; a
+  401 forces one refresh and a retry.
+- Polling backs off from `poll_interval` to `max_poll_interval`. Once a few
+  operations have finished, the first polls wait for about as long as they
+  usually take instead of asking early.
+- The finished operation's base64 video is decoded straight into a file as
+  the response streams in (VideoDecoder), so memory stays at a chunk or two
+  rather than the base64 text plus the decoded video.
+
+`fake_vertex.py` serves the same endpoints locally for tests.
+"""
+import os
+import re
+import json
+import time
+import base64
+import logging
+import tempfile
+import threading
+import statistics
+from collections import deque
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 256 * 1024
+SCOPES = ("https://www.googleapis.com/auth/cloud-platform",)
+
+# Where the MP4 sits in the two response shapes Veo uses:
+# response.videos[].bytesBase64Encoded and response.predictions[].video[].content
+VIDEO_STRING = re.compile(rb'"(?:bytesBase64Encoded|content)"\s*:\s*"')
+SCAN_OVERLAP = 64            # bytes kept between chunks so a key split across two is still found
+STRING_END = re.compile(rb'["\\]')
+JSON_ESCAPES = {ord("/"): b"/", ord("\\"): b"\\", ord('"'): b'"', ord("n"): b"", ord("r"): b"",
+                ord("t"): b"", ord("b"): b"", ord("f"): b""}
+
+log = logging.getLogger(__name__)
+
+
+class GoogleToken:
+    """Access tokens from Application Default Credentials, refreshed shortly before they expire."""
+
+    def __init__(self, scopes=SCOPES, refresh_margin=300):
+        self.scopes = list(scopes)
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._credentials = None
+        self._request = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self._credentials is None:
+                import google.auth
+                import google.auth.transport.requests
+
+                self._credentials, _ = google.auth.default(scopes=self.scopes)
+                self._request = google.auth.transport.requests.Request()
+            creds = self._credentials
+            # google-auth keeps expiry as naive UTC
+            if not creds.token or (creds.expiry and creds.expiry - self.refresh_margin <= datetime.utcnow()):
+                creds.refresh(self._request)
+            return creds.token
+
+    def invalidate(self):
+        with self._lock:
+            if self._credentials is not None:
+                self._credentials.token = None
+
+
+class VideoDecoder:
+    """Decodes the first video string of a JSON response fed to it in chunks.
+
+    The base64 goes through `open_output()` (called once, when the video
+    starts) as bytes; everything else is kept, with the video string left
+    empty, and parsed by finish().
+    """
+
+    def __init__(self, open_output):
+        self.open_output = open_output
+        self.out = None
+        self.written = 0
+        self._state = "scan"      # scan -> video -> rest
+        self._json = bytearray()
+        self._scan = b""           # tail of the previous chunk, not yet searched past
+        self._escape = b""         # an escape sequence split across chunks
+        self._base64 = b""         # fewer than 4 base64 characters left over
+
+    def feed(self, chunk):
+        if self._state == "scan":
+            data = self._scan + chunk
+            match = VIDEO_STRING.search(data)
+            if match is None:
+                keep = max(len(data) - SCAN_OVERLAP, 0)
+                self._json += data[:keep]
+                self._scan = data[keep:]
+                return
+            self._json += data[:match.end()]
+            self._scan = b""
+            self._state = "video"
+            self.out = self.open_output()
+            chunk = data[match.end():]
+        if self._state == "video":
+            chunk = self._feed_video(chunk)
+            if chunk is None:
+                return
+            self._state = "rest"
+        self._json += chunk
+
+    def _feed_video(self, data):
+        """Decode what is there; returns the remainder after the closing quote, or None if not there yet."""
+        data = self._escape + data
+        self._escape = b""
+        text = bytearray()
+        rest = None
+        i = 0
+        while True:
+            match = STRING_END.search(data, i)
+            if match is None:
+                text += data[i:]
+                break
+            j = match.start()
+            text += data[i:j]
+            if data[j:j + 1] == b'"':
+                rest = data[j:]
+                break
+            # A JSON escape; base64 only ever needs \/ and \uXXXX
+            if j + 1 >= len(data) or (data[j + 1] == ord("u") and j + 6 > len(data)):
+                self._escape = data[j:]
+                break
+            if data[j + 1] == ord("u"):
+                text += chr(int(data[j + 2:j + 6], 16)).encode("ascii", "ignore")
+                i = j + 6
+            else:
+                text += JSON_ESCAPES.get(data[j + 1], b"")
+                i = j + 2
+
+        text = self._base64 + bytes(text)
+        usable = len(text) - len(text) % 4 if rest is None else len(text)
+        if usable:
+            decoded = base64.b64decode(text[:usable])
+            self.out.write(decoded)
+            self.written += len(decoded)
+        self._base64 = text[usable:]
+        return rest
+
+    def finish(self):
+        """The response JSON (video string emptied)."""
+        if self._state == "video":
+            raise RuntimeError("Veo response ended in the middle of the video")
+        return json.loads(bytes(self._json + self._scan))
+
+
+def video_error(result):
+    """Why a finished operation has no inline video."""
+    response = result.get("response") or {}
+    for video in response.get("videos") or []:
+        if video.get("gcsUri"):
+            return RuntimeError(f"Video was written to {video['gcsUri']}; storageUri output is not supported")
+    reasons = response.get("raiMediaFilteredReasons")
+    if reasons:
+        return RuntimeError(f"Video was filtered: {reasons}")
+    return RuntimeError("No video content in the finished operation. Check prompt or API usage.")
+
+
+class VeoClient:
+    def __init__(self, api_base, project, location, model_id, token_provider=None, timeout=60,
+                 poll_interval=5.0, max_poll_interval=30.0, poll_backoff=1.5, max_concurrent=8):
+        self.model_url = (f"{api_base.rstrip('/')}/v1/projects/{project}/locations/{location}"
+                          f"/publishers/google/models/{model_id}")
+        self.token_provider = token_provider or GoogleToken()
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(max_poll_interval, poll_interval)
+        self.poll_backoff = poll_backoff
+        self.max_concurrent = max_concurrent
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._executor = None
+        self._started = {}                   # operation name -> monotonic start, for durations
+        self._durations = deque(maxlen=20)   # seconds, recent operations
+        self._lock = threading.Lock()
+
+    # -- operations --
+    def start(self, prompt, params):
+        """Start the operation. Returns its name."""
+        result = self._post("predictLongRunning", self.request_body(prompt, params)).json()
+        name = result.get("name")
+        if not name:
+            raise RuntimeError(f"Veo did not return an operation name: {result}")
+        with self._lock:
+            if len(self._started) < 10000:
+                self._started[name] = time.monotonic()
+        return name
+
+    def fetch(self, operation_name, output_dir):
+        """Poll once. Returns (done, path): the MP4 decoded into a temp file in output_dir."""
+        paths = []
+
+        def open_output():
+            fd, path = tempfile.mkstemp(dir=output_dir, prefix=".tmp-veo-", suffix=".mp4")
+            paths.append(path)
+            return os.fdopen(fd, "wb")
+
+        decoder = VideoDecoder(open_output)
+        try:
+            with self._post("fetchPredictOperation", {"operationName": operation_name}, stream=True) as response:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    decoder.feed(chunk)
+            if decoder.out is not None:
+                decoder.out.close()
+            result = decoder.finish()
+            if "error" in result:
+                raise RuntimeError(f"Veo fetchPredictOperation failed: {result['error']}")
+            if not result.get("done"):
+                return False, None
+            self._finished(operation_name)
+            if not decoder.written:
+                raise video_error(result)
+            return True, paths.pop()
+        except BaseException:
+            if decoder.out is not None:
+                decoder.out.close()
+            for path in paths:
+                os.remove(path)
+            raise
+
+    def generate(self, prompt, params, output_dir, timeout=900.0):
+        """Start, poll until done and return the path of the MP4 (a temp name in output_dir)."""
+        operation = self.start(prompt, params)
+        started = time.monotonic()
+        polls = 0
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed > timeout:
+                raise RuntimeError(f"Video generation timed out after {int(elapsed)}s")
+            time.sleep(self.poll_delay(polls, elapsed))
+            polls += 1
+            done, path = self.fetch(operation, output_dir)
+            if done:
+                return path
+
+    def submit(self, prompt, params, output_dir, timeout=900.0):
+        """generate() on the client's pool (max_concurrent at once). Returns a Future."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="veo")
+        return self._executor.submit(self.generate, prompt, params, output_dir, timeout)
+
+    def poll_delay(self, polls, elapsed):
+        """Seconds to wait before the next poll of an operation `elapsed` seconds old."""
+        delay = min(self.max_poll_interval, self.poll_interval * self.poll_backoff ** polls)
+        expected = self.expected_seconds()
+        if expected is not None and elapsed + delay < expected:
+            # Operations usually take about this long; asking sooner is wasted
+            delay = min(expected - elapsed, self.max_poll_interval)
+        return delay
+
+    def expected_seconds(self):
+        with self._lock:
+            if len(self._durations) < 3:
+                return None
+            return statistics.median(self._durations)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.session.close()
+
+    # -- internals --
+    @staticmethod
+    def request_body(prompt, params):
+        return {
+            "instances": [{"prompt": prompt}],
+            "parameters": {
+                "aspectRatio": params.get("aspectRatio", "16:9"),
+                "sampleCount": 1,
+                "durationSeconds": params.get("durationSeconds", 8),
+                "personGeneration": "allow_all",
+                "addWatermark": True,
+                "includeRaiReason": True,
+                "generateAudio": params.get("generateAudio", True),
+                "resolution": params.get("resolution", "720p")
+            }
+        }
+
+    def _post(self, action, body, stream=False):
+        for attempt in range(2):
+            response = self.session.post(
+                f"{self.model_url}:{action}",
+                headers={"Authorization": f"Bearer {self.token_provider()}"},
+                json=body,
+                timeout=self.timeout,
+                stream=stream)
+            if response.status_code == 401 and attempt == 0 and hasattr(self.token_provider, "invalidate"):
+                response.close()
+                self.token_provider.invalidate()
+                continue
+            break
+        if response.status_code >= 400:
+            try:
+                error = response.json().get("error", response.text)
+            except ValueError:
+                error = response.text
+            finally:
+                response.close()
+            raise RuntimeError(f"Veo {action} failed: {error}")
+        return response
+
+    def _finished(self, operation_name):
+        with self._lock:
+            started = self._started.pop(operation_name, None)
+            if started is not None:
+                self._durations.append(time.monotonic() - started)
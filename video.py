@@ -1,106 +1,65 @@
+# video.py
+"""Generate videos with Veo from the command line.
+
+    python video.py                                   # the default kitten prompt
+    python video.py "a fox in snow" "a lighthouse at dawn" --duration 6
+
+Prompts run concurrently, each written to OUTPUT_DIR/video[-n].mp4.
+Credentials come from Application Default Credentials
+(`gcloud auth application-default login`) or VEO_ACCESS_TOKEN; set
+VEO_API_BASE to point at fake_vertex.py.
+"""
 import os
-import json
-import time
-import base64
-import requests
-from subprocess import check_output
+import sys
+import logging
+import argparse
+
+from veo import VeoClient
 
 # --- Configuration ---
 PROJECT_ID = "perseptra-468600"
 LOCATION_ID = "us-central1"
-API_ENDPOINT = f"{LOCATION_ID}-aiplatform.googleapis.com"
+API_BASE = os.environ.get("VEO_API_BASE", f"https://{LOCATION_ID}-aiplatform.googleapis.com")
 MODEL_ID = "veo-3.0-generate-001"
 
 OUTPUT_DIR = "frames"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # --- Predefined safe prompt ---
-prompt = "A cute kitten playing with a ball of yarn in a living room"
-
-# --- Request JSON ---
-request_data = {
-    "instances": [{"prompt": prompt}],
-    "parameters": {
-        "aspectRatio": "16:9",
-        "sampleCount": 1,
-        "durationSeconds": 8,
-        "personGeneration": "allow_all",
-        "addWatermark": True,
-        "includeRaiReason": True,
-        "generateAudio": True,
-        "resolution": "720p"
-    }
-}
-
-# --- Get access token (hardcoded gcloud path for Windows) ---
-gcloud_path = r"C:\Users\adels\AppData\Local\Google\Cloud SDK\google-cloud-sdk\bin\gcloud.cmd"
-access_token = check_output([gcloud_path, "auth", "print-access-token"]).decode().strip()
-
-# --- Start long-running operation ---
-response = requests.post(
-    f"https://{API_ENDPOINT}/v1/projects/{PROJECT_ID}/locations/{LOCATION_ID}/publishers/google/models/{MODEL_ID}:predictLongRunning",
-    headers={
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    },
-    json=request_data
-)
-
-operation = response.json().get("name")
-if not operation:
-    print("Failed to start operation:", response.text)
-    exit(1)
-
-print("Operation started:", operation)
-
-# --- Poll until operation is done ---
-elapsed = 0
-while True:
-    time.sleep(10)
-    elapsed += 10
-    print(f"Waiting for operation to finish... ({elapsed}s elapsed)")
+DEFAULT_PROMPT = "A cute kitten playing with a ball of yarn in a living room"
 
-    fetch_response = requests.post(
-        f"https://{API_ENDPOINT}/v1/projects/{PROJECT_ID}/locations/{LOCATION_ID}/publishers/google/models/{MODEL_ID}:fetchPredictOperation",
-        headers={
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        },
-        json={"operationName": operation}
-    )
-    result = fetch_response.json()
 
-    # --- Debug: show full API response ---
-    print("--- FULL RESPONSE JSON ---")
-    print(json.dumps(result, indent=2))
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("prompts", nargs="*", default=[DEFAULT_PROMPT])
+    parser.add_argument("--duration", type=int, default=8, help="seconds of video")
+    parser.add_argument("--aspect-ratio", default="16:9")
+    parser.add_argument("--resolution", default="720p")
+    parser.add_argument("--timeout", type=float, default=900.0)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-    # --- Check for errors ---
-    if "error" in result:
-        print("Operation returned an error:", result["error"])
-        exit(1)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    token = os.environ.get("VEO_ACCESS_TOKEN")
+    client = VeoClient(API_BASE, PROJECT_ID, LOCATION_ID, MODEL_ID,
+                       token_provider=(lambda: token) if token else None,
+                       max_concurrent=max(len(args.prompts), 1))
+    params = {"durationSeconds": args.duration, "aspectRatio": args.aspect_ratio, "resolution": args.resolution}
+    futures = [client.submit(prompt, params, OUTPUT_DIR, args.timeout) for prompt in args.prompts]
 
-    if result.get("done"):
-        break
+    failed = 0
+    for i, (prompt, future) in enumerate(zip(args.prompts, futures)):
+        try:
+            path = future.result()
+        except Exception as e:
+            failed += 1
+            print(f"{prompt!r} failed: {e}")
+            continue
+        output_path = os.path.join(OUTPUT_DIR, "video.mp4" if i == 0 else f"video-{i}.mp4")
+        os.replace(path, output_path)
+        print(f"{prompt!r} saved to {output_path}")
+    client.close()
+    return 1 if failed else 0
 
-# --- Save MP4 videos ---
-predictions = result.get("response", {}).get("predictions")
-if predictions is None:
-    print("No predictions key in response! Check API limits or prompt filtering.")
-elif not predictions:
-    print("Predictions array is empty! Prompt may be rejected or invalid.")
-else:
-    video_list = predictions[0].get("video", [])
-    if video_list:
-        video_base64 = video_list[0].get("content")
-        if video_base64:
-            video_bytes = base64.b64decode(video_base64)
-            output_path = os.path.join(OUTPUT_DIR, "video.mp4")
-            with open(output_path, "wb") as f:
-                f.write(video_bytes)
-            print(f"Video saved to {output_path}")
-        else:
-            print("No content in video object!")
-    else:
-        print("No video content in predictions. Check prompt or API usage.")
 
-print("All done!")
+if __name__ == "__main__":
+    sys.exit(main())
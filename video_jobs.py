@@ -0,0 +1,290 @@
+# video_jobs.py
+"""Background video generation jobs.
+
+/generate-video enqueues a job and returns its id straight away. A small,
+bounded pool of worker threads drives the Veo long-running operation through
+a veo.VeoClient (predictLongRunning, then fetchPredictOperation on the
+client's backoff schedule until done) and moves the MP4 into STATIC_DIR.
+
+Jobs live in SQLite, so they survive a restart: a job that was queued is
+picked up again, and a job that was running resumes polling the operation it
+already started instead of paying for a new one. A running job holds a lease
+that its worker renews on every poll; if the worker dies the lease expires
+and any worker (in any process sharing the database) takes the job over.
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import threading
+import logging
+
+TERMINAL_STATES = ("succeeded", "failed")
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id              TEXT PRIMARY KEY,
+    user_id         TEXT NOT NULL,
+    prompt          TEXT NOT NULL,
+    params          TEXT NOT NULL,
+    cost            INTEGER NOT NULL DEFAULT 0,
+    status          TEXT NOT NULL,
+    progress        TEXT,
+    operation_name  TEXT,
+    filename        TEXT,
+    error           TEXT,
+    polls           INTEGER NOT NULL DEFAULT 0,
+    created_at      REAL NOT NULL,
+    started_at      REAL,
+    updated_at      REAL NOT NULL,
+    lease_until     REAL,
+    refunded        INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class VideoJobStore:
+    """SQLite persistence for video jobs."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(SCHEMA)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, user_id, prompt, params, cost):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO jobs (id, user_id, prompt, params, cost, status, progress, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, 'queued', 'Waiting for a worker', ?, ?)",
+            (job_id, user_id, prompt, json.dumps(params), cost, now, now))
+        return job_id
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def claim(self, job_id, lease_seconds):
+        """Take a job for this worker. Returns the job, or None if someone else has it."""
+        now = time.time()
+        cur = self._conn().execute(
+            "UPDATE jobs SET status = 'running', lease_until = ?, updated_at = ?, "
+            "started_at = COALESCE(started_at, ?) "
+            "WHERE id = ? AND (status = 'queued' OR (status = 'running' AND lease_until < ?))",
+            (now + lease_seconds, now, now, job_id, now))
+        if cur.rowcount != 1:
+            return None
+        return self.get(job_id)
+
+    def update(self, job_id, lease_seconds=None, **fields):
+        fields["updated_at"] = time.time()
+        if lease_seconds is not None and "lease_until" not in fields:
+            fields["lease_until"] = fields["updated_at"] + lease_seconds
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._conn().execute(f"UPDATE jobs SET {columns} WHERE id = ?",
+                             list(fields.values()) + [job_id])
+
+    def release(self, job_id):
+        """Hand a running job back to the queue (graceful shutdown)."""
+        self._conn().execute(
+            "UPDATE jobs SET status = 'queued', lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    def mark_refunded(self, job_id):
+        """Returns True exactly once per job."""
+        cur = self._conn().execute(
+            "UPDATE jobs SET refunded = 1 WHERE id = ? AND refunded = 0", (job_id,))
+        return cur.rowcount == 1
+
+    def unmark_refunded(self, job_id):
+        """Undo mark_refunded after the refund itself failed, so it is tried again."""
+        self._conn().execute("UPDATE jobs SET refunded = 0 WHERE id = ?", (job_id,))
+
+    def unrefunded_ids(self):
+        """Failed jobs whose refund hasn't gone through yet."""
+        rows = self._conn().execute(
+            "SELECT id FROM jobs WHERE status = 'failed' AND refunded = 0 ORDER BY created_at").fetchall()
+        return [row["id"] for row in rows]
+
+    def runnable_ids(self):
+        """Queued jobs plus running jobs whose worker stopped renewing its lease."""
+        rows = self._conn().execute(
+            "SELECT id FROM jobs WHERE status = 'queued' "
+            "OR (status = 'running' AND lease_until < ?) ORDER BY created_at",
+            (time.time(),)).fetchall()
+        return [row["id"] for row in rows]
+
+    def count_active(self):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+
+class VideoJobQueue:
+    """Bounded worker pool running video jobs from a VideoJobStore.
+
+    on_failed(job) is called once for every job that ends up failed (e.g. to
+    refund its credits). If it raises, the job stays unrefunded and the hook
+    is tried again on the next recovery pass (at start, and when a worker is
+    idle), so it must be idempotent. save_file(filename, path, job) takes a
+    finished video, decoded into a temp file in output_dir; by default it is
+    renamed to output_dir/filename.
+    """
+
+    def __init__(self, store, client, output_dir, workers=2, max_pending=100,
+                 job_timeout=900.0, on_failed=None, save_file=None):
+        self.store = store
+        self.client = client
+        self.output_dir = output_dir
+        self.workers = workers
+        self.max_pending = max_pending
+        self.job_timeout = job_timeout
+        self.lease_seconds = max(60.0, client.max_poll_interval * 3)
+        self.on_failed = on_failed
+        self.save_file = save_file or self._write_output
+        self.changed = threading.Condition()
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    # -- public API --
+    def start(self):
+        """Start the workers and pick up jobs left over from a previous run."""
+        self._stop.clear()
+        self._recover()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"video-job-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        """Stop the workers. Jobs in progress go back to 'queued'."""
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def submit(self, user_id, prompt, params, cost=0):
+        if self.store.count_active() >= self.max_pending:
+            raise JobQueueFull("Too many video jobs in progress, try again later")
+        job_id = self.store.create(user_id, prompt, params, cost)
+        self._queue.put(job_id)
+        self._notify()
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def wait_for_change(self, timeout):
+        with self.changed:
+            self.changed.wait(timeout)
+
+    # -- internals --
+    def _notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def _update(self, job_id, **fields):
+        self.store.update(job_id, lease_seconds=self.lease_seconds, **fields)
+        self._notify()
+
+    def _recover(self):
+        for job_id in self.store.runnable_ids():
+            self._queue.put(job_id)
+        for job_id in self.store.unrefunded_ids():
+            self._refund(job_id)
+
+    def _worker(self):
+        last_recover = time.time()
+        while not self._stop.is_set():
+            try:
+                job_id = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                # Idle: now and then adopt jobs orphaned by a worker that died
+                if time.time() - last_recover > self.lease_seconds:
+                    last_recover = time.time()
+                    self._recover()
+                continue
+            job = self.store.claim(job_id, self.lease_seconds)
+            if job is None:
+                continue
+            try:
+                self._run(job)
+            except Exception as e:
+                log.exception(f"Error in video job {job_id}")
+                self._fail(job_id, str(e))
+
+    def _run(self, job):
+        job_id = job["id"]
+        operation = job["operation_name"]
+        if not operation:
+            self._update(job_id, progress="Submitting to Veo")
+            operation = self.client.start(job["prompt"], job["params"])
+            self._update(job_id, operation_name=operation, progress="Generating video")
+
+        polls = job["polls"]
+        while True:
+            elapsed = time.time() - job["started_at"]
+            if self._stop.wait(self.client.poll_delay(polls, elapsed)):
+                self.store.release(job_id)
+                self._notify()
+                return
+            polls += 1
+            done, path = self.client.fetch(operation, self.output_dir)
+            if done:
+                break
+            elapsed = time.time() - job["started_at"]
+            if elapsed > self.job_timeout:
+                raise RuntimeError(f"Video generation timed out after {int(elapsed)}s")
+            self._update(job_id, polls=polls, progress=f"Generating video ({int(elapsed)}s elapsed)")
+
+        filename = f"generated_video_{time.time_ns()}.mp4"
+        try:
+            self.save_file(filename, path, job)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self._update(job_id, status="succeeded", polls=polls, filename=filename,
+                     progress="Done", lease_until=None)
+
+    def _write_output(self, filename, path, job):
+        os.replace(path, os.path.join(self.output_dir, filename))
+
+    def _fail(self, job_id, error):
+        self.store.update(job_id, status="failed", error=error, progress="Failed", lease_until=None)
+        self._notify()
+        self._refund(job_id)
+
+    def _refund(self, job_id):
+        # mark_refunded first, so two workers never both refund; undone if the hook fails
+        if self.on_failed and self.store.mark_refunded(job_id):
+            try:
+                self.on_failed(self.store.get(job_id))
+            except Exception:
+                self.store.unmark_refunded(job_id)
+                log.exception(f"on_failed hook failed for video job {job_id}; will retry")
@@ -0,0 +1,212 @@
+# webhook_events.py
+"""Durable queue for webhook events (Stripe), keyed by the event id.
+
+/stripe-webhook verifies the signature, stores the raw event and answers 200
+straight away; Stripe gets its acknowledgement in a few milliseconds and
+stops retrying. Worker threads then apply each event with the handler
+registered for its type.
+
+Events live in SQLite, so they survive a restart. The event id is the
+primary key: a retry or a duplicate delivery of an event already stored is
+acknowledged and dropped. A handler that raises is tried again later with
+exponential backoff, up to `max_attempts`; one that raises EventRejected
+(the event can never be applied, e.g. no user id) fails straight away.
+Handlers should still be idempotent on the event id, since a worker dying
+between applying an event and marking it done means it runs again; the
+credit grants are (see CreditLedger.grant / FirebaseCreditStore.grant).
+"""
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+import metrics
+
+WEBHOOK_EVENTS = metrics.counter("webhook_events_total", "Webhook events by outcome", ("type", "outcome"))
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id              TEXT PRIMARY KEY,
+    type            TEXT NOT NULL,
+    payload         TEXT NOT NULL,
+    status          TEXT NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until     REAL,
+    result          TEXT,
+    error           TEXT,
+    created_at      REAL NOT NULL,
+    updated_at      REAL NOT NULL
+)
+"""
+
+
+class EventRejected(Exception):
+    """Raised by a handler for an event that will never apply; it isn't retried."""
+
+
+class WebhookEventStore:
+    """SQLite persistence for received events."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(SCHEMA)
+        conn.execute("CREATE INDEX IF NOT EXISTS events_due ON events (status, next_attempt_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, event_id, event_type, payload):
+        """Store a new event. Returns False if the id was seen before."""
+        now = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO events (id, type, payload, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'queued', ?, ?, ?) ON CONFLICT(id) DO NOTHING",
+            (event_id, event_type, payload, now, now, now))
+        return cur.rowcount == 1
+
+    def get(self, event_id):
+        row = self._conn().execute("SELECT * FROM events WHERE id = ?", (event_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self, event_id, lease_seconds):
+        """Take a due event for this worker. Returns it, or None if it isn't due or someone else has it."""
+        now = time.time()
+        row = self._conn().execute(
+            "UPDATE events SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ? "
+            "WHERE id = ? AND ((status = 'queued' AND next_attempt_at <= ?) "
+            "OR (status = 'running' AND lease_until < ?)) RETURNING *",
+            (now + lease_seconds, now, event_id, now, now)).fetchone()
+        return dict(row) if row is not None else None
+
+    def finish(self, event_id, status, result=None, error=None, retry_at=None):
+        """status: 'done', 'failed', or 'queued' again to retry at `retry_at`."""
+        now = time.time()
+        self._conn().execute(
+            "UPDATE events SET status = ?, result = ?, error = ?, next_attempt_at = ?, lease_until = NULL, "
+            "updated_at = ? WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, retry_at or now, now, event_id))
+
+    def due_ids(self):
+        """Queued events whose time has come, plus running ones whose worker stopped."""
+        now = time.time()
+        rows = self._conn().execute(
+            "SELECT id FROM events WHERE (status = 'queued' AND next_attempt_at <= ?) "
+            "OR (status = 'running' AND lease_until < ?) ORDER BY created_at",
+            (now, now)).fetchall()
+        return [row["id"] for row in rows]
+
+    def counts(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM events GROUP BY status").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+
+class WebhookEventQueue:
+    """Worker threads applying stored events with handlers[event type](event)."""
+
+    def __init__(self, store, handlers, workers=1, max_attempts=8, retry_base=2.0, retry_max=600.0,
+                 lease_seconds=60.0, poll_interval=1.0):
+        self.store = store
+        self.handlers = handlers
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    # -- public API --
+    def start(self):
+        """Start the workers; events left over from a previous run are picked up as they come due."""
+        self._stop.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"webhook-events-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def handles(self, event_type):
+        return event_type in self.handlers
+
+    def submit(self, event_id, event_type, payload):
+        """Store an event and queue it. Returns False for a duplicate."""
+        if not self.store.add(event_id, event_type, payload):
+            WEBHOOK_EVENTS.inc(type=event_type, outcome="duplicate")
+            return False
+        WEBHOOK_EVENTS.inc(type=event_type, outcome="received")
+        self._queue.put(event_id)
+        return True
+
+    def wait_idle(self, timeout):
+        """Wait until nothing is queued or running. Returns True if that happened in time."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            counts = self.store.counts()
+            if not counts.get("queued") and not counts.get("running"):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def stats(self):
+        return dict(self.store.counts(), workers=len(self._threads))
+
+    # -- internals --
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                event_id = self._queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                # Idle: retries that came due, and events orphaned by a dead worker
+                for event_id in self.store.due_ids():
+                    self._queue.put(event_id)
+                continue
+            event = self.store.claim(event_id, self.lease_seconds)
+            if event is not None:
+                self._process(event)
+
+    def _process(self, event):
+        event_id, event_type = event["id"], event["type"]
+        try:
+            result = self.handlers[event_type](json.loads(event["payload"]))
+        except EventRejected as e:
+            log.error(f"Webhook event {event_id} rejected: {e}", extra={"eventType": event_type})
+            self.store.finish(event_id, "failed", error=str(e))
+            WEBHOOK_EVENTS.inc(type=event_type, outcome="failed")
+            return
+        except Exception as e:
+            if event["attempts"] >= self.max_attempts:
+                log.exception(f"Webhook event {event_id} failed {event['attempts']} times, giving up",
+                              extra={"eventType": event_type})
+                self.store.finish(event_id, "failed", error=str(e))
+                WEBHOOK_EVENTS.inc(type=event_type, outcome="failed")
+                return
+            delay = min(self.retry_max, self.retry_base * 2 ** (event["attempts"] - 1))
+            log.warning(f"Webhook event {event_id} failed ({e}), retrying in {delay:.0f}s",
+                        extra={"eventType": event_type, "attempt": event["attempts"]})
+            self.store.finish(event_id, "queued", error=str(e), retry_at=time.time() + delay)
+            WEBHOOK_EVENTS.inc(type=event_type, outcome="retried")
+            return
+        self.store.finish(event_id, "done", result=result)
+        WEBHOOK_EVENTS.inc(type=event_type, outcome="applied")